@@ -0,0 +1,203 @@
+import copy
+import time
+import torch
+import argparse
+
+from torch import nn
+from fed_multimodal.constants import constants
+from fed_multimodal.model.mm_models import HARClassifier, MMActionClassifier
+from fed_multimodal.trainers.evaluation import EvalMetric
+from fed_multimodal.trainers.fed_avg_trainer import ClientFedAvg
+from fed_multimodal.trainers.mixed_precision import autocast_context
+
+# Define logging console
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def parse_args():
+    # read path config files
+    parser = argparse.ArgumentParser(description='bf16 autocast accuracy parity check')
+    parser.add_argument(
+        '--hid_size',
+        type=int,
+        default=64,
+        help='RNN hidden size dim'
+    )
+    parser.add_argument(
+        '--num_clients',
+        type=int,
+        default=4,
+        help='Clients trained every round'
+    )
+    parser.add_argument(
+        '--num_epochs',
+        type=int,
+        default=10,
+        help='Federated rounds'
+    )
+    parser.add_argument(
+        '--learning_rate',
+        type=float,
+        default=0.05,
+        help='Client learning rate'
+    )
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=1,
+        help='Torch intra-op threads'
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cpu',
+        help='Device to run the check on'
+    )
+    args = parser.parse_args()
+    return args
+
+
+def build_setting(
+    dataset: str,
+    args
+):
+    """
+    Build the model and synthetic client and test data at the shapes of a dataset.
+
+    Every class has its own mean feature vector per modality, so the data is
+    learnable and the accuracy of both precisions can be compared.
+    :param dataset: uci-har or crema_d
+    :param args: check arguments
+    :return: model, client data list, test data
+    """
+    torch.manual_seed(8)
+    num_class = constants.num_class_dict[dataset]
+    if dataset == 'uci-har':
+        model = HARClassifier(
+            num_classes=num_class,
+            acc_input_dim=constants.feature_len_dict['acc'],
+            gyro_input_dim=constants.feature_len_dict['gyro'],
+            d_hid=args.hid_size,
+            en_att=True,
+            att_name='fuse_base'
+        )
+        shapes = [(128, 128), (constants.feature_len_dict['acc'], constants.feature_len_dict['gyro'])]
+    else:
+        model = MMActionClassifier(
+            num_classes=num_class,
+            audio_input_dim=constants.feature_len_dict['mfcc'],
+            video_input_dim=constants.feature_len_dict['mobilenet_v2'],
+            d_hid=args.hid_size,
+            en_att=True,
+            att_name='fuse_base'
+        )
+        shapes = [(300, 6), (constants.feature_len_dict['mfcc'], constants.feature_len_dict['mobilenet_v2'])]
+    means = [torch.randn(num_class, dim) for dim in shapes[1]]
+
+    def sample(num_samples):
+        # Padded batches of class means plus noise, with random valid lengths
+        y = torch.randint(num_class, (num_samples,))
+        data = list()
+        for max_len, dim, mean in zip(shapes[0], shapes[1], means):
+            x = mean[y].unsqueeze(1) + torch.randn(num_samples, max_len, dim)
+            lens = torch.randint(max_len // 2, max_len + 1, (num_samples,))
+            lens[0] = max_len
+            x = x * (torch.arange(max_len).unsqueeze(0) < lens.unsqueeze(1)).unsqueeze(2)
+            data.extend([x, lens])
+        x_a, l_a, x_b, l_b = data
+        return [
+            (x_a[idx:idx+16], x_b[idx:idx+16], l_a[idx:idx+16], l_b[idx:idx+16], y[idx:idx+16])
+            for idx in range(0, num_samples, 16)
+        ]
+
+    client_data = [sample(64) for _ in range(args.num_clients)]
+    return model.to(args.device), client_data, sample(256)
+
+
+def evaluate(
+    model,
+    test_data: list,
+    train_args
+):
+    # Test accuracy and loss, with the forward of Server.inference
+    model.eval()
+    eval_metric = EvalMetric(False)
+    criterion = nn.NLLLoss()
+    with torch.inference_mode():
+        for x_a, x_b, l_a, l_b, y in test_data:
+            with autocast_context(train_args, train_args.device):
+                outputs, _ = model(
+                    x_a.to(train_args.device), x_b.to(train_args.device),
+                    l_a.to(train_args.device), l_b.to(train_args.device)
+                )
+            outputs = torch.log_softmax(outputs.float(), dim=1)
+            y = y.to(train_args.device)
+            eval_metric.append_classification_results(y, outputs, criterion(outputs, y))
+    return eval_metric.classification_summary()
+
+
+def run(
+    dataset: str,
+    precision: str,
+    args
+):
+    """
+    Train FedAvg rounds with ClientFedAvg in one precision and evaluate the global model.
+    :param dataset: uci-har or crema_d
+    :param precision: fp32 or bf16
+    :param args: check arguments
+    :return: test result, training time in seconds
+    """
+    global_model, client_data, test_data = build_setting(dataset, args)
+    train_args = argparse.Namespace(
+        dataset=dataset,
+        modality='multimodal',
+        fed_alg='fed_avg',
+        learning_rate=args.learning_rate,
+        local_epochs=1,
+        mu=0,
+        device=args.device,
+        mixed_precision=precision
+    )
+    torch.manual_seed(8)
+    start_time = time.time()
+    for epoch in range(args.num_epochs):
+        # fp32 average of the client weights
+        state_dicts = list()
+        for dataloader in client_data:
+            client = ClientFedAvg(
+                train_args,
+                args.device,
+                nn.NLLLoss(),
+                dataloader,
+                copy.deepcopy(global_model)
+            )
+            client.update_weights()
+            state_dicts.append(client.get_parameters())
+        global_model.load_state_dict({
+            key: torch.stack([state_dict[key].float() for state_dict in state_dicts]).mean(dim=0)
+            for key in state_dicts[0]
+        })
+    train_time = time.time() - start_time
+    return evaluate(global_model, test_data, train_args), train_time
+
+
+if __name__ == '__main__':
+
+    # argument parser
+    args = parse_args()
+    torch.set_num_threads(args.num_threads)
+
+    for dataset in ['uci-har', 'crema_d']:
+        fp32_result, fp32_time = run(dataset, 'fp32', args)
+        bf16_result, bf16_time = run(dataset, 'bf16', args)
+        logging.info(
+            f'{dataset:>8}: fp32 acc {fp32_result["acc"]:6.2f} loss {fp32_result["loss"]:.4f} ({fp32_time:6.2f} s), '
+            f'bf16 acc {bf16_result["acc"]:6.2f} loss {bf16_result["loss"]:.4f} ({bf16_time:6.2f} s), '
+            f'acc diff {bf16_result["acc"] - fp32_result["acc"]:+.2f}'
+        )
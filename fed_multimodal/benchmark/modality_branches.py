@@ -0,0 +1,153 @@
+import time
+import torch
+import argparse
+
+from fed_multimodal.constants import constants
+from fed_multimodal.model.mm_models import HARClassifier, MMActionClassifier
+
+# Define logging console
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def parse_args():
+    # read path config files
+    parser = argparse.ArgumentParser(description='Concurrent modality branch microbenchmark')
+    parser.add_argument(
+        '--hid_size',
+        type=int,
+        default=64,
+        help='RNN hidden size dim'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=16,
+        help='Client batch size'
+    )
+    parser.add_argument(
+        '--num_steps',
+        type=int,
+        default=50,
+        help='Timed steps per setting'
+    )
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=4,
+        help='Torch intra-op threads'
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cpu',
+        help='Device to run the benchmark on'
+    )
+    args = parser.parse_args()
+    return args
+
+
+def build_model(
+    model_name: str,
+    concurrent: bool,
+    args
+):
+    """
+    Build the benchmarked model and a random padded batch at its dataset shapes.
+    :param model_name: har or mm_action
+    :param concurrent: run the modality branches concurrently
+    :param args: benchmark arguments
+    :return: model, model inputs
+    """
+    torch.manual_seed(8)
+    batch_size = args.batch_size
+    if model_name == 'har':
+        model = HARClassifier(
+            num_classes=constants.num_class_dict['uci-har'],
+            acc_input_dim=constants.feature_len_dict['acc'],
+            gyro_input_dim=constants.feature_len_dict['gyro'],
+            d_hid=args.hid_size,
+            en_att=True,
+            att_name='fuse_base',
+            concurrent_branches=concurrent
+        )
+        x_a = torch.randn(batch_size, 128, constants.feature_len_dict['acc'])
+        x_b = torch.randn(batch_size, 128, constants.feature_len_dict['gyro'])
+        l_a = torch.full((batch_size,), 128)
+        l_b = torch.full((batch_size,), 128)
+    else:
+        model = MMActionClassifier(
+            num_classes=constants.num_class_dict['ucf101'],
+            audio_input_dim=constants.feature_len_dict['mfcc'],
+            video_input_dim=constants.feature_len_dict['mobilenet_v2'],
+            d_hid=args.hid_size,
+            en_att=True,
+            att_name='fuse_base',
+            concurrent_branches=concurrent
+        )
+        x_a = torch.randn(batch_size, 400, constants.feature_len_dict['mfcc'])
+        x_b = torch.randn(batch_size, 50, constants.feature_len_dict['mobilenet_v2'])
+        l_a = torch.randint(200, 401, (batch_size,))
+        l_b = torch.randint(25, 51, (batch_size,))
+        l_a[0], l_b[0] = 400, 50
+    model = model.to(args.device)
+    inputs = [x_a.to(args.device), x_b.to(args.device), l_a.to(args.device), l_b.to(args.device)]
+    return model, inputs
+
+
+def time_steps(
+    model_name: str,
+    concurrent: bool,
+    train: bool,
+    args
+):
+    """
+    Time forward (and backward) steps of a model.
+    :param model_name: har or mm_action
+    :param concurrent: run the modality branches concurrently
+    :param train: time forward and backward, else inference
+    :param args: benchmark arguments
+    :return: mean step time in milliseconds, eval outputs of the first batch
+    """
+    model, inputs = build_model(model_name, concurrent, args)
+    model.eval()
+    with torch.no_grad():
+        outputs, _ = model(*[value.clone() for value in inputs])
+
+    def step():
+        if train:
+            model.train()
+            preds, _ = model(*[value.clone() for value in inputs])
+            preds.sum().backward()
+        else:
+            with torch.no_grad():
+                model(*[value.clone() for value in inputs])
+
+    # warm up, then time
+    for _ in range(5): step()
+    if args.device == 'cuda': torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(args.num_steps): step()
+    if args.device == 'cuda': torch.cuda.synchronize()
+    return (time.time() - start_time) / args.num_steps * 1e3, outputs
+
+
+if __name__ == '__main__':
+
+    # argument parser
+    args = parse_args()
+    torch.set_num_threads(args.num_threads)
+
+    for model_name in ['har', 'mm_action']:
+        for train in [True, False]:
+            seq_time, seq_outputs = time_steps(model_name, False, train, args)
+            con_time, con_outputs = time_steps(model_name, True, train, args)
+            max_diff = (seq_outputs - con_outputs).abs().max().item()
+            logging.info(
+                f'{model_name:>9} {"train" if train else "eval":>5}: sequential {seq_time:7.2f} ms, '
+                f'concurrent {con_time:7.2f} ms, speedup {seq_time/con_time:.2f}x, max diff {max_diff:.1e}'
+            )
@@ -0,0 +1,367 @@
+import time
+import torch
+import argparse
+import warnings
+
+from fed_multimodal.constants import constants
+from fed_multimodal.model.mm_models import HARClassifier
+from fed_multimodal.trainers.optimizer import FedProxOptimizer, ScaffoldOptimizer, NovaOptimizer
+
+# Define logging console
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def parse_args():
+    # read path config files
+    parser = argparse.ArgumentParser(description='Optimizer step microbenchmark')
+    parser.add_argument(
+        '--hid_size',
+        type=int,
+        default=64,
+        help='RNN hidden size dim'
+    )
+    parser.add_argument(
+        '--num_steps',
+        type=int,
+        default=500,
+        help='Timed optimizer steps per setting'
+    )
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=1,
+        help='Torch intra-op threads'
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cpu',
+        help='Device to run the benchmark on'
+    )
+    args = parser.parse_args()
+    return args
+
+
+# The steps of the client optimizers before the foreach and flat paths, copied
+# unchanged as the reference timing and parity target. They use the deprecated
+# add_(scalar, tensor) overloads, whose warnings are silenced.
+class BaselineNovaOptimizer(NovaOptimizer):
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            weight_decay = group["weight_decay"]
+            momentum = group["momentum"]
+            dampening = group["dampening"]
+            nesterov = group["nesterov"]
+
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+
+                d_p = p.grad.data
+
+                # weight_decay
+                if weight_decay != 0:
+                    d_p.add_(weight_decay, p.data)
+
+                # save the first parameter w0
+                param_state = self.state[p]
+                if "old_init" not in param_state:
+                    param_state["old_init"] = torch.clone(p.data).detach()
+
+                local_lr = group["lr"]
+                if momentum != 0:
+                    if "momentum_buffer" not in param_state:
+                        buf = torch.clone(d_p).detach()
+                        param_state["momentum_buffer"] = buf
+                    else:
+                        buf = param_state["momentum_buffer"]
+                        buf.mul_(momentum).add_(1 - dampening, d_p)
+
+                        # update momentum buffer !!!
+                        param_state["momentum_buffer"] = buf
+
+                    if nesterov:
+                        d_p = d_p.add(momentum, buf)
+                    else:
+                        d_p = buf
+
+                # add proximal updates: g_t = g_t + prox_mu * (w - w0)
+                if self.prox_mu != 0:
+                    d_p.add_(self.prox_mu, p.data - param_state["old_init"])
+
+                # updata accumulated local updates
+                if "cum_grad" not in param_state:
+                    param_state["cum_grad"] = torch.clone(d_p).detach()
+                    param_state["cum_grad"].mul_(local_lr)
+                else:
+                    param_state["cum_grad"].add_(local_lr, d_p)
+
+                # update: w_{t+1} = w_t - lr * g_t
+                p.data.add_(-1.0 * local_lr, d_p)
+
+        if self.momentum != 0:
+            self.local_counter = self.local_counter * self.momentum + 1
+            self.local_normalizing_vec += self.local_counter
+
+        self.etamu = local_lr * self.prox_mu
+        if self.etamu != 0:
+            self.local_normalizing_vec *= (1 - self.etamu)
+            self.local_normalizing_vec += 1
+
+        if self.momentum == 0 and self.etamu == 0:
+            self.local_normalizing_vec += 1
+
+        self.local_steps += 1
+        return
+
+
+class BaselineScaffoldOptimizer(ScaffoldOptimizer):
+    def step(self, server_control, client_control, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure
+
+        ng = len(self.param_groups[0]["params"])
+        names = list(server_control.keys())
+
+        # BatchNorm: running_mean/std, num_batches_tracked
+        names = [name for name in names if "running" not in name]
+        names = [name for name in names if "num_batch" not in name]
+
+        t = 0
+        for group in self.param_groups:
+            weight_decay = group["weight_decay"]
+            momentum = group["momentum"]
+            dampening = group["dampening"]
+
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+
+                d_p = p.grad.data
+                param_state = self.state[p]
+
+                # weight_decay
+                if weight_decay != 0:
+                    d_p.add_(weight_decay, p.data)
+
+                if momentum != 0:
+                    if "momentum_buffer" not in param_state:
+                        buf = torch.clone(d_p).detach()
+                        param_state["momentum_buffer"] = buf
+                    else:
+                        buf = param_state["momentum_buffer"]
+                        buf.mul_(momentum).add_(1 - dampening, d_p)
+
+                        # update momentum buffer !!!
+                        param_state["momentum_buffer"] = buf
+                    d_p = buf
+
+                c = server_control[names[t]]
+                ci = client_control[names[t]]
+
+                d_p = d_p + c.data - ci.data
+
+                p.data = p.data - d_p.data * group["lr"]
+                t += 1
+        assert t == ng
+        return loss
+
+
+class BaselineFedProxOptimizer(FedProxOptimizer):
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            weight_decay = group['weight_decay']
+            momentum = group['momentum']
+            dampening = group['dampening']
+            nesterov = group['nesterov']
+
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                d_p = p.grad.data
+
+                if weight_decay != 0:
+                    d_p.add_(weight_decay, p.data)
+
+                param_state = self.state[p]
+                if 'old_init' not in param_state:
+                    param_state['old_init'] = torch.clone(p.data).detach()
+
+                if momentum != 0:
+                    if 'momentum_buffer' not in param_state:
+                        buf = param_state['momentum_buffer'] = torch.clone(d_p).detach()
+                    else:
+                        buf = param_state['momentum_buffer']
+                        buf.mul_(momentum).add_(1 - dampening, d_p)
+                    if nesterov:
+                        d_p = d_p.add(momentum, buf)
+                    else:
+                        d_p = buf
+
+                # apply proximal update
+                d_p.add_(self.mu, p.data - param_state['old_init'])
+                p.data.add_(-group['lr'], d_p)
+
+        return loss
+
+
+def build_optimizer(
+    fed_alg: str,
+    model,
+    mode: str
+):
+    # Build the client optimizer of fed_alg, as ClientFedAvg and ClientScaffold do
+    if mode == 'baseline':
+        classes = dict(fed_prox=BaselineFedProxOptimizer, scaffold=BaselineScaffoldOptimizer, fed_nova=BaselineNovaOptimizer)
+        options = dict()
+    else:
+        classes = dict(fed_prox=FedProxOptimizer, scaffold=ScaffoldOptimizer, fed_nova=NovaOptimizer)
+        options = dict(foreach=(mode != 'loop'), flat=(mode == 'flat'))
+    if fed_alg == 'fed_prox':
+        return classes[fed_alg](
+            model.parameters(),
+            lr=0.05,
+            momentum=0.9,
+            weight_decay=1e-5,
+            mu=0.01,
+            **options
+        )
+    elif fed_alg == 'scaffold':
+        return classes[fed_alg](
+            model.parameters(),
+            lr=0.05,
+            momentum=0.9,
+            weight_decay=1e-5,
+            param_names=[name for name, _ in model.named_parameters()],
+            **options
+        )
+    return classes[fed_alg](
+        model.parameters(),
+        lr=0.05,
+        ratio=1.0,
+        gmf=0,
+        prox_mu=0.01,
+        momentum=0.9,
+        weight_decay=1e-5,
+        **options
+    )
+
+
+def build_setting(
+    fed_alg: str,
+    mode: str,
+    args
+):
+    """
+    Build the uci-har model with random gradients and controls, and its optimizer.
+    :param fed_alg: federated algorithm of the optimizer
+    :param mode: baseline, loop, foreach or flat
+    :param args: benchmark arguments
+    :return: model, gradients, controls (None but for scaffold), optimizer
+    """
+    torch.manual_seed(8)
+    model = HARClassifier(
+        num_classes=constants.num_class_dict['uci-har'],
+        acc_input_dim=constants.feature_len_dict['acc'],
+        gyro_input_dim=constants.feature_len_dict['gyro'],
+        en_att=True,
+        d_hid=args.hid_size,
+        att_name='fuse_base'
+    ).to(args.device)
+    grads = [torch.randn_like(param) * 1e-3 for param in model.parameters()]
+    for param, grad in zip(model.parameters(), grads): param.grad = grad.clone()
+    controls = None
+    if fed_alg == 'scaffold':
+        controls = [
+            {key: torch.randn_like(value.float()) * 1e-4 for key, value in model.state_dict().items()}
+            for _ in range(2)
+        ]
+    optimizer = build_optimizer(fed_alg, model, mode)
+    return model, grads, controls, optimizer
+
+
+def optimizer_step(
+    optimizer,
+    controls
+):
+    # One step, scaffold takes the server and client controls
+    if controls is not None: optimizer.step(server_control=controls[0], client_control=controls[1])
+    else: optimizer.step()
+
+
+def time_steps(
+    fed_alg: str,
+    mode: str,
+    args
+):
+    """
+    Time optimizer steps on random gradients.
+    :param fed_alg: federated algorithm of the optimizer
+    :param mode: baseline, loop, foreach or flat
+    :param args: benchmark arguments
+    :return: mean step time in microseconds
+    """
+    _, _, controls, optimizer = build_setting(fed_alg, mode, args)
+
+    # warm up, then time
+    for _ in range(10): optimizer_step(optimizer, controls)
+    if args.device == 'cuda': torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(args.num_steps): optimizer_step(optimizer, controls)
+    if args.device == 'cuda': torch.cuda.synchronize()
+    return (time.time() - start_time) / args.num_steps * 1e6
+
+
+def run_steps(
+    fed_alg: str,
+    mode: str,
+    args,
+    num_steps: int=20
+):
+    """
+    Run optimizer steps on the same gradients every step, for the parity check.
+    :param fed_alg: federated algorithm of the optimizer
+    :param mode: baseline, loop, foreach or flat
+    :param args: benchmark arguments
+    :param num_steps: number of steps
+    :return: flat params after the steps
+    """
+    model, grads, controls, optimizer = build_setting(fed_alg, mode, args)
+    for _ in range(num_steps):
+        # the loop paths add the weight decay to the gradients in place
+        for param, grad in zip(model.parameters(), grads): param.grad = grad.clone()
+        optimizer_step(optimizer, controls)
+    return torch.cat([param.detach().reshape(-1) for param in model.parameters()])
+
+
+if __name__ == '__main__':
+
+    # argument parser
+    args = parse_args()
+    torch.set_num_threads(args.num_threads)
+    warnings.filterwarnings('ignore', category=UserWarning)
+
+    for fed_alg in ['fed_prox', 'scaffold', 'fed_nova']:
+        baseline_time = time_steps(fed_alg, 'baseline', args)
+        baseline_params = run_steps(fed_alg, 'baseline', args)
+        for mode in ['baseline', 'loop', 'foreach', 'flat']:
+            step_time = baseline_time if mode == 'baseline' else time_steps(fed_alg, mode, args)
+            max_diff = (run_steps(fed_alg, mode, args) - baseline_params).abs().max().item()
+            logging.info(
+                f'{fed_alg:>8} {mode:>8}: {step_time:8.1f} us/step, speedup {baseline_time/step_time:.2f}x, '
+                f'max diff {max_diff:.1e}'
+            )
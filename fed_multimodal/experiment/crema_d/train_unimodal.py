@@ -27,6 +27,11 @@ from dataload_manager import DataloadManager
 from fed_rs_trainer import ClientFedRS
 from fed_avg_trainer import ClientFedAvg
 from scaffold_trainer import ClientScaffold
+from round_executor import build_round_executor
+from distributed import shard_client_ids
+from eval_pipeline import build_eval_pipeline
+from eval_scheduler import EvalScheduler
+from compiled_model import compile_model
 
 # define logging console
 import logging
@@ -257,6 +262,377 @@ def parse_args():
         "--dataset", 
         default="crema_d"
     )
+
+    parser.add_argument(
+        '--client_workers', 
+        default=0,
+        type=int,
+        help="worker processes training clients in parallel, 0 trains sequentially",
+    )
+
+    parser.add_argument(
+        '--worker_threads', 
+        default=1,
+        type=int,
+        help="torch threads per client worker process",
+    )
+
+    parser.add_argument(
+        '--stack_clients', 
+        default=0,
+        type=int,
+        help="train this many clients together as one vmap-stacked model, 0 disables",
+    )
+
+    parser.add_argument(
+        '--control_dtype', 
+        default='fp32',
+        type=str,
+        help="storage dtype of the scaffold client controls: fp32 or fp16",
+    )
+
+    parser.add_argument(
+        '--control_hot_clients', 
+        default=0,
+        type=int,
+        help="scaffold client controls kept in memory, the rest spill to disk, 0 keeps all",
+    )
+
+    parser.add_argument(
+        '--control_spill_dir', 
+        default=None,
+        type=str,
+        help="directory of the scaffold control and codec residual spill files, default system temp dir",
+    )
+
+    parser.add_argument(
+        '--server_beta1', 
+        default=0.9,
+        type=float,
+        help="server momentum (fed_avgm) or first moment decay (fed_adam, fed_yogi, fed_adagrad)",
+    )
+
+    parser.add_argument(
+        '--server_beta2', 
+        default=0.99,
+        type=float,
+        help="second moment decay of fed_adam and fed_yogi",
+    )
+
+    parser.add_argument(
+        '--server_tau', 
+        default=1e-3,
+        type=float,
+        help="adaptivity of fed_adam, fed_yogi and fed_adagrad",
+    )
+
+    parser.add_argument(
+        '--update_codec', 
+        default='none',
+        type=str,
+        help="client update codec: none, fp16, q8, q4, topk or randk",
+    )
+
+    parser.add_argument(
+        '--codec_ratio', 
+        default=0.01,
+        type=float,
+        help="fraction of the update sent by topk and randk",
+    )
+
+    parser.add_argument(
+        '--codec_residual_dtype', 
+        default='fp16',
+        type=str,
+        help="storage dtype of the topk and randk client residuals: fp32 or fp16",
+    )
+
+    parser.add_argument(
+        '--codec_hot_clients', 
+        default=0,
+        type=int,
+        help="topk and randk client residuals kept in memory, the rest spill to disk, 0 keeps all",
+    )
+
+    parser.add_argument(
+        '--async_buffer', 
+        default=0,
+        type=int,
+        help="asynchronous buffered aggregation: client updates per server update, 0 trains synchronously",
+    )
+
+    parser.add_argument(
+        '--async_server_lr', 
+        default=1.0,
+        type=float,
+        help="server learning rate of the asynchronous updates",
+    )
+
+    parser.add_argument(
+        '--client_speed_sigma', 
+        default=0.0,
+        type=float,
+        help="lognormal sigma of the emulated client slowdowns in asynchronous training",
+    )
+
+    parser.add_argument(
+        "--simulate",
+        type=bool, 
+        default=False,
+        help="virtual-clock simulation of device speeds and dropouts",
+    )
+    
+    parser.add_argument(
+        "--en_simulate",
+        dest='simulate',
+        action='store_true',
+        help="enable virtual-clock simulation",
+    )
+
+    parser.add_argument(
+        '--sim_gflops', 
+        default=10.0,
+        type=float,
+        help="mean client compute speed in GFLOP/s",
+    )
+
+    parser.add_argument(
+        '--sim_bandwidth_mbps', 
+        default=10.0,
+        type=float,
+        help="mean client upload bandwidth in Mbit/s, downloads are 4x faster",
+    )
+
+    parser.add_argument(
+        '--sim_speed_sigma', 
+        default=0.5,
+        type=float,
+        help="lognormal sigma of the client compute speeds",
+    )
+
+    parser.add_argument(
+        '--sim_bandwidth_sigma', 
+        default=0.5,
+        type=float,
+        help="lognormal sigma of the client bandwidths",
+    )
+
+    parser.add_argument(
+        '--sim_deadline', 
+        default=0.0,
+        type=float,
+        help="round deadline in simulated seconds, later clients are dropped; 0 waits for all",
+    )
+
+    parser.add_argument(
+        '--sim_over_select', 
+        default=0.0,
+        type=float,
+        help="extra fraction of clients selected per round, the slowest are dropped",
+    )
+
+    parser.add_argument(
+        '--sim_dropout', 
+        default=0.0,
+        type=float,
+        help="probability that a selected client goes offline during the round",
+    )
+
+    parser.add_argument(
+        '--sim_target', 
+        default=0.0,
+        type=float,
+        help="dev metric target of the time-to-accuracy report; 0 disables",
+    )
+
+    parser.add_argument(
+        "--distributed",
+        type=bool, 
+        default=False,
+        help="distributed run over torch.distributed (gloo), launched with torchrun",
+    )
+    
+    parser.add_argument(
+        "--en_distributed",
+        dest='distributed',
+        action='store_true',
+        help="enable distributed run, rank 0 hosts the server",
+    )
+
+    parser.add_argument(
+        '--net_clients', 
+        default=0,
+        type=int,
+        help="number of local client processes of the socket runtime, 0 trains in process",
+    )
+
+    parser.add_argument(
+        '--net_host', 
+        default='127.0.0.1',
+        type=str,
+        help="address the socket runtime server listens on",
+    )
+
+    parser.add_argument(
+        '--net_port', 
+        default=0,
+        type=int,
+        help="port of the socket runtime server, 0 picks a free port",
+    )
+
+    parser.add_argument(
+        '--num_edges', 
+        default=0,
+        type=int,
+        help="number of edge aggregators, sorted clients are split into contiguous groups; 0 disables",
+    )
+
+    parser.add_argument(
+        '--edge_map', 
+        default='',
+        type=str,
+        help="json file mapping edges to client ids (or client ids to edges), overrides num_edges",
+    )
+
+    parser.add_argument(
+        "--eval_pipeline",
+        type=bool, 
+        default=False,
+        help="evaluate dev/test in a background process while the next round trains",
+    )
+    
+    parser.add_argument(
+        "--en_eval_pipeline",
+        dest='eval_pipeline',
+        action='store_true',
+        help="enable pipelined evaluation",
+    )
+
+    parser.add_argument(
+        '--eval_threads', 
+        default=0,
+        type=int,
+        help="torch threads of dev/test evaluation, 0 keeps the current setting (1 in the background evaluation process)",
+    )
+
+    parser.add_argument(
+        '--train_metrics', 
+        default='full',
+        type=str,
+        help="client training metrics: none, loss, full, or sampled (full on a fraction of the clients, loss on the others)",
+    )
+
+    parser.add_argument(
+        '--train_metrics_fraction', 
+        default=0.1,
+        type=float,
+        help="fraction of the clients collecting full training metrics in sampled mode",
+    )
+
+    parser.add_argument(
+        '--eval_cache', 
+        default='none',
+        type=str,
+        help="dev/test batches: none (dataloader every round), ordered (collated once) or sorted (collated once, length sorted)",
+    )
+
+    parser.add_argument(
+        '--eval_batch_size', 
+        default=0,
+        type=int,
+        help="batch size of the cached dev/test batches, 0 keeps the dataloader batch size",
+    )
+
+    parser.add_argument(
+        '--test_frequency', 
+        default=1,
+        type=int,
+        help="perform test frequency",
+    )
+
+    parser.add_argument(
+        '--eval_schedule', 
+        default='fixed',
+        type=str,
+        help="evaluation rounds: fixed (every test_frequency rounds), geometric or plateau (interval grows without dev improvement)",
+    )
+
+    parser.add_argument(
+        '--eval_growth', 
+        default=2.0,
+        type=float,
+        help="interval growth of the geometric evaluation schedule",
+    )
+
+    parser.add_argument(
+        '--eval_max_interval', 
+        default=0,
+        type=int,
+        help="largest evaluation interval of the geometric and plateau schedules, 0 for no cap",
+    )
+
+    parser.add_argument(
+        "--lazy_test",
+        type=bool, 
+        default=False,
+        help="evaluate the test set only when dev improves",
+    )
+    
+    parser.add_argument(
+        "--en_lazy_test",
+        dest='lazy_test',
+        action='store_true',
+        help="enable lazy test evaluation",
+    )
+
+    parser.add_argument(
+        '--patience', 
+        default=0,
+        type=int,
+        help="stop after this many evaluations without dev improvement, 0 disables",
+    )
+
+    parser.add_argument(
+        "--compile",
+        type=bool, 
+        default=False,
+        help="run the model forward and backward through torch.compile",
+    )
+    
+    parser.add_argument(
+        "--en_compile",
+        dest='compile',
+        action='store_true',
+        help="enable compiled execution",
+    )
+
+    parser.add_argument(
+        '--compile_mode', 
+        default='default',
+        type=str,
+        help="torch.compile mode: default, reduce-overhead or max-autotune",
+    )
+
+    parser.add_argument(
+        '--compile_bucket', 
+        default=0,
+        type=int,
+        help="pad the sequence length of compiled batches to a multiple of this, 0 disables",
+    )
+
+    parser.add_argument(
+        '--mixed_precision', 
+        default='fp32',
+        type=str,
+        help="precision of the model forward: fp32 or bf16 (autocast, fp32 weights and aggregation)",
+    )
+
+    parser.add_argument(
+        '--optimizer_impl', 
+        default='auto',
+        type=str,
+        help="client optimizer update path: auto (foreach on cuda), loop, foreach or flat",
+    )
     args = parser.parse_args()
     return args
 
@@ -275,7 +651,7 @@ if __name__ == '__main__':
 
     save_result_dict = dict()
 
-    if args.fed_alg in ['fed_avg', 'fed_prox', 'fed_opt']:
+    if args.fed_alg in ['fed_avg', 'fed_prox', 'fed_opt', 'fed_avgm', 'fed_adam', 'fed_yogi', 'fed_adagrad']:
         Client = ClientFedAvg
     elif args.fed_alg in ['scaffold']:
         Client = ClientScaffold
@@ -296,7 +672,7 @@ if __name__ == '__main__':
         # set dataloaders
         dataloader_dict = dict()
         logging.info('Loading Data')
-        for client_id in tqdm(dm.client_ids):
+        for client_id in tqdm(shard_client_ids(args, dm.client_ids)):
 
             if args.modality == 'audio':
                 data_dict = dm.load_audio_feat(
@@ -344,6 +720,8 @@ if __name__ == '__main__':
                 att_name=args.att_name
             )
         global_model = global_model.to(device)
+        # compiled once, the client models are copies of it
+        global_model = compile_model(args, global_model)
 
         # initialize server
         server = Server(
@@ -375,57 +753,41 @@ if __name__ == '__main__':
             save_json_path.joinpath('label.json')
         )
 
+        # round executor, trains the sampled clients of every round
+        round_executor = build_round_executor(
+            args, 
+            device, 
+            criterion, 
+            Client, 
+            dataloader_dict, 
+            model=server.global_model,
+            label_dist_dict=dm.label_dist_dict,
+            num_class=constants.num_class_dict[args.dataset]
+        )
+
+        # background dev/test evaluation, overlaps the next round
+        eval_pipeline = build_eval_pipeline(
+            args,
+            server,
+            dataloader_dict
+        )
+        # rounds to evaluate, and early stopping
+        eval_scheduler = EvalScheduler(args)
+
         # set seeds again
         set_seed(8)
 
         # Training steps
         for epoch in range(int(args.num_epochs)):
+            # stop once dev has not improved for args.patience evaluations
+            if eval_scheduler.should_stop(server): break
             # define list varibles that saves the weights, loss, num_sample, etc.
             server.initialize_epoch_updates(epoch)
             # 1. Local training, return weights in fed_avg, return gradients in fed_sgd
-            skip_client_ids = list()
-            for idx in server.clients_list[epoch]:
-                # Local training
-                client_id = client_ids[idx]
-                dataloader = dataloader_dict[client_id]
-                if dataloader is None:
-                    skip_client_ids.append(client_id)
-                    continue
-                # initialize client object
-                client = Client(
-                    args, 
-                    device, 
-                    criterion, 
-                    dataloader, 
-                    model=copy.deepcopy(server.global_model),
-                    label_dict=dm.label_dist_dict[client_id],
-                    num_class=constants.num_class_dict[args.dataset]
-                )
-
-                if args.fed_alg == 'scaffold':
-                    client.set_control(
-                        server_control=copy.deepcopy(server.server_control), 
-                        client_control=copy.deepcopy(server.client_controls[client_id])
-                    )
-                    client.update_weights()
-
-                    # server append updates
-                    server.set_client_control(client_id, copy.deepcopy(client.client_control))
-                    server.save_train_updates(
-                        copy.deepcopy(client.get_parameters()), 
-                        client.result['sample'], 
-                        client.result,
-                        delta_control=copy.deepcopy(client.delta_control)
-                    )
-                else:
-                    client.update_weights()
-                    # server append updates
-                    server.save_train_updates(
-                        copy.deepcopy(client.get_parameters()), 
-                        client.result['sample'], 
-                        client.result
-                    )
-                del client
+            skip_client_ids = round_executor.run_round(
+                server, 
+                [client_ids[idx] for idx in server.clients_list[epoch]]
+            )
             
             # logging skip client
             logging.info(f'Client Round: {epoch}, Skip client {skip_client_ids}')
@@ -439,25 +801,34 @@ if __name__ == '__main__':
                 data_split='train', 
                 metric=args.metric
             )
-            with torch.no_grad():
-                # 3. Perform the validation on dev set
-                server.inference(dataloader_dict['dev'])
-                server.result_dict[epoch]['dev'] = server.result
-                server.log_classification_result(
-                    data_split='dev', 
-                    metric=args.metric
-                )
-                # 4. Perform the test on holdout set
-                server.inference(dataloader_dict['test'])
-                server.result_dict[epoch]['test'] = server.result
-                server.log_classification_result(
-                    data_split='test', 
-                    metric=args.metric
-                )
+            if eval_scheduler.should_evaluate(epoch, server):
+                if eval_pipeline is not None:
+                    # evaluate the snapshot while the next round trains
+                    eval_pipeline.submit(server, metric=args.metric)
+                    continue
+                with torch.no_grad():
+                    # 3. Perform the validation on dev set
+                    server.inference(dataloader_dict['dev'])
+                    server.result_dict[epoch]['dev'] = server.result
+                    server.log_classification_result(
+                        data_split='dev', 
+                        metric=args.metric
+                    )
+                    # 4. Perform the test on holdout set, only when needed
+                    if eval_scheduler.need_test(server, metric=args.metric):
+                        server.inference(dataloader_dict['test'])
+                        server.result_dict[epoch]['test'] = server.result
+                        server.log_classification_result(
+                            data_split='test', 
+                            metric=args.metric
+                        )
             
+                logging.info('---------------------------------------------------------')
+                server.log_epoch_result(metric=args.metric)
             logging.info('---------------------------------------------------------')
-            server.log_epoch_result(metric=args.metric)
-            logging.info('---------------------------------------------------------')
+
+        round_executor.close()
+        if eval_pipeline is not None: eval_pipeline.close(server)
 
         # Performance save code
         save_result_dict[f'fold{fold_idx}'] = server.summarize_dict_results()
@@ -43,9 +43,12 @@ class FuseBaseSelfAttention(nn.Module):
         att = self.att_fc2(att)
         att = att.transpose(1, 2)
         if val_a is not None:
-            for idx in range(len(val_a)):
-                att[idx, :, val_a[idx]:a_len] = -1e5
-                att[idx, :, a_len+val_b[idx]:] = -1e5
+            # the first a_len positions hold modality a, the rest modality b
+            pos = torch.arange(att.shape[-1], device=att.device)
+            val_a = torch.as_tensor(val_a, device=att.device).unsqueeze(-1)
+            val_b = torch.as_tensor(val_b, device=att.device).unsqueeze(-1)
+            valid = torch.where(pos < a_len, pos < val_a, pos < a_len + val_b)
+            att = att.masked_fill(~valid.unsqueeze(1), -1e5)
         att = torch.softmax(att, dim=2)
         x = torch.matmul(att, x)
         x = x.reshape(x.shape[0], self.d_head*self.d_hid)
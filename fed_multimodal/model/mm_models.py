@@ -3,8 +3,10 @@
 """
 @author: Tiantian
 """
+import os
 import pdb
 import torch
+import threading
 import numpy as np
 import torch.nn as nn
 
@@ -15,6 +17,8 @@ from torch.nn.utils.rnn import pack_padded_sequence
 
 # typing import
 from typing import Dict, Iterable, Optional
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 class MMActionClassifier(nn.Module):
@@ -27,12 +31,16 @@ class MMActionClassifier(nn.Module):
         n_filters: int=32,      # number of filters
         en_att: bool=False,     # Enable self attention or not
         att_name: str='',       # Attention Name
-        d_head: int=6           # Head dim
+        d_head: int=6,          # Head dim
+        masked_pool: bool=False, # Average over valid timesteps only
+        concurrent_branches: bool=False # Run the modality encoders concurrently
     ):
         super(MMActionClassifier, self).__init__()
         self.dropout_p = 0.1
         self.en_att = en_att
         self.att_name = att_name
+        self.masked_pool = masked_pool
+        self.concurrent_branches = concurrent_branches
         
         # Conv Encoder module
         self.audio_conv = Conv1dEncoder(
@@ -42,7 +50,7 @@ class MMActionClassifier(nn.Module):
         )
         
         # RNN module
-        self.audio_rnn = nn.GRU(
+        self.audio_rnn = SequenceEncoder(
             input_size=n_filters*4, 
             hidden_size=d_hid,
             num_layers=1, 
@@ -51,7 +59,7 @@ class MMActionClassifier(nn.Module):
             bidirectional=False
         )
 
-        self.video_rnn = nn.GRU(
+        self.video_rnn = SequenceEncoder(
             input_size=video_input_dim, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -137,39 +145,13 @@ class MMActionClassifier(nn.Module):
         len_a, 
         len_v
     ):
-        # 1. Conv forward
-        x_audio = self.audio_conv(x_audio)
-        
-        # 2. Rnn forward
+        # 1. Conv and Rnn forward of each modality
         # max pooling, time dim reduce by 8 times
         len_a = len_a//8
-        if len_a[0] != 0:
-            x_audio = pack_padded_sequence(
-                x_audio, 
-                len_a.cpu().numpy(), 
-                batch_first=True, 
-                enforce_sorted=False
-            )
-        if len_v[0] != 0:
-            x_video = pack_padded_sequence(
-                x_video, 
-                len_v.cpu().numpy(), 
-                batch_first=True, 
-                enforce_sorted=False
-            )
-
-        x_audio, _ = self.audio_rnn(x_audio) 
-        x_video, _ = self.video_rnn(x_video) 
-        if len_a[0] != 0:
-            x_audio, _ = pad_packed_sequence(   
-                x_audio, 
-                batch_first=True
-            )
-        if len_v[0] != 0:
-            x_video, _ = pad_packed_sequence(
-                x_video, 
-                batch_first=True
-            )
+        (x_audio, _), (x_video, _) = run_branches([
+            lambda: self.audio_rnn(self.audio_conv(x_audio), len_a),
+            lambda: self.video_rnn(x_video, len_v)
+        ], concurrent=self.concurrent_branches)
 
         # 3. Attention
         if self.en_att:
@@ -177,8 +159,8 @@ class MMActionClassifier(nn.Module):
                 x_audio, _ = self.audio_att(x_audio, x_audio, x_audio)
                 x_video, _ = self.video_att(x_video, x_video, x_video)
                 # 4. Average pooling
-                x_audio = torch.mean(x_audio, axis=1)
-                x_video = torch.mean(x_video, axis=1)
+                x_audio = temporal_pool(x_audio, len_a, self.masked_pool)
+                x_video = temporal_pool(x_video, len_v, self.masked_pool)
             elif self.att_name == 'additive':
                 # get attention output
                 x_audio = self.audio_att(x_audio, x_audio, x_audio, len_a)
@@ -194,8 +176,8 @@ class MMActionClassifier(nn.Module):
                 x_video = self.video_att(x_video, len_v)
         else:
             # 4. Average pooling
-            x_audio = torch.mean(x_audio, axis=1)
-            x_video = torch.mean(x_video, axis=1)
+            x_audio = temporal_pool(x_audio, len_a, self.masked_pool)
+            x_video = temporal_pool(x_video, len_v, self.masked_pool)
             x_mm = torch.cat((x_audio, x_video), dim=1)
 
         # 5. Projection with no attention
@@ -218,12 +200,16 @@ class SERClassifier(nn.Module):
         n_filters: int=32,      # number of filters
         en_att: bool=False,     # Enable self attention or not
         att_name: str='',       # Attention Name
-        d_head: int=6           # Head dim
+        d_head: int=6,          # Head dim
+        masked_pool: bool=False, # Average over valid timesteps only
+        concurrent_branches: bool=False # Run the modality encoders concurrently
     ):
         super(SERClassifier, self).__init__()
         self.dropout_p = 0.1
         self.en_att = en_att
         self.att_name = att_name
+        self.masked_pool = masked_pool
+        self.concurrent_branches = concurrent_branches
         
         # Conv Encoder module
         self.audio_conv = Conv1dEncoder(
@@ -233,7 +219,7 @@ class SERClassifier(nn.Module):
         )
         
         # RNN module
-        self.audio_rnn = nn.GRU(
+        self.audio_rnn = SequenceEncoder(
             input_size=n_filters*4, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -242,7 +228,7 @@ class SERClassifier(nn.Module):
             bidirectional=False
         )
 
-        self.text_rnn = nn.GRU(
+        self.text_rnn = SequenceEncoder(
             input_size=text_input_dim, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -308,40 +294,14 @@ class SERClassifier(nn.Module):
                 m.bias.data.fill_(0.01)
 
     def forward(self, x_audio, x_text, len_a, len_t):
-        # 1. Conv forward
-        x_audio = self.audio_conv(x_audio)
-        
-        # 2. Rnn forward
+        # 1. Conv and Rnn forward of each modality
         # max pooling, time dim reduce by 8 times
         len_a = len_a//8
         len_a[len_a==0] = 1
-        if len_a[0] != 0:
-            x_audio = pack_padded_sequence(
-                x_audio, 
-                len_a.cpu().numpy(), 
-                batch_first=True, 
-                enforce_sorted=False
-            )
-        if len_t[0] != 0:
-            x_text = pack_padded_sequence(
-                x_text, 
-                len_t.cpu().numpy(), 
-                batch_first=True, 
-                enforce_sorted=False
-            )
-
-        x_audio, _ = self.audio_rnn(x_audio) 
-        x_text, _ = self.text_rnn(x_text)
-        if len_a[0] != 0:
-            x_audio, _ = pad_packed_sequence(   
-                x_audio,
-                batch_first=True
-            )
-        if len_t[0] != 0:
-            x_text, _ = pad_packed_sequence(
-                x_text,
-                batch_first=True
-            )
+        (x_audio, _), (x_text, _) = run_branches([
+            lambda: self.audio_rnn(self.audio_conv(x_audio), len_a),
+            lambda: self.text_rnn(x_text, len_t)
+        ], concurrent=self.concurrent_branches)
         
         # 3. Attention
         if self.en_att:
@@ -349,8 +309,8 @@ class SERClassifier(nn.Module):
                 x_audio, _ = self.audio_att(x_audio, x_audio, x_audio)
                 x_text, _ = self.text_att(x_text, x_text, x_text)
                 # 4. Average pooling
-                x_audio = torch.mean(x_audio, axis=1)
-                x_text = torch.mean(x_text, axis=1)
+                x_audio = temporal_pool(x_audio, len_a, self.masked_pool)
+                x_text = temporal_pool(x_text, len_t, self.masked_pool)
             elif self.att_name == 'base':
                 # get attention output
                 x_audio = self.audio_att(x_audio)
@@ -362,8 +322,8 @@ class SERClassifier(nn.Module):
                 x_mm = self.fuse_att(x_mm, len_a, len_t, a_max_len)
         else:
             # 4. Average pooling Projection
-            x_audio = torch.mean(x_audio, axis=1)
-            x_text = torch.mean(x_text, axis=1)
+            x_audio = temporal_pool(x_audio, len_a, self.masked_pool)
+            x_text = temporal_pool(x_text, len_t, self.masked_pool)
             x_mm = torch.cat((x_audio, x_text), dim=1)
         
         # 5. Projection
@@ -386,23 +346,27 @@ class ImageTextClassifier(nn.Module):
         d_hid: int=64,          # Hidden Layer size
         en_att: bool=False,     # Enable self attention or not
         att_name: str='',       # Attention Name
-        d_head: int=6           # Head dim
+        d_head: int=6,          # Head dim
+        masked_pool: bool=False, # Average over valid timesteps only
+        concurrent_branches: bool=False # Run the modality encoders concurrently
     ):
         super(ImageTextClassifier, self).__init__()
         self.dropout_p = 0.1
         self.en_att = en_att
         self.att_name = att_name
+        self.masked_pool = masked_pool
+        self.concurrent_branches = concurrent_branches
         
         # Projection head
         self.img_proj = nn.Sequential(
             nn.Linear(img_input_dim, d_hid),
             nn.ReLU(),
-            nn.Dropout(self.dropout_p),
+            BranchDropout(self.dropout_p),
             nn.Linear(d_hid, d_hid)
         )
             
         # RNN module
-        self.text_rnn = nn.GRU(
+        self.text_rnn = SequenceEncoder(
             input_size=text_input_dim, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -447,20 +411,11 @@ class ImageTextClassifier(nn.Module):
                 m.bias.data.fill_(0.01)
 
     def forward(self, x_img, x_text, len_i, len_t):
-        # 1. img proj
-        x_img = self.img_proj(x_img[:, 0, :])
-        
-        # 2. Rnn forward
-        if len_t[0] != 0:
-            x_text = pack_padded_sequence(
-                x_text, 
-                len_t.cpu().numpy(), 
-                batch_first=True, 
-                enforce_sorted=False
-            )
-        x_text, _ = self.text_rnn(x_text)
-        if len_t[0] != 0:
-            x_text, _ = pad_packed_sequence(x_text, batch_first=True)
+        # 1. img proj and text Rnn forward
+        x_img, (x_text, _) = run_branches([
+            lambda: self.img_proj(x_img[:, 0, :]),
+            lambda: self.text_rnn(x_text, len_t)
+        ], concurrent=self.concurrent_branches)
         
         # 3. Attention
         if self.en_att:
@@ -470,7 +425,7 @@ class ImageTextClassifier(nn.Module):
                 x_mm = self.fuse_att(x_mm, len_i, len_t, 1)
         else:
             # 4. Average pooling
-            x_text = torch.mean(x_text, axis=1)
+            x_text = temporal_pool(x_text, len_t, self.masked_pool)
             x_mm = torch.cat((x_img, x_text), dim=1)
             
         # 4. MM embedding and predict
@@ -487,12 +442,16 @@ class HARClassifier(nn.Module):
         n_filters: int=32,      # number of filters
         en_att: bool=False,     # Enable self attention or not
         att_name: str='',       # Attention Name
-        d_head: int=6           # Head dim
+        d_head: int=6,          # Head dim
+        masked_pool: bool=False, # Average over valid timesteps only
+        concurrent_branches: bool=False # Run the modality encoders concurrently
     ):
         super(HARClassifier, self).__init__()
         self.dropout_p = 0.1
         self.en_att = en_att
         self.att_name = att_name
+        self.masked_pool = masked_pool
+        self.concurrent_branches = concurrent_branches
         
         # Conv Encoder module
         self.acc_conv = Conv1dEncoder(
@@ -508,7 +467,7 @@ class HARClassifier(nn.Module):
         )
         
         # RNN module
-        self.acc_rnn = nn.GRU(
+        self.acc_rnn = SequenceEncoder(
             input_size=n_filters*4, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -517,7 +476,7 @@ class HARClassifier(nn.Module):
             bidirectional=False
         )
 
-        self.gyro_rnn = nn.GRU(
+        self.gyro_rnn = SequenceEncoder(
             input_size=n_filters*4, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -581,16 +540,17 @@ class HARClassifier(nn.Module):
                 m.bias.data.fill_(0.01)
 
     def forward(self, x_acc, x_gyro, l_a, l_b):
-        # 1. Conv forward
-        x_acc = self.acc_conv(x_acc)
-        x_gyro = self.gyro_conv(x_gyro)
-        # 2. Rnn forward
-        x_acc, _ = self.acc_rnn(x_acc)
-        x_gyro, _ = self.gyro_rnn(x_gyro)
-
         # Length of the signal
         l_a = l_a // 8
         l_b = l_b // 8
+        # padded steps are zeroed only for masked pooling, as the GRU ran unpacked before
+        rnn_l_a, rnn_l_b = (l_a, l_b) if self.masked_pool else (None, None)
+
+        # 1. Conv and Rnn forward of each modality
+        (x_acc, _), (x_gyro, _) = run_branches([
+            lambda: self.acc_rnn(self.acc_conv(x_acc), rnn_l_a),
+            lambda: self.gyro_rnn(self.gyro_conv(x_gyro), rnn_l_b)
+        ], concurrent=self.concurrent_branches)
         
         # 3. Attention
         if self.en_att:
@@ -598,8 +558,8 @@ class HARClassifier(nn.Module):
                 x_acc, _ = self.acc_att(x_acc, x_acc, x_acc)
                 x_gyro, _ = self.gyro_att(x_gyro, x_gyro, x_gyro)
                 # 4. Average pooling
-                x_acc = torch.mean(x_acc, axis=1)
-                x_gyro = torch.mean(x_gyro, axis=1)
+                x_acc = temporal_pool(x_acc, l_a, self.masked_pool)
+                x_gyro = temporal_pool(x_gyro, l_b, self.masked_pool)
             elif self.att_name == 'base':
                 # get attention output
                 x_acc = self.acc_att(x_acc)
@@ -615,8 +575,8 @@ class HARClassifier(nn.Module):
                 )
         else:
             # 4. Average pooling
-            x_acc = torch.mean(x_acc, axis=1)
-            x_gyro = torch.mean(x_gyro, axis=1)
+            x_acc = temporal_pool(x_acc, l_a, self.masked_pool)
+            x_gyro = temporal_pool(x_gyro, l_b, self.masked_pool)
             x_mm = torch.cat((x_acc, x_gyro), dim=1)
 
         # 5. Projection
@@ -640,12 +600,16 @@ class ECGClassifier(nn.Module):
         n_filters: int=32,          # number of filters
         en_att: bool=False,         # Enable self attention or not
         att_name: str='',       # Attention Name
-        d_head: int=6           # Head dim
+        d_head: int=6,          # Head dim
+        masked_pool: bool=False, # Average over valid timesteps only
+        concurrent_branches: bool=False # Run the modality encoders concurrently
     ):
         super(ECGClassifier, self).__init__()
         self.dropout_p = 0.1
         self.en_att = en_att
         self.att_name = att_name
+        self.masked_pool = masked_pool
+        self.concurrent_branches = concurrent_branches
         
         # Conv Encoder module
         self.i_to_avf_conv = Conv1dEncoder(
@@ -661,7 +625,7 @@ class ECGClassifier(nn.Module):
         )
         
         # RNN module
-        self.i_to_avf_rnn = nn.GRU(
+        self.i_to_avf_rnn = SequenceEncoder(
             input_size=n_filters*4, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -670,7 +634,7 @@ class ECGClassifier(nn.Module):
             bidirectional=False
         )
 
-        self.v1_to_v6_rnn = nn.GRU(
+        self.v1_to_v6_rnn = SequenceEncoder(
             input_size=n_filters*4, 
             hidden_size=d_hid, 
             num_layers=1, 
@@ -715,16 +679,16 @@ class ECGClassifier(nn.Module):
                 m.bias.data.fill_(0.01)
 
     def forward(self, x_i_to_avf, x_v1_to_v6, l_a, l_b):
-        # 1. Conv forward
-        x_i_to_avf = self.i_to_avf_conv(x_i_to_avf)
-        x_v1_to_v6 = self.v1_to_v6_conv(x_v1_to_v6)
-
         l_a = l_a // 8
         l_b = l_b // 8
+        # padded steps are zeroed only for masked pooling, as the GRU ran unpacked before
+        rnn_l_a, rnn_l_b = (l_a, l_b) if self.masked_pool else (None, None)
         
-        # 2. Rnn forward
-        x_i_to_avf, _ = self.i_to_avf_rnn(x_i_to_avf)
-        x_v1_to_v6, _ = self.v1_to_v6_rnn(x_v1_to_v6)
+        # 1. Conv and Rnn forward of each modality
+        (x_i_to_avf, _), (x_v1_to_v6, _) = run_branches([
+            lambda: self.i_to_avf_rnn(self.i_to_avf_conv(x_i_to_avf), rnn_l_a),
+            lambda: self.v1_to_v6_rnn(self.v1_to_v6_conv(x_v1_to_v6), rnn_l_b)
+        ], concurrent=self.concurrent_branches)
         # 3. Attention
         if self.en_att:
             # get attention output
@@ -737,14 +701,156 @@ class ECGClassifier(nn.Module):
             )
         else:
             # 4. Average pooling
-            x_i_to_avf = torch.mean(x_i_to_avf, axis=1)
-            x_v1_to_v6 = torch.mean(x_v1_to_v6, axis=1)
+            x_i_to_avf = temporal_pool(x_i_to_avf, l_a, self.masked_pool)
+            x_v1_to_v6 = temporal_pool(x_v1_to_v6, l_b, self.masked_pool)
             # 6. MM embedding and predict
             x_mm = torch.cat((x_i_to_avf, x_v1_to_v6), dim=1)
         preds = self.classifier(x_mm)
         return preds, x_mm
 
 
+# worker thread of the concurrent modality branches, created on first use
+_branch_pool = None
+# seed and generators of the branch running on a thread, see run_branches
+_branch_rng = threading.local()
+
+
+def _reset_branch_pool():
+    # A forked child does not inherit the worker thread
+    global _branch_pool
+    _branch_pool = None
+
+
+os.register_at_fork(after_in_child=_reset_branch_pool)
+
+
+def run_branches(branches: list, concurrent: bool=False):
+    """
+    Run the encoder branches of a multimodal model and return their outputs in order.
+
+    Concurrently, every branch but the last runs on a worker thread while
+    the calling thread runs the last one; torch ops release the GIL, so on
+    cpu the two encoders share the cores instead of running one after the
+    other. Grad, inference and autocast modes are thread local and are
+    carried over to the worker. The global generator is shared by the
+    threads, so the caller draws one seed per branch from it and every
+    branch runs with generators of its own, seeded with it, which the
+    BranchDropout layers of the branch draw from; the dropout masks do not
+    depend on thread timing. Inside torch.func transforms the branches
+    always run sequentially.
+    :param branches: functions without arguments, one per modality
+    :param concurrent: run the branches concurrently
+    :return: list of branch outputs
+    """
+    if not concurrent or len(branches) < 2:
+        return [branch() for branch in branches]
+    if getattr(torch._C, '_are_functorch_transforms_active', lambda: False)():
+        return [branch() for branch in branches]
+    global _branch_pool
+    if _branch_pool is None:
+        _branch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='modality_branch')
+    state = (
+        torch.is_grad_enabled(),
+        torch.is_inference_mode_enabled(),
+        torch.is_autocast_cpu_enabled(),
+        torch.get_autocast_cpu_dtype(),
+        torch.is_autocast_enabled(),
+        torch.get_autocast_gpu_dtype()
+    )
+    seeds = torch.randint(0, 2**62, (len(branches),)).tolist()
+    futures = [
+        _branch_pool.submit(_run_branch, branch, state, seed)
+        for branch, seed in zip(branches[:-1], seeds[:-1])
+    ]
+    with _branch_seed(seeds[-1]):
+        last_output = branches[-1]()
+    return [future.result() for future in futures] + [last_output]
+
+
+# torch.compile traces the branches, not the runner, whose lambdas are new on every call
+if hasattr(torch, '_dynamo'):
+    run_branches = torch._dynamo.disable(run_branches, recursive=False)
+
+
+def _run_branch(branch, state, seed):
+    # Run a branch on the worker thread under the thread local modes of the caller
+    grad_enabled, inference, cpu_autocast, cpu_dtype, gpu_autocast, gpu_dtype = state
+    with torch.inference_mode(inference), torch.set_grad_enabled(grad_enabled), \
+        torch.autocast('cpu', dtype=cpu_dtype, enabled=cpu_autocast), \
+        torch.autocast('cuda', dtype=gpu_dtype, enabled=gpu_autocast), \
+        _branch_seed(seed):
+        return branch()
+
+
+@contextmanager
+def _branch_seed(seed: int):
+    # Seed the branch generators of this thread, one per device, created on first use
+    _branch_rng.seed, _branch_rng.generators = seed, dict()
+    try:
+        yield
+    finally:
+        _branch_rng.seed, _branch_rng.generators = None, None
+
+
+class BranchDropout(nn.Dropout):
+    """
+    Dropout that draws its mask from the generator of the running branch.
+
+    Outside concurrent branches, or in eval mode, it is nn.Dropout; inside
+    them the mask comes from the generator that run_branches seeded for the
+    branch on this thread.
+    """
+    def forward(self, x: Tensor):
+        seed = getattr(_branch_rng, 'seed', None)
+        if seed is None or not self.training or self.p in [0, 1]:
+            return super().forward(x)
+        generator = _branch_rng.generators.get(x.device)
+        if generator is None:
+            generator = _branch_rng.generators[x.device] = torch.Generator(x.device)
+            generator.manual_seed(seed)
+        mask = torch.empty_like(x).bernoulli_(1 - self.p, generator=generator)
+        return x * mask / (1 - self.p)
+
+
+class SequenceEncoder(nn.GRU):
+    """
+    GRU over padded batches that keeps the lengths on device.
+
+    The unidirectional GRU runs over the whole padded batch, so its outputs
+    on the valid timesteps are the ones of a packed sequence; the padded
+    timesteps are then zeroed with a mask built on device, which matches
+    pad_packed_sequence without moving the lengths to the host or repacking.
+    Batches without padding skip the mask when their lengths are on cpu,
+    except inside torch.func transforms.
+    The parameters, and so the state dict keys, are the ones of nn.GRU.
+    """
+    def forward(
+        self, 
+        x: Tensor, 
+        lengths: Tensor=None
+    ):
+        """
+        :param x: padded batch, batch first
+        :param lengths: valid timesteps of every sample, None for no padding
+        :return: outputs with zeroed padding, hidden state after the padded batch
+        """
+        output, hidden = super().forward(x)
+        if lengths is None: return output, hidden
+        # the check reads the lengths, which torch.func transforms do not allow
+        functorch_active = getattr(torch._C, '_are_functorch_transforms_active', lambda: False)()
+        if lengths.device.type == 'cpu' and not functorch_active and bool((lengths >= output.shape[1]).all()):
+            return output, hidden
+        mask = sequence_mask(lengths, output.shape[1], device=output.device)
+        return output * mask.unsqueeze(-1).to(output.dtype), hidden
+
+
+def temporal_pool(x, lengths, masked: bool=False):
+    """Average (batch, time, dim) over time, only over the valid timesteps when masked."""
+    if not masked: return torch.mean(x, axis=1)
+    mask = sequence_mask(lengths, x.shape[1], device=x.device).unsqueeze(-1).to(x.dtype)
+    return (x * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
 class Conv1dEncoder(nn.Module):
     def __init__(
         self,
@@ -759,7 +865,7 @@ class Conv1dEncoder(nn.Module):
         self.conv3 = nn.Conv1d(n_filters*2, n_filters*4, kernel_size=5, padding=2)
         self.relu = nn.ReLU()
         self.pooling = nn.MaxPool1d(kernel_size=2, stride=2)
-        self.dropout = nn.Dropout(dropout)
+        self.dropout = BranchDropout(dropout)
         
     def forward(
             self,
@@ -786,22 +892,24 @@ class Conv1dEncoder(nn.Module):
         return x
     
     
+def sequence_mask(valid_lens, max_len: int, device=None):
+    """Return a (..., max_len) bool mask, True on the first valid_lens positions."""
+    valid_lens = torch.as_tensor(valid_lens, device=device)
+    return torch.arange(max_len, device=valid_lens.device) < valid_lens.unsqueeze(-1)
+
+
 def masked_softmax(X, valid_lens):
     """Perform softmax operation by masking elements on the last axis."""
-    # `X`: 3D tensor, `valid_lens`: 1D or 2D tensor
+    # `X`: 2D or 3D tensor, `valid_lens`: lengths over the leading axes of X
     if valid_lens is None:
         return nn.functional.softmax(X, dim=-1)
     else:
-        shape = X.shape
-        if valid_lens.dim() == 1:
-            valid_lens = torch.repeat_interleave(valid_lens, shape[1])
-        else:
-            valid_lens = valid_lens.reshape(-1)
+        mask = sequence_mask(valid_lens, X.shape[-1], device=X.device)
+        # 1D lengths of a 3D X are shared by its middle axis
+        mask = mask.reshape(mask.shape[:-1] + (1,) * (X.dim() - mask.dim()) + mask.shape[-1:])
         # On the last axis, replace masked elements with a very large negative
         # value, whose exponentiation outputs 0
-        X = d2l.sequence_mask(X.reshape(-1, shape[-1]), valid_lens,
-                              value=-1e6)
-        return nn.functional.softmax(X.reshape(shape), dim=-1)
+        return nn.functional.softmax(X.masked_fill(~mask, -1e6), dim=-1)
     
 
 class AdditiveAttention(nn.Module):
@@ -827,7 +935,7 @@ class AdditiveAttention(nn.Module):
     ):
         score = self.score_proj(torch.tanh(self.key_proj(key) + self.query_proj(query) + self.bias)).squeeze(-1)
         # attn = F.softmax(score, dim=-1)
-        attn = masked_softmax(scores, valid_lens)
+        attn = masked_softmax(score, valid_lens)
         attn = self.dropout(attn)
         output = torch.bmm(attn.unsqueeze(1), value)
         return output
@@ -919,8 +1027,7 @@ class BaseSelfAttention(nn.Module):
         att = self.att_pool(self.att_fc1(x))
         att = self.att_fc2(att).squeeze(-1)
         if val_l is not None:
-            for idx in range(len(val_l)):
-                att[idx, val_l[idx]:] = -1e6
+            att = att.masked_fill(~sequence_mask(val_l, att.shape[-1], device=att.device), -1e6)
         att = torch.softmax(att, dim=1)
         x = (att.unsqueeze(2) * x).sum(axis=1)
         return x
@@ -952,9 +1059,12 @@ class FuseBaseSelfAttention(nn.Module):
         att = self.att_fc2(att)
         att = att.transpose(1, 2)
         if val_a is not None:
-            for idx in range(len(val_a)):
-                att[idx, :, val_a[idx]:a_len] = -1e5
-                att[idx, :, a_len+val_b[idx]:] = -1e5
+            # the first a_len positions hold modality a, the rest modality b
+            pos = torch.arange(att.shape[-1], device=att.device)
+            val_a = torch.as_tensor(val_a, device=att.device).unsqueeze(-1)
+            val_b = torch.as_tensor(val_b, device=att.device).unsqueeze(-1)
+            valid = torch.where(pos < a_len, pos < val_a, pos < a_len + val_b)
+            att = att.masked_fill(~valid.unsqueeze(1), -1e5)
         att = torch.softmax(att, dim=2)
         # x = torch.matmul(att, x).mean(axis=1)
         x = torch.matmul(att, x)
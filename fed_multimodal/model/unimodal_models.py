@@ -392,22 +392,24 @@ class Conv1dEncoder(nn.Module):
         return x
     
     
+def sequence_mask(valid_lens, max_len: int, device=None):
+    """Return a (..., max_len) bool mask, True on the first valid_lens positions."""
+    valid_lens = torch.as_tensor(valid_lens, device=device)
+    return torch.arange(max_len, device=valid_lens.device) < valid_lens.unsqueeze(-1)
+
+
 def masked_softmax(X, valid_lens):
     """Perform softmax operation by masking elements on the last axis."""
-    # `X`: 3D tensor, `valid_lens`: 1D or 2D tensor
+    # `X`: 2D or 3D tensor, `valid_lens`: lengths over the leading axes of X
     if valid_lens is None:
         return nn.functional.softmax(X, dim=-1)
     else:
-        shape = X.shape
-        if valid_lens.dim() == 1:
-            valid_lens = torch.repeat_interleave(valid_lens, shape[1])
-        else:
-            valid_lens = valid_lens.reshape(-1)
+        mask = sequence_mask(valid_lens, X.shape[-1], device=X.device)
+        # 1D lengths of a 3D X are shared by its middle axis
+        mask = mask.reshape(mask.shape[:-1] + (1,) * (X.dim() - mask.dim()) + mask.shape[-1:])
         # On the last axis, replace masked elements with a very large negative
         # value, whose exponentiation outputs 0
-        X = d2l.sequence_mask(X.reshape(-1, shape[-1]), valid_lens,
-                              value=-1e6)
-        return nn.functional.softmax(X.reshape(shape), dim=-1)
+        return nn.functional.softmax(X.masked_fill(~mask, -1e6), dim=-1)
     
 
 class AdditiveAttention(nn.Module):
@@ -433,7 +435,7 @@ class AdditiveAttention(nn.Module):
     ):
         score = self.score_proj(torch.tanh(self.key_proj(key) + self.query_proj(query) + self.bias)).squeeze(-1)
         # attn = F.softmax(score, dim=-1)
-        attn = masked_softmax(scores, valid_lens)
+        attn = masked_softmax(score, valid_lens)
         attn = self.dropout(attn)
         output = torch.bmm(attn.unsqueeze(1), value)
         return output
@@ -531,8 +533,9 @@ class BaseSelfAttention(nn.Module):
         att = att.transpose(1, 2)
         
         if val_l is not None:
-            for idx in range(len(val_l)):
-                att[idx, val_l[idx]:] = -1e6
+            # mask the padded frames of every head
+            valid = sequence_mask(val_l, att.shape[-1], device=att.device)
+            att = att.masked_fill(~valid.unsqueeze(1), -1e6)
 
         att = torch.softmax(att, dim=2)
         x = torch.matmul(att, x)
@@ -565,9 +568,12 @@ class FuseBaseSelfAttention(nn.Module):
         att = self.att_fc2(att)
         att = att.transpose(1, 2)
         if val_a is not None:
-            for idx in range(len(val_a)):
-                att[idx, :, val_a[idx]:a_len] = -1e5
-                att[idx, :, a_len+val_b[idx]:] = -1e5
+            # the first a_len positions hold modality a, the rest modality b
+            pos = torch.arange(att.shape[-1], device=att.device)
+            val_a = torch.as_tensor(val_a, device=att.device).unsqueeze(-1)
+            val_b = torch.as_tensor(val_b, device=att.device).unsqueeze(-1)
+            valid = torch.where(pos < a_len, pos < val_a, pos < a_len + val_b)
+            att = att.masked_fill(~valid.unsqueeze(1), -1e5)
         att = torch.softmax(att, dim=2)
         # x = torch.matmul(att, x).mean(axis=1)
         x = torch.matmul(att, x)
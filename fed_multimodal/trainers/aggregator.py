@@ -0,0 +1,70 @@
+import torch
+
+from .flat_buffer import StateDictFlattener
+
+
+class StreamingAggregator(object):
+    """
+    Running weighted sum of client updates in one flat fp32 buffer.
+
+    Updates are added as soon as a client finishes, so the memory does not
+    grow with the number of clients in a round.
+    """
+    def __init__(
+        self,
+        state_dict: dict
+    ):
+        self.flattener = StateDictFlattener(state_dict)
+        self.device = next(iter(state_dict.values())).device
+        self.sum_buf = torch.zeros(self.flattener.numel, device=self.device)
+        self.reset()
+
+    def reset(self):
+        # Start a new round
+        self.sum_buf.zero_()
+        self.total_weight = 0.0
+        self.num_updates = 0
+
+    def add(
+        self,
+        update,
+        weight: float=1.0
+    ):
+        """
+        Add one weighted client update to the running sum.
+        :param update: state_dict, or the update as a flat tensor
+        :param weight: aggregation weight of the update
+        """
+        with torch.no_grad():
+            if isinstance(update, dict):
+                offsets = self.flattener.offsets
+                for idx, key in enumerate(self.flattener.keys):
+                    self.sum_buf[offsets[idx]:offsets[idx+1]].add_(
+                        update[key].detach().reshape(-1).to(self.device),
+                        alpha=weight
+                    )
+            else:
+                self.sum_buf.add_(update.to(self.device), alpha=weight)
+        self.total_weight += weight
+        self.num_updates += 1
+
+    def add_payload(
+        self,
+        codec,
+        payload: dict,
+        weight: float=1.0
+    ):
+        """
+        Decode one weighted client payload straight into the running sum.
+        :param codec: update codec that encoded the payload
+        :param payload: encoded client delta
+        :param weight: aggregation weight of the update
+        """
+        with torch.no_grad():
+            codec.decode_add(payload, self.sum_buf, weight)
+        self.total_weight += weight
+        self.num_updates += 1
+
+    def average(self):
+        # Return the weighted average as a flat tensor
+        return self.sum_buf / self.total_weight
@@ -0,0 +1,104 @@
+import copy
+import torch
+import torch.nn.functional as F
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+class CompiledForward(object):
+    """
+    Forward of a model run through torch.compile, with an eager fallback.
+
+    The wrapper replaces model.forward, so the training step of every client
+    and the dev/test inference go through the compiled graph, and the
+    backward is compiled with it. Weights are swapped in place by
+    load_state_dict, so a pooled model is compiled once and reused by every
+    client it trains. Copies of the model (the model pool, the stacked
+    trainer) get their own wrapper and compile on first use; forked workers
+    compile in their own process.
+
+    Shapes that change between batches are handled by the automatic dynamic
+    shapes of torch.compile. With bucket > 0 the time axis of every padded
+    sequence input is padded up to a multiple of bucket, which bounds the
+    number of distinct shapes. The extra frames are padding: length-masked
+    attention and masked pooling skip them, but plain mean pooling averages
+    them and the conv encoders read them next to the last valid frames, so
+    outputs move slightly, as with any other padding. Under torch.func
+    transforms, or once compilation failed, the eager forward runs.
+    """
+    def __init__(
+        self,
+        eager_forward,
+        mode: str='default',
+        bucket: int=0
+    ):
+        self.eager_forward = eager_forward
+        self.mode = mode
+        self.bucket = bucket
+        self.compiled_forward = torch.compile(eager_forward, mode=mode)
+        self.failed = False
+
+    def __call__(self, *inputs, **kwargs):
+        functorch_active = getattr(torch._C, '_are_functorch_transforms_active', lambda: False)()
+        if self.failed or functorch_active:
+            return self.eager_forward(*inputs, **kwargs)
+        if self.bucket > 0:
+            inputs = [pad_to_bucket(value, self.bucket) for value in inputs]
+        try:
+            return self.compiled_forward(*inputs, **kwargs)
+        except torch._dynamo.exc.TorchDynamoException as error:
+            logging.warning(f'Compiling {type(self.eager_forward.__self__).__name__} failed, run eagerly: {error}')
+            self.failed = True
+            return self.eager_forward(*inputs, **kwargs)
+
+    def __deepcopy__(self, memo):
+        # The copied forward is bound to the copied model, it compiles on its first call
+        return CompiledForward(
+            copy.deepcopy(self.eager_forward, memo),
+            mode=self.mode,
+            bucket=self.bucket
+        )
+
+
+def pad_to_bucket(
+    value,
+    bucket: int
+):
+    # Pad the time axis of a (batch, time, feature) float tensor to a multiple of bucket
+    if not torch.is_tensor(value) or value.dim() != 3 or not value.is_floating_point():
+        return value
+    pad_len = -value.shape[1] % bucket
+    if pad_len == 0: return value
+    return F.pad(value, (0, 0, 0, pad_len))
+
+
+def compile_model(
+    args,
+    model
+):
+    """
+    Compile the forward of model in place when args.compile is set.
+    :param args: arguments, compile, compile_mode and compile_bucket
+    :param model: global model, before the client models are copied from it
+    :return: model
+    """
+    if not getattr(args, 'compile', False): return model
+    if not hasattr(torch, 'compile'):
+        logging.info('torch.compile needs torch 2.0, run eagerly')
+        return model
+    if getattr(model, 'concurrent_branches', False):
+        # the worker thread would run the branches outside the compiled graph
+        logging.info('Compiled execution runs the modality branches sequentially')
+        model.concurrent_branches = False
+    model.forward = CompiledForward(
+        model.forward,
+        mode=getattr(args, 'compile_mode', 'default'),
+        bucket=getattr(args, 'compile_bucket', 0)
+    )
+    return model
@@ -0,0 +1,123 @@
+import torch
+import tempfile
+import numpy as np
+
+from collections import OrderedDict
+
+from .flat_buffer import StateDictFlattener
+
+
+class ControlVariateStore(object):
+    """
+    Per-client SCAFFOLD control variates, stored as compact flat vectors.
+
+    A client control is created on first use (all zeros until the client
+    first trains) and kept as one flat fp32 or fp16 vector. When hot_size is
+    set, only the hot_size most recently used controls stay in memory, the
+    others spill to a memory-mapped file that grows on demand and is removed
+    when the store is closed. Reads return fp32 state_dicts on cpu. SparseCodec
+    keeps its per-client error feedback residuals in a store as well.
+    """
+    def __init__(
+        self,
+        state_dict: dict,
+        dtype=torch.float32,
+        hot_size: int=0,
+        spill_dir: str=None
+    ):
+        self.flattener = StateDictFlattener(state_dict)
+        self.dtype = dtype
+        self.np_dtype = np.float16 if dtype == torch.float16 else np.float32
+        self.hot_size = hot_size
+        self.spill_dir = spill_dir
+        self.hot = OrderedDict()
+        self.slots = dict()
+        self.spill_file, self.spill, self.capacity = None, None, 0
+
+    def __contains__(self, client_id):
+        return client_id in self.hot or client_id in self.slots
+
+    def __len__(self):
+        return len(set(self.hot.keys()) | set(self.slots.keys()))
+
+    def __getitem__(self, client_id):
+        return self.flattener.unflatten(self.get_flat(client_id))
+
+    def __setitem__(self, client_id, control):
+        self.set(client_id, control)
+
+    def get_flat(
+        self,
+        client_id
+    ):
+        """
+        Return the control of a client as a flat fp32 tensor.
+        :param client_id: client id
+        :return: flat control, zeros if the client has not trained yet
+        """
+        if client_id in self.hot:
+            self.hot.move_to_end(client_id)
+            flat = self.hot[client_id]
+        elif client_id in self.slots:
+            flat = torch.from_numpy(np.array(self.spill[self.slots[client_id]]))
+            self.hot[client_id] = flat
+            self.evict()
+        else:
+            return torch.zeros(self.flattener.numel)
+        return flat if flat.dtype == torch.float32 else flat.float()
+
+    def set(
+        self,
+        client_id,
+        control
+    ):
+        """
+        Store the control of a client.
+        :param client_id: client id
+        :param control: control state_dict, or a flat tensor
+        """
+        if isinstance(control, dict):
+            flat = self.flattener.flatten(
+                {key: value.detach().cpu() for key, value in control.items()}
+            )
+        else:
+            flat = control.detach().cpu().float()
+        self.hot[client_id] = flat.to(self.dtype)
+        self.hot.move_to_end(client_id)
+        self.evict()
+
+    def evict(self):
+        # Write the least recently used controls to the spill file
+        if self.hot_size <= 0: return
+        while len(self.hot) > self.hot_size:
+            client_id, flat = self.hot.popitem(last=False)
+            if client_id not in self.slots:
+                self.slots[client_id] = len(self.slots)
+                self.reserve(len(self.slots))
+            self.spill[self.slots[client_id]] = flat.numpy()
+
+    def reserve(
+        self,
+        num_slots: int
+    ):
+        # Grow the spill file to hold num_slots controls
+        if num_slots <= self.capacity: return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        if self.spill is not None: self.spill.flush()
+        self.capacity = max(num_slots, 2 * self.capacity, 16)
+        row_bytes = self.flattener.numel * np.dtype(self.np_dtype).itemsize
+        self.spill_file.truncate(self.capacity * row_bytes)
+        self.spill = np.memmap(
+            self.spill_file,
+            dtype=self.np_dtype,
+            mode='r+',
+            shape=(self.capacity, self.flattener.numel)
+        )
+
+    def close(self):
+        # Drop the spill file
+        self.spill = None
+        if self.spill_file is not None: self.spill_file.close()
+        self.spill_file, self.capacity = None, 0
+        self.slots = dict()
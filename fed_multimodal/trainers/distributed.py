@@ -0,0 +1,52 @@
+import torch
+import torch.distributed as dist
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def init_distributed(args):
+    """
+    Join the gloo process group started by torchrun, once per process.
+    :param args: arguments, distributed
+    :return: rank, world_size
+    """
+    if not getattr(args, 'distributed', False):
+        return 0, 1
+    if not dist.is_initialized():
+        # rank, world size and master address come from the torchrun environment
+        dist.init_process_group(backend='gloo')
+        logging.info(f'Joined process group, rank {dist.get_rank()} of {dist.get_world_size()}')
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_main_rank():
+    # Rank 0 hosts the server; true outside distributed runs
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def shard_client_ids(
+    args,
+    client_ids: list
+):
+    """
+    Return the clients whose data this rank loads.
+
+    Rank 0 loads the dev and test sets, the training clients are dealt
+    round-robin over ranks 1 to world_size - 1.
+    :param args: arguments, distributed
+    :param client_ids: all client ids, with dev and test
+    :return: client ids of this rank
+    """
+    rank, world_size = init_distributed(args)
+    if world_size == 1:
+        return client_ids
+    if rank == 0:
+        return [client_id for client_id in client_ids if client_id in ['dev', 'test']]
+    train_client_ids = [client_id for client_id in client_ids if client_id not in ['dev', 'test']]
+    return train_client_ids[rank-1::world_size-1]
@@ -0,0 +1,82 @@
+import json
+import numpy as np
+
+from .aggregator import StreamingAggregator
+
+
+class EdgeAggregator(object):
+    """
+    Edge tier of a hierarchical topology: partial aggregate of its clients.
+
+    Client updates are added to the edge as they arrive, with the same
+    weights the server would use. At the end of the round the edge forwards
+    one combined update, the weighted average of its clients with their
+    summed weight, and the sum of their SCAFFOLD control deltas, so the
+    server aggregates one update per edge and gets the same average as
+    aggregating every client.
+    """
+    def __init__(
+        self,
+        state_dict: dict,
+        control_state_dict: dict=None
+    ):
+        self.aggregator = StreamingAggregator(state_dict)
+        self.control_aggregator = None
+        if control_state_dict is not None:
+            self.control_aggregator = StreamingAggregator(control_state_dict)
+
+    def forward(
+        self,
+        aggregator: StreamingAggregator,
+        control_aggregator: StreamingAggregator=None
+    ):
+        """
+        Forward the combined update to the server aggregators and start over.
+        :param aggregator: server aggregator of the model updates
+        :param control_aggregator: server aggregator of the control deltas
+        :return: True if the edge had client updates
+        """
+        if self.aggregator.num_updates == 0: return False
+        aggregator.add(self.aggregator.average(), self.aggregator.total_weight)
+        self.aggregator.reset()
+        if control_aggregator is not None:
+            control_aggregator.add(self.control_aggregator.sum_buf)
+            self.control_aggregator.reset()
+        return True
+
+
+def load_edge_map(
+    args,
+    client_ids: list
+):
+    """
+    Return the edge of every client, from args.edge_map or args.num_edges.
+
+    args.edge_map is a json file, either {edge: [client_id, ...]} or
+    {client_id: edge}, e.g. built from speaker or subject metadata; clients
+    it does not list report to the server directly. args.num_edges splits
+    the sorted client ids into contiguous groups.
+    :param args: arguments, edge_map and num_edges
+    :param client_ids: training client ids
+    :return: client_id to edge name, empty without edges
+    """
+    edge_map_path = getattr(args, 'edge_map', '')
+    num_edges = getattr(args, 'num_edges', 0)
+    if edge_map_path:
+        with open(edge_map_path, 'r') as f:
+            edge_map = json.load(f)
+        if all(isinstance(value, list) for value in edge_map.values()):
+            edge_map = {
+                str(client_id): str(edge) for edge, edge_client_ids in edge_map.items() for client_id in edge_client_ids
+            }
+        # json keys are strings
+        return {
+            client_id: edge_map[str(client_id)] for client_id in client_ids if str(client_id) in edge_map
+        }
+    if num_edges > 0:
+        groups = np.array_split(np.arange(len(client_ids)), min(num_edges, len(client_ids)))
+        sorted_ids = sorted(client_ids, key=str)
+        return {
+            sorted_ids[idx]: f'edge{edge_idx}' for edge_idx, group in enumerate(groups) for idx in group
+        }
+    return dict()
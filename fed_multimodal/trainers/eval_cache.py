@@ -0,0 +1,94 @@
+import torch
+import weakref
+import numpy as np
+
+from contextlib import contextmanager
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# collated eval sets per dataloader, shared by every server of the run
+_eval_sets = weakref.WeakKeyDictionary()
+
+
+class CachedEvalSet(object):
+    """
+    Dev or test set collated once into padded batches.
+
+    The samples are read and padded with the collate function of the
+    dataloader a single time, then every evaluation iterates over the same
+    cpu tensors. 'ordered' keeps the dataset order, so with the dataloader
+    batch size the batches are exactly the ones of the dataloader. 'sorted'
+    groups samples of similar length to cut padding; models that average
+    over padded frames then see less padding than with the dataloader.
+    """
+    def __init__(
+        self,
+        dataloader,
+        batch_size: int=64,
+        sort_by_length: bool=False
+    ):
+        dataset = dataloader.dataset
+        items = [dataset[idx] for idx in range(len(dataset))]
+        order = np.arange(len(items))
+        if sort_by_length:
+            # padded sequences are the leading tensors of a sample, label last
+            num_seqs = 2 if len(items[0]) == 5 else 1
+            order = sorted(order, key=lambda idx: tuple(items[idx][seq_idx].shape[0] for seq_idx in range(num_seqs)))
+        self.batches = [
+            dataloader.collate_fn([items[idx] for idx in order[start:start+batch_size]])
+            for start in range(0, len(items), batch_size)
+        ]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def build_eval_set(
+    args,
+    dataloader
+):
+    """
+    Return the cached eval set of a dev or test dataloader, selected by args.eval_cache.
+
+    The first call collates the set, later calls with the same dataloader, from
+    any round, fold or server, return the same batches.
+    :param args: arguments, eval_cache and eval_batch_size
+    :param dataloader: dev or test dataloader
+    :return: cached eval set, or the dataloader without caching
+    """
+    eval_cache = getattr(args, 'eval_cache', 'none')
+    if eval_cache == 'none': return dataloader
+    batch_size = getattr(args, 'eval_batch_size', 0) or dataloader.batch_size
+    key = (eval_cache, batch_size)
+    eval_sets = _eval_sets.setdefault(dataloader, dict())
+    if key not in eval_sets:
+        eval_sets[key] = CachedEvalSet(
+            dataloader,
+            batch_size=batch_size,
+            sort_by_length=eval_cache == 'sorted'
+        )
+        logging.info(f'Cached eval set, {len(dataloader.dataset)} samples in {len(eval_sets[key])} batches')
+    return eval_sets[key]
+
+
+@contextmanager
+def eval_threads(num_threads: int=0):
+    # Run the enclosed evaluation with num_threads torch threads, 0 keeps the current setting
+    if num_threads <= 0:
+        yield
+        return
+    prev_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(prev_threads)
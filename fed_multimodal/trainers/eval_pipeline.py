@@ -0,0 +1,170 @@
+import queue
+import torch
+import traceback
+import torch.multiprocessing as mp
+
+from .flat_buffer import StateDictFlattener
+from .distributed import is_main_rank
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+class EvalPipeline(object):
+    """
+    Evaluate the global model on dev and test in a background process.
+
+    After aggregation the global weights are copied into a shared snapshot
+    buffer and a forked worker, with its own thread budget, runs the dev and
+    test inference while the next round trains. At most one evaluation is in
+    flight: the next submit, or close, first waits for it, then logs its
+    metrics and runs log_epoch_result on the evaluated round with the
+    snapshot weights. Rounds are therefore logged in order, and the best
+    model is selected and saved exactly as with synchronous evaluation.
+    With lazy_test the worker skips the test set when dev does not beat
+    the best dev result known at submit time.
+    """
+    def __init__(
+        self,
+        server,
+        dataloader_dict: dict,
+        num_threads: int=1,
+        lazy_test: bool=False
+    ):
+        self.num_threads = num_threads
+        self.lazy_test = lazy_test
+        self.flattener = StateDictFlattener(server.global_model.state_dict())
+        self.snapshot_buf = self.flattener.zeros(shared=True)
+        self.pending = None
+
+        # fork the worker, it inherits the server and the dev and test sets; dev doubles as test without one
+        ctx = mp.get_context('fork')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.worker = ctx.Process(
+            target=_eval_worker,
+            args=(self, server, dataloader_dict['dev'], dataloader_dict.get('test')),
+            daemon=True
+        )
+        self.worker.start()
+
+    def submit(
+        self,
+        server,
+        metric: str='acc'
+    ):
+        """
+        Snapshot the global weights of the current round and start evaluating them.
+        :param server: server after average_weights
+        :param metric: dev metric for best model selection
+        """
+        self.collect(server)
+        self.flattener.flatten(server.get_parameters(), out=self.snapshot_buf)
+        # the test set is needed above this dev result, always before the first evaluation
+        best_dev = None
+        if self.lazy_test and len(server.best_test_dict) > 0: best_dev = server.best_dev_dict[metric]
+        self.task_queue.put((server.epoch, metric, best_dev))
+        self.pending = (server.epoch, metric)
+
+    def collect(self, server):
+        """
+        Wait for the evaluation in flight, log it and update the best model.
+        :param server: server owning the result dict
+        """
+        if self.pending is None: return
+        epoch, metric = self.pending
+        self.pending = None
+        while True:
+            try:
+                dev_result, test_result, error = self.result_queue.get(timeout=5)
+                break
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError('The evaluation worker exited unexpectedly')
+        if error is not None:
+            self.close()
+            raise RuntimeError(f'Evaluation of round {epoch} failed:\n{error}')
+
+        # log under the evaluated round, the server may be one round ahead
+        current_epoch = server.epoch
+        server.epoch = epoch
+        server.result_dict[epoch]['dev'] = dev_result
+        if test_result is not None: server.result_dict[epoch]['test'] = test_result
+        log_result = server.log_multilabel_result if server.multilabel else server.log_classification_result
+        logging.info('---------------------------------------------------------')
+        log_result(
+            data_split='dev',
+            metric=metric
+        )
+        if test_result is not None:
+            log_result(
+                data_split='test',
+                metric=metric
+            )
+        logging.info('---------------------------------------------------------')
+        server.log_epoch_result(
+            metric=metric,
+            model_state={key: value.clone() for key, value in self.flattener.unflatten(self.snapshot_buf).items()}
+        )
+        logging.info('---------------------------------------------------------')
+        server.epoch = current_epoch
+
+    def close(self, server=None):
+        # Log the last evaluation and stop the worker
+        if server is not None: self.collect(server)
+        if self.worker.is_alive(): self.task_queue.put(None)
+        self.worker.join(timeout=10)
+        if self.worker.is_alive(): self.worker.terminate()
+
+
+def _eval_worker(
+    pipeline,
+    server,
+    dev_dataloader,
+    test_dataloader
+):
+    # Worker loop: load the snapshot, run dev and test inference, send back the results
+    torch.set_num_threads(pipeline.num_threads)
+    while True:
+        task = pipeline.task_queue.get()
+        if task is None: break
+        epoch, metric, best_dev = task
+        try:
+            pipeline.flattener.load_into(server.global_model, pipeline.snapshot_buf)
+            with torch.no_grad():
+                server.inference(dev_dataloader)
+                dev_result, test_result = server.result, None
+                if test_dataloader is None:
+                    test_result = dev_result
+                elif best_dev is None or dev_result[metric] > best_dev:
+                    server.inference(test_dataloader)
+                    test_result = server.result
+            pipeline.result_queue.put((dev_result, test_result, None))
+        except Exception:
+            pipeline.result_queue.put((None, None, traceback.format_exc()))
+
+
+def build_eval_pipeline(
+    args,
+    server,
+    dataloader_dict: dict
+):
+    """
+    Return the background evaluation pipeline when args.eval_pipeline is set, else None.
+    """
+    if not getattr(args, 'eval_pipeline', False) or not is_main_rank():
+        return None
+    if torch.device(server.device).type != 'cpu':
+        logging.info('Pipelined evaluation needs a cpu device, evaluate synchronously')
+        return None
+    return EvalPipeline(
+        server,
+        dataloader_dict,
+        num_threads=getattr(args, 'eval_threads', 0) or 1,
+        lazy_test=getattr(args, 'lazy_test', False)
+    )
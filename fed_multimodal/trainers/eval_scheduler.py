@@ -0,0 +1,109 @@
+import torch.distributed as dist
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+class EvalScheduler(object):
+    """
+    Choose the rounds evaluated on dev/test, and stop runs that stopped improving.
+
+    fixed evaluates every test_frequency rounds. geometric starts at
+    test_frequency and multiplies the interval by eval_growth after every
+    evaluation. plateau evaluates every test_frequency rounds while dev
+    improves and doubles the interval after every evaluation without
+    improvement. Intervals are capped at eval_max_interval (0 for no cap),
+    and the last round is always evaluated.
+
+    With lazy_test the test set is only evaluated when dev improves, the
+    only case in which log_epoch_result reads it. With patience > 0 the run
+    stops after patience evaluations without dev improvement.
+    """
+    def __init__(self, args):
+        self.schedule = getattr(args, 'eval_schedule', 'fixed')
+        if self.schedule not in ['fixed', 'geometric', 'plateau']:
+            raise ValueError(f'Unknown evaluation schedule {self.schedule}')
+        self.frequency = max(1, getattr(args, 'test_frequency', 1))
+        self.growth = getattr(args, 'eval_growth', 2.0)
+        self.max_interval = getattr(args, 'eval_max_interval', 0)
+        self.lazy_test = getattr(args, 'lazy_test', False)
+        self.patience = getattr(args, 'patience', 0)
+        self.num_epochs = int(args.num_epochs)
+        self.interval = self.frequency
+        self.next_epoch = 0
+        self.eval_epochs = list()
+
+    def should_evaluate(
+        self,
+        epoch: int,
+        server
+    ):
+        """
+        Return True if this round is evaluated, and schedule the next evaluation.
+        :param epoch: current round
+        :param server: server, its best epoch drives the plateau schedule
+        """
+        if self.schedule == 'fixed':
+            evaluate = epoch % self.frequency == 0
+        else:
+            evaluate = epoch >= self.next_epoch
+            if evaluate:
+                if self.schedule == 'geometric' and len(self.eval_epochs) > 0:
+                    self.interval = self.interval * self.growth
+                elif self.schedule == 'plateau':
+                    self.interval = self.frequency if self.last_improved(server) else self.interval * 2
+                if self.max_interval > 0: self.interval = min(self.interval, self.max_interval)
+                self.next_epoch = epoch + max(1, int(round(self.interval)))
+        if epoch == self.num_epochs - 1: evaluate = True
+        if evaluate: self.eval_epochs.append(epoch)
+        return evaluate
+
+    def last_improved(self, server):
+        # Whether the latest logged evaluation improved dev, true before any evaluation
+        logged_epochs = [epoch for epoch in self.eval_epochs if self.is_logged(epoch, server)]
+        if len(logged_epochs) == 0: return True
+        return getattr(server, 'best_epoch', None) == logged_epochs[-1]
+
+    def is_logged(
+        self,
+        epoch: int,
+        server
+    ):
+        # Dev results of the round are logged, pipelined evaluations are logged a round late
+        return len(server.result_dict[epoch]['dev']) > 0
+
+    def need_test(
+        self,
+        server,
+        metric: str='acc'
+    ):
+        # Evaluate the test set unless lazy and dev did not improve this round
+        return not self.lazy_test or server.dev_improved(metric)
+
+    def should_stop(self, server):
+        """
+        Return True once patience evaluations in a row did not improve dev.
+
+        In distributed runs rank 0 decides and every rank gets its decision,
+        so all ranks leave the round loop together.
+        :param server: server with the logged evaluations
+        """
+        if self.patience <= 0: return False
+        stop = False
+        if hasattr(server, 'best_epoch'):
+            num_stale = sum(
+                1 for epoch in self.eval_epochs
+                if epoch > server.best_epoch and self.is_logged(epoch, server)
+            )
+            stop = num_stale >= self.patience
+        if dist.is_initialized():
+            decision = [stop]
+            dist.broadcast_object_list(decision, src=0)
+            stop = decision[0]
+        if stop: logging.info(f'Dev has not improved for {self.patience} evaluations, stop training')
+        return stop
@@ -6,20 +6,55 @@ import copy, pdb, time, warnings, torch
 
 from torch import nn
 from torch.utils import data
-from sklearn.metrics import f1_score
-from sklearn.metrics import confusion_matrix
 from torch.utils.data import DataLoader, Dataset
-from sklearn.metrics import accuracy_score, recall_score, roc_auc_score
 warnings.filterwarnings('ignore')
 
 
 class EvalMetric(object):
-    def __init__(self, multilabel=False):
+    """
+    Accumulate predictions batch by batch and summarize them at the end.
+
+    Classification keeps a running C x C confusion matrix, the top-5 hits
+    and the loss sum as tensors on the device of the model outputs, so
+    appending a batch does not synchronize with the host. Accuracy, UAR,
+    macro-F1, the normalized confusion matrix and the binary AUC are derived
+    from the confusion matrix in the summary, over the classes that appear
+    in the labels or the predictions, as sklearn does.
+
+    Multilabel keeps per-class TP/FP/FN/TN counts and the number of exact
+    matches the same way, for macro-F1 and recording-wise accuracy.
+
+    mode limits what is collected: 'full' for all metrics, 'loss' for the
+    loss and the sample count, 'none' for the sample count only.
+    """
+    def __init__(
+        self, 
+        multilabel=False,
+        mode: str='full'
+    ):
         self.multilabel = multilabel
-        self.pred_list = list()
-        self.truth_list = list()
-        self.top_k_list = list()
-        self.loss_list = list()
+        self.mode = mode
+        self.num_samples = 0
+        # streaming state, sized by the first batch
+        self.num_classes = None
+        self.conf_matrix = None
+        self.top_k_correct = None
+        self.exact_correct = None
+        self.loss_sum = None
+        self.num_batches = 0
+
+    def append_loss(
+        self,
+        outputs,
+        loss
+    ):
+        # Count the batch samples and add the batch loss unless the mode is none
+        self.num_samples += len(outputs)
+        if self.mode == 'none': return
+        if self.loss_sum is None:
+            self.loss_sum = torch.zeros((), dtype=torch.float64, device=outputs.device)
+        self.loss_sum += loss.detach().double()
+        self.num_batches += 1
         
     def append_classification_results(
         self, 
@@ -27,14 +62,23 @@ class EvalMetric(object):
         outputs,
         loss
     ):
-        predictions = np.argmax(outputs.detach().cpu().numpy(), axis=1)
-        top_k_predictions = np.argsort(outputs.detach().cpu().numpy(), axis = 1)[:, ::-1][:, :5]
-        for idx in range(len(predictions)):
-            self.pred_list.append(predictions[idx])
-            self.truth_list.append(labels.detach().cpu().numpy()[idx])
-            self.top_k_list.append(top_k_predictions[idx])
-        self.loss_list.append(loss.item())
+        outputs = outputs.detach()
+        self.append_loss(outputs, loss)
+        if self.mode != 'full': return
+        labels = labels.detach().reshape(-1).long()
+        if self.conf_matrix is None:
+            self.num_classes = outputs.shape[1]
+            self.conf_matrix = torch.zeros(self.num_classes**2, dtype=torch.long, device=outputs.device)
+            self.top_k_correct = torch.zeros((), dtype=torch.long, device=outputs.device)
         
+        # confusion matrix entry truth * C + prediction
+        predictions = torch.argmax(outputs, dim=1)
+        self.conf_matrix += torch.bincount(
+            labels * self.num_classes + predictions, 
+            minlength=self.num_classes**2
+        )
+        top_k_predictions = torch.topk(outputs, min(5, self.num_classes), dim=1).indices
+        self.top_k_correct += (top_k_predictions == labels.unsqueeze(1)).sum()
         
     def append_multilabel_results(
         self, 
@@ -42,43 +86,88 @@ class EvalMetric(object):
         outputs,
         loss
     ):
-        predictions = np.array(nn.Sigmoid()(outputs).detach().cpu().numpy() > 0.5, dtype=int)
-        for idx in range(len(predictions)):
-            self.pred_list.append(predictions[idx])
-            self.truth_list.append(labels.detach().cpu().numpy()[idx])
-        self.loss_list.append(loss.item())
+        outputs = outputs.detach()
+        self.append_loss(outputs, loss)
+        if self.mode != 'full': return
+        if self.conf_matrix is None:
+            self.num_classes = outputs.shape[1]
+            # per class [[TN, FN], [FP, TP]], as in compute_confusion_matrices
+            self.conf_matrix = torch.zeros((self.num_classes, 2, 2), dtype=torch.long, device=outputs.device)
+            self.exact_correct = torch.zeros((), dtype=torch.long, device=outputs.device)
+        
+        predictions = torch.sigmoid(outputs) > 0.5
+        labels = labels.detach() == 1
+        self.conf_matrix[:, 1, 1] += (predictions & labels).sum(dim=0)
+        self.conf_matrix[:, 1, 0] += (predictions & ~labels).sum(dim=0)
+        self.conf_matrix[:, 0, 1] += (~predictions & labels).sum(dim=0)
+        self.conf_matrix[:, 0, 0] += (~predictions & ~labels).sum(dim=0)
+        self.exact_correct += (predictions == labels).all(dim=1).sum()
         
     def classification_summary(
         self, 
         return_auc: bool=False
     ):
+        if self.mode != 'full': return self.loss_summary()
+        conf_matrix = self.conf_matrix.view(self.num_classes, self.num_classes).cpu().numpy()
+        num_samples = int(conf_matrix.sum())
+        # sklearn metrics cover the classes seen in the labels or the predictions
+        support, predicted = conf_matrix.sum(axis=1), conf_matrix.sum(axis=0)
+        classes = np.flatnonzero(support + predicted)
+        true_positive = np.diag(conf_matrix)[classes]
+        support, predicted = support[classes], predicted[classes]
+        recall = np.divide(true_positive, support, out=np.zeros(len(classes)), where=support > 0)
+        conf_matrix = conf_matrix[classes][:, classes]
+        
+        result_dict = dict()
+        result_dict['acc'] = true_positive.sum() / num_samples*100
+        result_dict['uar'] = np.mean(recall)*100
+        result_dict['top5_acc'] = self.top_k_correct.item() / num_samples*100
+        result_dict['conf'] = np.round(np.divide(
+            conf_matrix, 
+            support.reshape(-1, 1), 
+            out=np.zeros(conf_matrix.shape), 
+            where=support.reshape(-1, 1) > 0
+        )*100, decimals=2)
+        result_dict["loss"] = self.loss_sum.item() / self.num_batches
+        result_dict["sample"] = num_samples
+        result_dict['f1'] = np.mean(2*true_positive / (support + predicted))*100
+        if return_auc: result_dict['auc'] = self.binary_auc()*100
+        return result_dict
+
+    def binary_auc(self):
+        # ROC AUC of hard binary predictions: (1 + TPR - FPR) / 2
+        conf_matrix = self.conf_matrix.view(self.num_classes, self.num_classes).cpu().numpy()
+        support = conf_matrix.sum(axis=1)
+        if self.num_classes != 2 or np.count_nonzero(support) != 2:
+            raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+        true_positive_rate = conf_matrix[1, 1] / support[1]
+        false_positive_rate = conf_matrix[0, 1] / support[0]
+        return (1 + true_positive_rate - false_positive_rate) / 2
+
+    def loss_summary(self):
+        # Sample count, and the mean batch loss unless the mode is none
         result_dict = dict()
-        result_dict['acc'] = accuracy_score(self.truth_list, self.pred_list)*100
-        result_dict['uar'] = recall_score(self.truth_list, self.pred_list, average="macro")*100
-        result_dict['top5_acc'] = (np.sum(self.top_k_list == np.array(self.truth_list).reshape(len(self.truth_list), 1)) / len(self.truth_list))*100
-        result_dict['conf'] = np.round(confusion_matrix(self.truth_list, self.pred_list, normalize='true')*100, decimals=2)
-        result_dict["loss"] = np.mean(self.loss_list)
-        result_dict["sample"] = len(self.truth_list)
-        result_dict['f1'] = f1_score(self.truth_list, self.pred_list, average='macro')*100
-        if return_auc: result_dict['auc'] = roc_auc_score(self.truth_list, self.pred_list)*100
+        if self.mode != 'none': result_dict["loss"] = self.loss_sum.item() / self.num_batches
+        result_dict["sample"] = self.num_samples
         return result_dict
 
     def multilabel_summary(self):
-        num_recordings, num_classes = np.shape(np.array(self.truth_list))
-        A = self.compute_confusion_matrices(np.array(self.truth_list), np.array(self.pred_list))
-        f_measure = np.zeros(num_classes)
-        for k in range(num_classes):
-            tp, fp, fn, tn = A[k, 1, 1], A[k, 1, 0], A[k, 0, 1], A[k, 0, 0]
-            if 2 * tp + fp + fn:
-                f_measure[k] = float(2 * tp) / float(2 * tp + fp + fn)
-            else:
-                f_measure[k] = float('nan')
+        if self.mode != 'full': return self.loss_summary()
+        A = self.conf_matrix.cpu().numpy()
+        num_recordings = int(A[0].sum())
+        tp, fp, fn = A[:, 1, 1], A[:, 1, 0], A[:, 0, 1]
+        f_measure = np.divide(
+            2*tp, 
+            2*tp + fp + fn, 
+            out=np.full(len(tp), np.nan), 
+            where=(2*tp + fp + fn) > 0
+        )
 
         result_dict = dict()
-        result_dict['acc'] = self.multilabel_acc(np.array(self.truth_list), np.array(self.pred_list))*100
-        result_dict["loss"] = np.mean(self.loss_list)
+        result_dict['acc'] = self.exact_correct.item() / num_recordings*100
+        result_dict["loss"] = self.loss_sum.item() / self.num_batches
         result_dict['macro_f'] = np.nanmean(f_measure)*100
-        result_dict["sample"] = len(self.truth_list)
+        result_dict["sample"] = num_recordings
         return result_dict
     
     # Compute recording-wise accuracy.
@@ -87,13 +176,7 @@ class EvalMetric(object):
         truth_list, 
         pred_list
     ):
-        num_recordings, num_classes = np.shape(np.array(truth_list))
-        num_correct_recordings = 0
-        for i in range(num_recordings):
-            if np.all(truth_list[i, :]==pred_list[i, :]):
-                num_correct_recordings += 1
-        return float(num_correct_recordings) / float(num_recordings)
-    
+        return float(np.mean(np.all(np.asarray(truth_list) == np.asarray(pred_list), axis=1)))
     
     def compute_confusion_matrices(
         self, 
@@ -106,21 +189,33 @@ class EvalMetric(object):
         #     [TN_k FN_k]
         #     [FP_k TP_k]
         #
-        # If the normalize variable is set to true, then normalize the contributions
-        # to the confusion matrix by the number of labels per recording.
-        num_recordings, num_classes = np.shape(labels)
-        A = np.zeros((num_classes, 2, 2))
-        
-        for i in range(num_recordings):
-            for j in range(num_classes):
-                if labels[i, j]==1 and outputs[i, j]==1: # TP
-                    A[j, 1, 1] += 1
-                elif labels[i, j]==0 and outputs[i, j]==1: # FP
-                    A[j, 1, 0] += 1
-                elif labels[i, j]==1 and outputs[i, j]==0: # FN
-                    A[j, 0, 1] += 1
-                elif labels[i, j]==0 and outputs[i, j]==0: # TN
-                    A[j, 0, 0] += 1
-                else: # This condition should not happen.
-                    raise ValueError('Error in computing the confusion matrix.')
-        return A
\ No newline at end of file
+        labels, outputs = np.asarray(labels), np.asarray(outputs)
+        if not np.all(np.isin(labels, [0, 1]) & np.isin(outputs, [0, 1])):
+            raise ValueError('Error in computing the confusion matrix.')
+        labels, outputs = labels == 1, outputs == 1
+        A = np.zeros((labels.shape[1], 2, 2))
+        A[:, 1, 1] = np.sum(labels & outputs, axis=0)
+        A[:, 1, 0] = np.sum(~labels & outputs, axis=0)
+        A[:, 0, 1] = np.sum(labels & ~outputs, axis=0)
+        A[:, 0, 0] = np.sum(~labels & ~outputs, axis=0)
+        return A
+
+
+def train_metric_mode(
+    args,
+    seed: int=0
+):
+    """
+    Return the training metrics a client collects, from args.train_metrics.
+
+    'sampled' collects the full metrics on args.train_metrics_fraction of
+    the clients and the loss on the others. The client seed picks them, so
+    every round executor samples the same clients.
+    :param args: arguments, train_metrics and train_metrics_fraction
+    :param seed: training seed of the client in this round
+    :return: metric mode of EvalMetric
+    """
+    mode = getattr(args, 'train_metrics', 'full')
+    if mode != 'sampled': return mode
+    fraction = getattr(args, 'train_metrics_fraction', 0.1)
+    return 'full' if np.random.RandomState(seed).rand() < fraction else 'loss'
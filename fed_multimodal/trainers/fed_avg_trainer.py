@@ -12,10 +12,12 @@ from torch.utils.data import DataLoader, Dataset
 from sklearn.metrics import accuracy_score, recall_score
 
 # import optimizer
-from .optimizer import FedProxOptimizer
+from .optimizer import FedProxOptimizer, optimizer_options
 
 warnings.filterwarnings('ignore')
 from .evaluation import EvalMetric
+from .server_optimizer import server_opt_algs
+from .mixed_precision import autocast_context
 
 
 class ClientFedAvg(object):
@@ -27,7 +29,8 @@ class ClientFedAvg(object):
         dataloader, 
         model, 
         label_dict=None,
-        num_class=None
+        num_class=None,
+        metric_mode='full'
     ):
         self.args = args
         self.model = model
@@ -35,6 +38,7 @@ class ClientFedAvg(object):
         self.criterion = criterion
         self.dataloader = dataloader
         self.multilabel = True if args.dataset == 'ptb-xl' else False
+        self.metric_mode = metric_mode
         
     def get_parameters(self):
         # Return model parameters
@@ -61,27 +65,28 @@ class ClientFedAvg(object):
         self.model.train()
 
         # initialize eval
-        self.eval = EvalMetric(self.multilabel)
+        self.eval = EvalMetric(self.multilabel, mode=self.metric_mode)
         
         # optimizer
-        if self.args.fed_alg in ['fed_avg', 'fed_opt']:
+        options = optimizer_options(self.args)
+        if self.args.fed_alg in ['fed_avg'] + server_opt_algs and not options['flat']:
             optimizer = torch.optim.SGD(
                 self.model.parameters(), 
                 lr=self.args.learning_rate,
                 momentum=0.9,
-                weight_decay=1e-5
+                weight_decay=1e-5,
+                foreach=options['foreach']
             )
         else:
+            # without the proximal term, the flat path of plain SGD
             optimizer = FedProxOptimizer(
                 self.model.parameters(), 
                 lr=self.args.learning_rate,
                 momentum=0.9,
                 weight_decay=1e-5,
-                mu=self.args.mu
+                mu=self.args.mu if self.args.fed_alg == 'fed_prox' else 0,
+                **options
             )
-            
-        # last global model
-        last_global_model = copy.deepcopy(self.model)
         
         for iter in range(int(self.args.local_epochs)):
             for batch_idx, batch_data in enumerate(self.dataloader):
@@ -94,17 +99,21 @@ class ClientFedAvg(object):
                     l_a, l_b = l_a.to(self.device), l_b.to(self.device)
                     
                     # forward
-                    outputs, _ = self.model(
-                        x_a.float(), x_b.float(), l_a, l_b
-                    )
+                    with autocast_context(self.args, self.device):
+                        outputs, _ = self.model(
+                            x_a.float(), x_b.float(), l_a, l_b
+                        )
                 else:
                     x, l, y = batch_data
                     x, l, y = x.to(self.device), l.to(self.device), y.to(self.device)
                     
                     # forward
-                    outputs, _ = self.model(
-                        x.float(), l
-                    )
+                    with autocast_context(self.args, self.device):
+                        outputs, _ = self.model(
+                            x.float(), l
+                        )
+                # loss in fp32
+                outputs = outputs.float()
                 
                 if not self.multilabel: 
                     outputs = torch.log_softmax(outputs, dim=1)
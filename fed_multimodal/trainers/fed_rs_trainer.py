@@ -13,6 +13,8 @@ from sklearn.metrics import accuracy_score, recall_score
 
 warnings.filterwarnings('ignore')
 from .evaluation import EvalMetric
+from .optimizer import FedProxOptimizer, optimizer_options
+from .mixed_precision import autocast_context
 
 
 class ClientFedRS(object):
@@ -24,7 +26,8 @@ class ClientFedRS(object):
         dataloader, 
         model,
         label_dict=None,
-        num_class=None
+        num_class=None,
+        metric_mode='full'
     ):
         self.args = args
         self.model = model
@@ -32,6 +35,7 @@ class ClientFedRS(object):
         self.criterion = criterion
         self.dataloader = dataloader
         self.multilabel = True if args.dataset == 'ptb-xl' else False
+        self.metric_mode = metric_mode
         self.label_dict = label_dict
         self.num_class = num_class
         self.get_label_dist()
@@ -82,15 +86,28 @@ class ClientFedRS(object):
         self.model.train()
 
         # initialize eval
-        self.eval = EvalMetric(self.multilabel)
+        self.eval = EvalMetric(self.multilabel, mode=self.metric_mode)
         
         # optimizer
-        optimizer = torch.optim.SGD(
-            self.model.parameters(), 
-            lr=self.args.learning_rate,
-            momentum=0.9,
-            weight_decay=1e-5
-        )
+        options = optimizer_options(self.args)
+        if not options['flat']:
+            optimizer = torch.optim.SGD(
+                self.model.parameters(), 
+                lr=self.args.learning_rate,
+                momentum=0.9,
+                weight_decay=1e-5,
+                foreach=options['foreach']
+            )
+        else:
+            # without the proximal term, the flat path of plain SGD
+            optimizer = FedProxOptimizer(
+                self.model.parameters(), 
+                lr=self.args.learning_rate,
+                momentum=0.9,
+                weight_decay=1e-5,
+                mu=0,
+                flat=True
+            )
         
         for iter in range(int(self.args.local_epochs)):
             for batch_idx, batch_data in enumerate(self.dataloader):
@@ -101,13 +118,15 @@ class ClientFedRS(object):
                 x_a, x_b, y = x_a.to(self.device), x_b.to(self.device), y.to(self.device)
                 l_a, l_b = l_a.to(self.device), l_b.to(self.device)
                 
-                # forward
-                _, x_mm = self.model(
-                    x_a.float(), 
-                    x_b.float(), 
-                    l_a, 
-                    l_b
-                )
+                # forward, the restricted classifier runs in fp32
+                with autocast_context(self.args, self.device):
+                    _, x_mm = self.model(
+                        x_a.float(), 
+                        x_b.float(), 
+                        l_a, 
+                        l_b
+                    )
+                x_mm = x_mm.float()
 
                 # get distribution
                 # self.dist = self.dist / self.dist.max()
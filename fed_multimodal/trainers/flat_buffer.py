@@ -0,0 +1,77 @@
+import torch
+import numpy as np
+
+
+class StateDictFlattener(object):
+    """
+    Map a model state_dict onto one contiguous fp32 vector and back.
+    """
+    def __init__(
+        self,
+        state_dict: dict
+    ):
+        self.keys = list(state_dict.keys())
+        self.shapes = [state_dict[key].shape for key in self.keys]
+        self.dtypes = [state_dict[key].dtype for key in self.keys]
+        self.numels = [state_dict[key].numel() for key in self.keys]
+        self.offsets = np.cumsum([0] + self.numels).tolist()
+        self.numel = self.offsets[-1]
+
+    def zeros(
+        self,
+        shared: bool=False
+    ):
+        # Return an empty flat buffer, optionally in shared memory
+        flat = torch.zeros(self.numel, dtype=torch.float32)
+        if shared: flat.share_memory_()
+        return flat
+
+    def flatten(
+        self,
+        state_dict: dict,
+        out=None
+    ):
+        """
+        Copy a state_dict into a flat fp32 vector.
+        :param state_dict: model state_dict, or a dict with the same keys
+        :param out: optional preallocated flat buffer
+        :return: flat tensor
+        """
+        if out is None: out = self.zeros()
+        with torch.no_grad():
+            for idx, key in enumerate(self.keys):
+                out[self.offsets[idx]:self.offsets[idx+1]].copy_(
+                    state_dict[key].detach().reshape(-1)
+                )
+        return out
+
+    def unflatten(
+        self,
+        flat,
+        cast: bool=True
+    ):
+        """
+        Return a state_dict whose fp32 entries are views into the flat buffer.
+        :param flat: flat tensor
+        :param cast: cast non fp32 entries back to their dtype
+        :return: state_dict
+        """
+        state_dict = dict()
+        for idx, key in enumerate(self.keys):
+            value = flat[self.offsets[idx]:self.offsets[idx+1]].view(self.shapes[idx])
+            if cast and self.dtypes[idx] != torch.float32: value = value.to(self.dtypes[idx])
+            state_dict[key] = value
+        return state_dict
+
+    def load_into(
+        self,
+        model,
+        flat
+    ):
+        # Copy the flat buffer into the model weights in place
+        state_dict = model.state_dict()
+        with torch.no_grad():
+            for idx, key in enumerate(self.keys):
+                state_dict[key].copy_(
+                    flat[self.offsets[idx]:self.offsets[idx+1]].view(self.shapes[idx])
+                )
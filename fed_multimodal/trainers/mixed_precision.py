@@ -0,0 +1,37 @@
+import torch
+import contextlib
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def autocast_context(
+    args,
+    device
+):
+    """
+    Return the autocast context of the model forward.
+
+    With mixed_precision bf16 the forward of the client training step and of
+    the server inference runs under bfloat16 autocast. Parameters, gradients
+    and optimizer state stay fp32, so the fp32 weights are the master copy
+    that every step updates. Callers cast the outputs back to fp32 before the
+    loss, and the flattened updates, the codecs and the aggregation run in
+    fp32 as before. fp32 returns a null context.
+    :param args: arguments, mixed_precision is fp32 or bf16
+    :param device: device the model runs on
+    :return: context manager
+    """
+    precision = getattr(args, 'mixed_precision', 'fp32')
+    if precision == 'fp32': return contextlib.nullcontext()
+    if precision != 'bf16':
+        raise ValueError(f'Unknown mixed precision mode {precision}')
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=torch.bfloat16
+    )
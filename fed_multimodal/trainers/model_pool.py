@@ -0,0 +1,55 @@
+import copy
+import torch
+
+from collections import deque
+
+from .flat_buffer import StateDictFlattener
+
+
+class ModelPool(object):
+    """
+    A fixed set of pre-built client models and reusable flat update buffers.
+
+    Clients borrow a model whose weights are overwritten in place with the
+    global weights, instead of deep-copying the global model. Flat buffers
+    hold client updates that finish before the server can take them, and are
+    reused across rounds.
+    """
+    def __init__(
+        self,
+        model,
+        pool_size: int=1
+    ):
+        self.flattener = StateDictFlattener(model.state_dict())
+        self.models = [copy.deepcopy(model) for _ in range(pool_size)]
+        self.free_models = deque(self.models)
+        self.device = next(iter(model.state_dict().values())).device
+        self.free_bufs = deque()
+
+    def acquire(
+        self,
+        global_model
+    ):
+        # Borrow a model loaded with the global weights
+        model = self.free_models.popleft()
+        model.load_state_dict(global_model.state_dict())
+        return model
+
+    def release(
+        self,
+        model
+    ):
+        # Return a borrowed model to the pool
+        self.free_models.append(model)
+
+    def take_buffer(self):
+        # Borrow a flat buffer to hold one client update
+        if len(self.free_bufs) > 0: return self.free_bufs.popleft()
+        return torch.zeros(self.flattener.numel, device=self.device)
+
+    def release_buffer(
+        self,
+        flat
+    ):
+        # Return a borrowed flat buffer to the pool
+        self.free_bufs.append(flat)
@@ -0,0 +1,227 @@
+import json
+import time
+import torch
+import socket
+import struct
+import asyncio
+import numpy as np
+
+from .flat_buffer import StateDictFlattener
+from .control_store import ControlVariateStore
+from .update_codec import build_update_codec
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# frame header: magic, metadata length, tensor body length
+MAGIC = b'FMW1'
+HEADER = struct.Struct('!4sIQ')
+
+
+def pack_message(
+    meta: dict,
+    tensors: dict=None
+):
+    """
+    Frame a message as header, json metadata and the raw tensor bytes.
+
+    The tensors are not copied, the returned buffers are views of their
+    memory and are written to the socket one after another.
+    :param meta: json serializable metadata
+    :param tensors: name to cpu tensor
+    :return: list of buffers
+    """
+    buffers, layout = list(), list()
+    for name, tensor in (tensors or dict()).items():
+        array = tensor.detach().contiguous().numpy()
+        layout.append([name, array.dtype.str, list(array.shape), array.nbytes])
+        buffers.append(memoryview(array).cast('B'))
+    meta = dict(meta, tensors=layout)
+    meta_bytes = json.dumps(meta, default=_to_json).encode()
+    body_len = sum(len(buffer) for buffer in buffers)
+    return [HEADER.pack(MAGIC, len(meta_bytes), body_len), meta_bytes] + buffers
+
+
+def unpack_tensors(
+    meta: dict,
+    body: bytearray
+):
+    """
+    Return the tensors of a message as views into the received body.
+    :param meta: message metadata
+    :param body: tensor bytes of the message
+    :return: name to tensor
+    """
+    tensors, offset = dict(), 0
+    for name, dtype, shape, nbytes in meta['tensors']:
+        array = np.frombuffer(body, dtype=np.dtype(dtype), count=nbytes // np.dtype(dtype).itemsize, offset=offset)
+        tensors[name] = torch.from_numpy(array.reshape(shape))
+        offset += nbytes
+    return tensors
+
+
+async def send_message(
+    sock,
+    meta: dict,
+    tensors: dict=None
+):
+    """
+    Send one framed message.
+    :return: number of bytes sent
+    """
+    loop = asyncio.get_running_loop()
+    buffers = pack_message(meta, tensors)
+    for buffer in buffers:
+        await loop.sock_sendall(sock, buffer)
+    return sum(len(buffer) for buffer in buffers)
+
+
+async def recv_message(sock):
+    """
+    Receive one framed message, the tensor bytes land in one fresh buffer.
+    :return: meta, tensors, number of bytes received
+    """
+    header = await _recv_exactly(sock, HEADER.size)
+    magic, meta_len, body_len = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ConnectionError('Unknown message framing')
+    meta = json.loads(bytes(await _recv_exactly(sock, meta_len)))
+    body = await _recv_exactly(sock, body_len)
+    return meta, unpack_tensors(meta, body), HEADER.size + meta_len + body_len
+
+
+async def _recv_exactly(
+    sock,
+    num_bytes: int
+):
+    # Read exactly num_bytes from the socket into a new buffer
+    loop = asyncio.get_running_loop()
+    buffer = bytearray(num_bytes)
+    view = memoryview(buffer)
+    while len(view) > 0:
+        received = await loop.sock_recv_into(sock, view)
+        if received == 0:
+            raise ConnectionError('Connection closed')
+        view = view[received:]
+    return buffer
+
+
+def _to_json(value):
+    # numpy values in client results
+    if hasattr(value, 'tolist'): return value.tolist()
+    return str(value)
+
+
+def split_payload(payload: dict):
+    # Codec payload as tensors and json scalars
+    tensors = {f'payload/{key}': value for key, value in payload.items() if torch.is_tensor(value)}
+    scalars = {key: value for key, value in payload.items() if not torch.is_tensor(value)}
+    return tensors, scalars
+
+
+def join_payload(
+    tensors: dict,
+    scalars: dict
+):
+    # Rebuild a codec payload from a message
+    payload = {key[len('payload/'):]: value for key, value in tensors.items() if key.startswith('payload/')}
+    payload.update(scalars)
+    return payload
+
+
+class NetworkClient(object):
+    """
+    Client side of the socket runtime: one persistent connection per process.
+
+    The client registers the ids of the clients whose data it holds. Every
+    round the server sends the global weights (and the scaffold server
+    control) once with the list of (client_id, seed) to train; the process
+    trains them one after another and streams back one update per client,
+    encoded with the update codec when one is set. Scaffold client controls
+    stay on the client process.
+    """
+    def __init__(
+        self,
+        executor,
+        model,
+        client_ids: list,
+        host: str='127.0.0.1',
+        port: int=8790
+    ):
+        self.executor = executor
+        self.args = executor.args
+        self.model = model
+        self.client_ids = client_ids
+        self.host = host
+        self.port = port
+        self.flattener = StateDictFlattener(model.state_dict())
+        self.update_codec = build_update_codec(self.args, self.flattener.numel)
+        self.update_buf = self.flattener.zeros()
+        if self.args.fed_alg == 'scaffold':
+            self.client_controls = ControlVariateStore(model.state_dict())
+
+    def run(self):
+        # Serve the server until it closes the session
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try:
+            await send_message(sock, {'type': 'hello', 'client_ids': self.client_ids})
+            while True:
+                meta, tensors, _ = await recv_message(sock)
+                if meta['type'] == 'close': break
+                for client_id, seed in meta['tasks']:
+                    reply, reply_tensors = self.train(client_id, seed, tensors)
+                    await send_message(sock, reply, reply_tensors)
+        finally:
+            sock.close()
+
+    def train(
+        self,
+        client_id,
+        seed: int,
+        tensors: dict
+    ):
+        """
+        Train one client from the received global weights.
+        :return: reply metadata and tensors
+        """
+        train_start = time.time()
+        self.flattener.load_into(self.model, tensors['global'])
+        torch.manual_seed(seed)
+        client = self.executor.build_client(client_id, model=self.model, seed=seed)
+        if self.args.fed_alg == 'scaffold':
+            client.set_control(
+                server_control=self.flattener.unflatten(tensors['server_control']),
+                client_control=self.client_controls[client_id]
+            )
+        client.update_weights()
+        train_time = time.time() - train_start
+
+        serialize_start = time.time()
+        self.flattener.flatten(client.get_parameters(), out=self.update_buf)
+        meta = {
+            'type': 'update',
+            'client_id': client_id,
+            'num_sample': client.result['sample'],
+            'result': client.result,
+            'train_time': train_time
+        }
+        if self.update_codec is not None:
+            payload = self.update_codec.encode(self.update_buf - tensors['global'], client_id, seed=seed)
+            reply_tensors, meta['payload'] = split_payload(payload)
+        else:
+            reply_tensors = {'update': self.update_buf}
+        if self.args.fed_alg == 'scaffold':
+            self.client_controls[client_id] = client.client_control
+            reply_tensors['delta_control'] = self.flattener.flatten(client.delta_control)
+        meta['serialize_time'] = time.time() - serialize_start
+        return meta, reply_tensors
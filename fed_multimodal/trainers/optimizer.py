@@ -5,21 +5,132 @@ import torch.nn as nn
 
 from torch.optim.optimizer import Optimizer, required
 
+
+def _params_with_grad(group):
+    # Return the params of a group that received gradients, with their grads
+    params = [p for p in group["params"] if p.grad is not None]
+    return params, [p.grad for p in params]
+
+
+def _use_foreach(
+    foreach,
+    group: dict
+):
+    # Follow torch: multi-tensor ops by default only for cuda params
+    if foreach is not None: return foreach
+    return all(p.is_cuda for p in group["params"])
+
+
+def optimizer_options(args):
+    """
+    Return the update path options of the client optimizers.
+    :param args: arguments, optimizer_impl is auto, loop, foreach or flat
+    :return: dict with foreach and flat
+    """
+    impl = getattr(args, 'optimizer_impl', 'auto')
+    if impl not in ['auto', 'loop', 'foreach', 'flat']:
+        raise ValueError(f'Unknown optimizer implementation {impl}')
+    # auto follows torch: foreach for cuda params, the loop otherwise
+    return dict(
+        foreach=None if impl == 'auto' else impl == 'foreach',
+        flat=impl == 'flat'
+    )
+
+
+def _flatten_params(
+    flat_state: dict,
+    params: list
+):
+    """
+    Move the params into one contiguous buffer, the params become views of it.
+    :param flat_state: flat state of the param group, empty before the first step
+    :param params: params that received gradients
+    :return: flat param buffer
+    """
+    if "param" not in flat_state:
+        flat_param = torch.cat([p.detach().reshape(-1) for p in params])
+        offset = 0
+        for p in params:
+            p.data = flat_param[offset:offset+p.numel()].view_as(p)
+            offset += p.numel()
+        flat_state["params"] = params
+        flat_state["param"] = flat_param
+    elif len(params) != len(flat_state["params"]) or any(
+        p is not q for p, q in zip(params, flat_state["params"])
+    ):
+        raise RuntimeError("Flat mode needs the same params to receive gradients every step")
+    return flat_state["param"]
+
+
+def _foreach_momentum(
+    state,
+    params: list,
+    d_ps: list,
+    momentum: float,
+    dampening: float
+):
+    # Update the momentum buffers of a param list, return the buffers
+    old_bufs, old_d_ps = list(), list()
+    for p, d_p in zip(params, d_ps):
+        param_state = state[p]
+        if "momentum_buffer" not in param_state:
+            param_state["momentum_buffer"] = torch.clone(d_p).detach()
+        else:
+            old_bufs.append(param_state["momentum_buffer"])
+            old_d_ps.append(d_p)
+    if len(old_bufs) > 0:
+        torch._foreach_mul_(old_bufs, momentum)
+        torch._foreach_add_(old_bufs, old_d_ps, alpha=1 - dampening)
+    return [state[p]["momentum_buffer"] for p in params]
+
+
+def _flat_momentum(
+    flat_state: dict,
+    d_p,
+    momentum: float,
+    dampening: float
+):
+    # Update the flat momentum buffer, return the buffer
+    if "momentum_buffer" not in flat_state:
+        flat_state["momentum_buffer"] = torch.clone(d_p).detach()
+    else:
+        flat_state["momentum_buffer"].mul_(momentum).add_(d_p, alpha=1 - dampening)
+    return flat_state["momentum_buffer"]
+
+
+def _foreach_state(
+    state,
+    params: list,
+    key: str
+):
+    # Return the per param state under key, initialized with a copy of the param
+    for p in params:
+        if key not in state[p]:
+            state[p][key] = torch.clone(p.data).detach()
+    return [state[p][key] for p in params]
+
+
 # code from https://github.com/lxcnju/FedRepo/blob/main/algorithms/fednova.py
 class NovaOptimizer(Optimizer):
     """ gmf: global momentum
         prox_mu: mu of proximal term
         ratio: client weight
+        foreach: update all params with multi-tensor ops, None turns it on for cuda
+        flat: keep params and optimizer state in one flat buffer
     """
 
     def __init__(
         self, params, lr, ratio, gmf, prox_mu=0,
-        momentum=0, dampening=0, weight_decay=0, nesterov=False, variance=0
+        momentum=0, dampening=0, weight_decay=0, nesterov=False, variance=0,
+        foreach=None, flat=False
     ):
         self.gmf = gmf
         self.ratio = ratio
         self.prox_mu = prox_mu
         self.momentum = momentum
+        self.foreach = foreach
+        self.flat = flat
+        self.flat_states = dict()
         self.local_normalizing_vec = 0
         self.local_counter = 0
         self.local_steps = 0
@@ -43,62 +154,14 @@ class NovaOptimizer(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
-            weight_decay = group["weight_decay"]
-            momentum = group["momentum"]
-            dampening = group["dampening"]
-            nesterov = group["nesterov"]
-
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-
-                d_p = p.grad.data
-
-                # weight_decay
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-
-                # save the first parameter w0
-                param_state = self.state[p]
-                if "old_init" not in param_state:
-                    param_state["old_init"] = torch.clone(p.data).detach()
-
-                # momentum:
-                # v_{t+1} = rho * v_t + g_t
-                # g_t = v_{t+1}
-                # rho = momentum
-                local_lr = group["lr"]
-                if momentum != 0:
-                    if "momentum_buffer" not in param_state:
-                        buf = torch.clone(d_p).detach()
-                        param_state["momentum_buffer"] = buf
-                    else:
-                        buf = param_state["momentum_buffer"]
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-
-                        # update momentum buffer !!!
-                        param_state["momentum_buffer"] = buf
-
-                    if nesterov:
-                        d_p = d_p.add(momentum, buf)
-                    else:
-                        d_p = buf
-
-                # add proximal updates: g_t = g_t + prox_mu * (w - w0)
-                if self.prox_mu != 0:
-                    d_p.add_(self.prox_mu, p.data - param_state["old_init"])
-
-                # updata accumulated local updates
-                # sum(g_0, g_1, ..., g_t)
-                if "cum_grad" not in param_state:
-                    param_state["cum_grad"] = torch.clone(d_p).detach()
-                    param_state["cum_grad"].mul_(local_lr)
-                else:
-                    param_state["cum_grad"].add_(local_lr, d_p)
-
-                # update: w_{t+1} = w_t - lr * g_t
-                p.data.add_(-1.0 * local_lr, d_p)
+        for group_idx, group in enumerate(self.param_groups):
+            if self.flat:
+                self._step_flat(group, self.flat_states.setdefault(group_idx, dict()))
+            elif _use_foreach(self.foreach, group):
+                self._step_foreach(group)
+            else:
+                self._step_loop(group)
+            local_lr = group["lr"]
 
         # compute local normalizing vec, a_i
         # For momentum: a_i = [(1 - rho)^{tau_i - 1}/(1 - rho), ..., 1]
@@ -119,84 +182,314 @@ class NovaOptimizer(Optimizer):
             self.local_normalizing_vec += 1
 
         self.local_steps += 1
-        return 
+        return
+
+    def _step_loop(self, group):
+        weight_decay = group["weight_decay"]
+        momentum = group["momentum"]
+        dampening = group["dampening"]
+        nesterov = group["nesterov"]
+
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+
+            d_p = p.grad.data
+
+            # weight_decay
+            if weight_decay != 0:
+                d_p.add_(p.data, alpha=weight_decay)
+
+            # save the first parameter w0
+            param_state = self.state[p]
+            if "old_init" not in param_state:
+                param_state["old_init"] = torch.clone(p.data).detach()
+
+            # momentum:
+            # v_{t+1} = rho * v_t + g_t
+            # g_t = v_{t+1}
+            # rho = momentum
+            local_lr = group["lr"]
+            if momentum != 0:
+                if "momentum_buffer" not in param_state:
+                    buf = torch.clone(d_p).detach()
+                    param_state["momentum_buffer"] = buf
+                else:
+                    buf = param_state["momentum_buffer"]
+                    buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+
+                    # update momentum buffer !!!
+                    param_state["momentum_buffer"] = buf
+
+                if nesterov:
+                    d_p = d_p.add(buf, alpha=momentum)
+                else:
+                    d_p = buf
+
+            # add proximal updates: g_t = g_t + prox_mu * (w - w0)
+            if self.prox_mu != 0:
+                d_p.add_(p.data - param_state["old_init"], alpha=self.prox_mu)
+
+            # updata accumulated local updates
+            # sum(g_0, g_1, ..., g_t)
+            if "cum_grad" not in param_state:
+                param_state["cum_grad"] = torch.clone(d_p).detach()
+                param_state["cum_grad"].mul_(local_lr)
+            else:
+                param_state["cum_grad"].add_(d_p, alpha=local_lr)
+
+            # update: w_{t+1} = w_t - lr * g_t
+            p.data.add_(d_p, alpha=-1.0 * local_lr)
+
+    def _step_foreach(self, group):
+        params, d_ps = _params_with_grad(group)
+        if len(params) == 0: return
+        local_lr = group["lr"]
+        with torch.no_grad():
+            # weight_decay
+            if group["weight_decay"] != 0:
+                torch._foreach_add_(d_ps, params, alpha=group["weight_decay"])
+
+            # save the first parameter w0
+            old_inits = _foreach_state(self.state, params, "old_init")
+
+            # momentum
+            if group["momentum"] != 0:
+                bufs = _foreach_momentum(
+                    self.state, params, d_ps, group["momentum"], group["dampening"]
+                )
+                if group["nesterov"]:
+                    d_ps = torch._foreach_add(d_ps, bufs, alpha=group["momentum"])
+                else:
+                    d_ps = bufs
+
+            # add proximal updates: g_t = g_t + prox_mu * (w - w0)
+            if self.prox_mu != 0:
+                torch._foreach_add_(d_ps, torch._foreach_sub(params, old_inits), alpha=self.prox_mu)
+
+            # updata accumulated local updates
+            cum_grads, old_d_ps = list(), list()
+            for p, d_p in zip(params, d_ps):
+                if "cum_grad" not in self.state[p]:
+                    self.state[p]["cum_grad"] = torch.clone(d_p).detach().mul_(local_lr)
+                else:
+                    cum_grads.append(self.state[p]["cum_grad"])
+                    old_d_ps.append(d_p)
+            if len(cum_grads) > 0:
+                torch._foreach_add_(cum_grads, old_d_ps, alpha=local_lr)
+
+            # update: w_{t+1} = w_t - lr * g_t
+            torch._foreach_add_(params, d_ps, alpha=-1.0 * local_lr)
+
+    def _step_flat(self, group, flat_state):
+        params, grads = _params_with_grad(group)
+        if len(params) == 0: return
+        local_lr = group["lr"]
+        with torch.no_grad():
+            flat_param = _flatten_params(flat_state, params)
+            d_p = torch.cat([grad.reshape(-1) for grad in grads])
+
+            # weight_decay
+            if group["weight_decay"] != 0:
+                d_p.add_(flat_param, alpha=group["weight_decay"])
+
+            # save the first parameter w0
+            if "old_init" not in flat_state:
+                flat_state["old_init"] = torch.clone(flat_param).detach()
+
+            # momentum
+            if group["momentum"] != 0:
+                buf = _flat_momentum(flat_state, d_p, group["momentum"], group["dampening"])
+                if group["nesterov"]:
+                    d_p = d_p.add(buf, alpha=group["momentum"])
+                else:
+                    d_p = buf
+
+            # add proximal updates: g_t = g_t + prox_mu * (w - w0)
+            if self.prox_mu != 0:
+                d_p.add_(flat_param - flat_state["old_init"], alpha=self.prox_mu)
+
+            # updata accumulated local updates
+            if "cum_grad" not in flat_state:
+                flat_state["cum_grad"] = torch.clone(d_p).detach().mul_(local_lr)
+            else:
+                flat_state["cum_grad"].add_(d_p, alpha=local_lr)
+
+            # update: w_{t+1} = w_t - lr * g_t
+            flat_param.add_(d_p, alpha=-1.0 * local_lr)
 
 
 class ScaffoldOptimizer(torch.optim.Optimizer):
+    """ param_names: names of the params, used to look up the controls
+        foreach: update all params with multi-tensor ops, None turns it on for cuda
+        flat: keep params and optimizer state in one flat buffer
+
+        The correction c - ci is computed once per client by set_control, into
+        one read-only flat buffer per param group, and applied to the params
+        in place after the momentum update.
+    """
     def __init__(
-        self, 
-        params, 
-        lr, 
-        momentum=0, 
-        dampening=0, 
-        weight_decay=0
+        self,
+        params,
+        lr,
+        momentum=0,
+        dampening=0,
+        weight_decay=0,
+        param_names=None,
+        foreach=None,
+        flat=False
     ):
         defaults = dict(
-            lr=lr, 
-            weight_decay=weight_decay, 
-            momentum=momentum, 
+            lr=lr,
+            weight_decay=weight_decay,
+            momentum=momentum,
             dampening=dampening,
             nesterov=False
         )
+        params = list(params)
         super().__init__(params, defaults)
+        self.foreach = foreach
+        self.flat = flat
+        self.flat_states = dict()
+        self.corrections = None
+        # map params to the control keys by name
+        self.param_names = None
+        if param_names is not None:
+            self.param_names = {p: name for p, name in zip(params, param_names)}
 
     def __setstate__(self, state):
         super(ScaffoldOptimizer, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('nesterov', False)
 
-    def step(self, server_control, client_control, closure=None):
-        loss = None
-        if closure is not None:
-            loss = closure
-
-        ng = len(self.param_groups[0]["params"])
+    def control_names(self, server_control):
+        # Control keys of all params, in param order
+        if self.param_names is not None:
+            return [
+                self.param_names[p] for group in self.param_groups for p in group["params"]
+            ]
         names = list(server_control.keys())
 
         # BatchNorm: running_mean/std, num_batches_tracked
         names = [name for name in names if "running" not in name]
         names = [name for name in names if "num_batch" not in name]
+        return names
 
-        t = 0
-        for group in self.param_groups:
-            weight_decay = group["weight_decay"]
-            momentum = group["momentum"]
-            dampening = group["dampening"]
-
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-
-                d_p = p.grad.data
-                param_state = self.state[p]
-                
-                # weight_decay
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-
-                if momentum != 0:
-                    if "momentum_buffer" not in param_state:
-                        buf = torch.clone(d_p).detach()
-                        param_state["momentum_buffer"] = buf
-                    else:
-                        buf = param_state["momentum_buffer"]
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-
-                        # update momentum buffer !!!
-                        param_state["momentum_buffer"] = buf
-                    d_p = buf
+    def set_control(self, server_control, client_control):
+        """
+        Precompute the correction c - ci of every param.
+        :param server_control: server control variates, {name: tensor}
+        :param client_control: client control variates, {name: tensor}
+        """
+        names = self.control_names(server_control)
+        self.corrections, self.flat_corrections, t = dict(), list(), 0
+        with torch.no_grad():
+            for group in self.param_groups:
+                params = group["params"]
+                flat_correction = torch.cat([
+                    (server_control[name] - client_control[name]).reshape(-1).to(params[0].device)
+                    for name in names[t:t+len(params)]
+                ])
+                offset = 0
+                for p in params:
+                    self.corrections[p] = flat_correction[offset:offset+p.numel()].view_as(p)
+                    offset += p.numel()
+                self.flat_corrections.append(flat_correction)
+                t += len(params)
+        for flat_state in self.flat_states.values(): flat_state.pop("correction", None)
+
+    def step(self, server_control=None, client_control=None, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure
+
+        if server_control is not None:
+            self.set_control(server_control, client_control)
+        for group_idx, group in enumerate(self.param_groups):
+            if self.flat:
+                self._step_flat(group, group_idx)
+            elif _use_foreach(self.foreach, group):
+                self._step_foreach(group)
+            else:
+                self._step_loop(group)
+        return loss
 
-                # d_p = p.grad.data
-                c = server_control[names[t]]
-                ci = client_control[names[t]]
+    def _step_loop(self, group):
+        weight_decay = group["weight_decay"]
+        momentum = group["momentum"]
+        dampening = group["dampening"]
 
-                # print(names[t], p.shape, c.shape, ci.shape)
-                d_p = d_p + c.data - ci.data
+        for p in group["params"]:
+            if p.grad is None:
+                continue
 
-                p.data = p.data - d_p.data * group["lr"]
-                t += 1
-        assert t == ng
-        return loss
+            d_p = p.grad.data
+            param_state = self.state[p]
+
+            # weight_decay
+            if weight_decay != 0:
+                d_p.add_(p.data, alpha=weight_decay)
+
+            if momentum != 0:
+                if "momentum_buffer" not in param_state:
+                    buf = torch.clone(d_p).detach()
+                    param_state["momentum_buffer"] = buf
+                else:
+                    buf = param_state["momentum_buffer"]
+                    buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+
+                    # update momentum buffer !!!
+                    param_state["momentum_buffer"] = buf
+                d_p = buf
+
+            # p = p - lr * (d_p + c - ci)
+            p.data.add_(d_p, alpha=-group["lr"])
+            p.data.add_(self.corrections[p], alpha=-group["lr"])
+
+    def _step_foreach(self, group):
+        params, d_ps = _params_with_grad(group)
+        if len(params) == 0: return
+        with torch.no_grad():
+            # weight_decay
+            if group["weight_decay"] != 0:
+                torch._foreach_add_(d_ps, params, alpha=group["weight_decay"])
+
+            if group["momentum"] != 0:
+                d_ps = _foreach_momentum(
+                    self.state, params, d_ps, group["momentum"], group["dampening"]
+                )
+
+            # p = p - lr * (d_p + c - ci)
+            torch._foreach_add_(params, d_ps, alpha=-group["lr"])
+            torch._foreach_add_(params, [self.corrections[p] for p in params], alpha=-group["lr"])
+
+    def _step_flat(self, group, group_idx):
+        params, grads = _params_with_grad(group)
+        if len(params) == 0: return
+        flat_state = self.flat_states.setdefault(group_idx, dict())
+        with torch.no_grad():
+            flat_param = _flatten_params(flat_state, params)
+            d_p = torch.cat([grad.reshape(-1) for grad in grads])
+
+            # weight_decay
+            if group["weight_decay"] != 0:
+                d_p.add_(flat_param, alpha=group["weight_decay"])
+
+            if group["momentum"] != 0:
+                d_p = _flat_momentum(flat_state, d_p, group["momentum"], group["dampening"])
+
+            # the correction of the params in the flat buffer
+            if "correction" not in flat_state:
+                if len(params) == len(group["params"]):
+                    flat_state["correction"] = self.flat_corrections[group_idx]
+                else:
+                    flat_state["correction"] = torch.cat([
+                        self.corrections[p].reshape(-1) for p in params
+                    ])
+
+            # p = p - lr * (d_p + c - ci)
+            flat_param.add_(d_p, alpha=-group["lr"])
+            flat_param.add_(flat_state["correction"], alpha=-group["lr"])
 
 # implementation from: https://github.com/JYWa/FedNova/blob/master/distoptim/FedProx.py
 class FedProxOptimizer(Optimizer):
@@ -214,6 +507,8 @@ class FedProxOptimizer(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         dampening (float, optional): dampening for momentum (default: 0)
         nesterov (bool, optional): enables Nesterov momentum (default: False)
+        foreach (bool, optional): update all params with multi-tensor ops (default: None, on for cuda)
+        flat (bool, optional): keep params and optimizer state in one flat buffer (default: False)
     Example:
         >>> optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
         >>> optimizer.zero_grad()
@@ -238,20 +533,25 @@ class FedProxOptimizer(Optimizer):
     """
 
     def __init__(
-        self, 
-        params, 
-        lr=required, 
-        momentum=0, 
+        self,
+        params,
+        lr=required,
+        momentum=0,
         dampening=0,
-        weight_decay=0, 
-        nesterov=False, 
-        variance=0, 
-        mu=0
+        weight_decay=0,
+        nesterov=False,
+        variance=0,
+        mu=0,
+        foreach=None,
+        flat=False
     ):
-        
+
         self.itr = 0
         self.a_sum = 0
         self.mu = mu
+        self.foreach = foreach
+        self.flat = flat
+        self.flat_states = dict()
 
 
         if lr is not required and lr < 0.0:
@@ -284,38 +584,92 @@ class FedProxOptimizer(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
-            weight_decay = group['weight_decay']
-            momentum = group['momentum']
-            dampening = group['dampening']
-            nesterov = group['nesterov']
-            
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                d_p = p.grad.data
-
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                
-                param_state = self.state[p]
-                if 'old_init' not in param_state:
-                    param_state['old_init'] = torch.clone(p.data).detach()
-
-                if momentum != 0:
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.clone(d_p).detach()
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    if nesterov:
-                        d_p = d_p.add(momentum, buf)
-                    else:
-                        d_p = buf
-
-                # apply proximal update
-                d_p.add_(self.mu, p.data - param_state['old_init'])
-                p.data.add_(-group['lr'], d_p)
-
-        return loss
\ No newline at end of file
+        for group_idx, group in enumerate(self.param_groups):
+            if self.flat:
+                self._step_flat(group, self.flat_states.setdefault(group_idx, dict()))
+            elif _use_foreach(self.foreach, group):
+                self._step_foreach(group)
+            else:
+                self._step_loop(group)
+        return loss
+
+    def _step_loop(self, group):
+        weight_decay = group['weight_decay']
+        momentum = group['momentum']
+        dampening = group['dampening']
+        nesterov = group['nesterov']
+
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            d_p = p.grad.data
+
+            if weight_decay != 0:
+                d_p.add_(p.data, alpha=weight_decay)
+
+            param_state = self.state[p]
+            if 'old_init' not in param_state:
+                param_state['old_init'] = torch.clone(p.data).detach()
+
+            if momentum != 0:
+                if 'momentum_buffer' not in param_state:
+                    buf = param_state['momentum_buffer'] = torch.clone(d_p).detach()
+                else:
+                    buf = param_state['momentum_buffer']
+                    buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+                if nesterov:
+                    d_p = d_p.add(buf, alpha=momentum)
+                else:
+                    d_p = buf
+
+            # apply proximal update
+            d_p.add_(p.data - param_state['old_init'], alpha=self.mu)
+            p.data.add_(d_p, alpha=-group['lr'])
+
+    def _step_foreach(self, group):
+        params, d_ps = _params_with_grad(group)
+        if len(params) == 0: return
+        with torch.no_grad():
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(d_ps, params, alpha=group['weight_decay'])
+
+            old_inits = _foreach_state(self.state, params, 'old_init')
+
+            if group['momentum'] != 0:
+                bufs = _foreach_momentum(
+                    self.state, params, d_ps, group['momentum'], group['dampening']
+                )
+                if group['nesterov']:
+                    d_ps = torch._foreach_add(d_ps, bufs, alpha=group['momentum'])
+                else:
+                    d_ps = bufs
+
+            # apply proximal update
+            if self.mu != 0:
+                torch._foreach_add_(d_ps, torch._foreach_sub(params, old_inits), alpha=self.mu)
+            torch._foreach_add_(params, d_ps, alpha=-group['lr'])
+
+    def _step_flat(self, group, flat_state):
+        params, grads = _params_with_grad(group)
+        if len(params) == 0: return
+        with torch.no_grad():
+            flat_param = _flatten_params(flat_state, params)
+            d_p = torch.cat([grad.reshape(-1) for grad in grads])
+
+            if group['weight_decay'] != 0:
+                d_p.add_(flat_param, alpha=group['weight_decay'])
+
+            if 'old_init' not in flat_state:
+                flat_state['old_init'] = torch.clone(flat_param).detach()
+
+            if group['momentum'] != 0:
+                buf = _flat_momentum(flat_state, d_p, group['momentum'], group['dampening'])
+                if group['nesterov']:
+                    d_p = d_p.add(buf, alpha=group['momentum'])
+                else:
+                    d_p = buf
+
+            # apply proximal update
+            if self.mu != 0:
+                d_p.add_(flat_param - flat_state['old_init'], alpha=self.mu)
+            flat_param.add_(d_p, alpha=-group['lr'])
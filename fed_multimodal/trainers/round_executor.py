@@ -0,0 +1,1067 @@
+import copy
+import time
+import queue
+import socket
+import asyncio
+import torch
+import traceback
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from collections import deque
+
+from .model_pool import ModelPool
+from .update_codec import build_update_codec
+from .flat_buffer import StateDictFlattener
+from .simulator import RoundSimulator, SimulatedRoundExecutor
+from .distributed import init_distributed
+from .network import NetworkClient, recv_message, send_message, join_payload
+from .stacked_trainer import StackedClientTrainer
+from .evaluation import train_metric_mode
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+class RoundExecutor(object):
+    """
+    Train the sampled clients of a round one after another.
+
+    Every client is trained under its own seed, drawn at the start of the
+    round from a generator of the executor that is seeded once with the run
+    seed, so the parallel executor below reproduces the same updates for a
+    fixed seed. The global generator is left to the server: evaluation,
+    whose DataLoaders draw from it, does not change the clients' training.
+    Clients borrow a pooled model instead of a deep copy of the global model.
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        Client,
+        dataloader_dict: dict,
+        model,
+        label_dist_dict: dict=None,
+        num_class: int=None,
+        pool_size: int=1
+    ):
+        self.args = args
+        self.model_pool = ModelPool(model, pool_size=pool_size)
+        self.device = device
+        self.Client = Client
+        self.criterion = criterion
+        self.num_class = num_class
+        self.dataloader_dict = dataloader_dict
+        self.label_dist_dict = label_dist_dict if label_dist_dict is not None else dict()
+        # client seeds, seeded with the run seed set before the executor is built
+        self.seed_generator = torch.Generator()
+        self.seed_generator.manual_seed(torch.initial_seed())
+
+    def draw_client_seeds(
+        self,
+        num_of_clients: int
+    ):
+        # Draw one seed per client from the generator of the executor
+        return torch.randint(0, 2**31-1, (num_of_clients,), generator=self.seed_generator).tolist()
+
+    def build_client(
+        self,
+        client_id: str,
+        model,
+        seed: int=0
+    ):
+        # Initialize client object, the seed picks its training metrics
+        return self.Client(
+            self.args,
+            self.device,
+            self.criterion,
+            self.dataloader_dict[client_id],
+            model=model,
+            label_dict=self.label_dist_dict.get(client_id),
+            num_class=self.num_class,
+            metric_mode=train_metric_mode(self.args, seed)
+        )
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        """
+        Train the sampled clients and save their updates to the server.
+        :param server: server object, after initialize_epoch_updates
+        :param client_ids: sampled client ids of this round
+        :return: skip_client_ids: clients without training data
+        """
+        seeds = self.draw_client_seeds(len(client_ids))
+        skip_client_ids, tasks = self.split_tasks(client_ids, seeds)
+        self.train_tasks(server, tasks)
+        return skip_client_ids
+
+    def train_tasks(
+        self,
+        server,
+        tasks: list
+    ):
+        """
+        Train clients one after another and save their updates to the server.
+        :param server: server object, after initialize_epoch_updates
+        :param tasks: (client_id, seed) of the clients to train
+        """
+        for client_id, seed in tasks:
+            model = self.model_pool.acquire(server.global_model)
+            # keep the global generator untouched by local training
+            with torch.random.fork_rng(devices=self.rng_devices()):
+                torch.manual_seed(seed)
+                client = self.build_client(client_id, model=model, seed=seed)
+                if self.args.fed_alg == 'scaffold':
+                    client.set_control(
+                        server_control=server.server_control,
+                        client_control=server.client_controls[client_id]
+                    )
+                client.update_weights()
+
+            # server accumulates the updates before the model returns to the pool
+            if self.args.fed_alg == 'scaffold':
+                server.set_client_control(client_id, client.client_control)
+                server.save_train_updates(
+                    client.get_parameters(),
+                    client.result['sample'],
+                    client.result,
+                    delta_control=client.delta_control,
+                    client_id=client_id,
+                    seed=seed
+                )
+            else:
+                server.save_train_updates(
+                    client.get_parameters(),
+                    client.result['sample'],
+                    client.result,
+                    client_id=client_id,
+                    seed=seed
+                )
+            self.model_pool.release(model)
+            del client
+
+    def split_tasks(
+        self,
+        client_ids: list,
+        seeds: list
+    ):
+        # Separate clients without training data from the ones to train
+        skip_client_ids, tasks = list(), list()
+        for client_id, seed in zip(client_ids, seeds):
+            if self.dataloader_dict[client_id] is None:
+                skip_client_ids.append(client_id)
+                continue
+            tasks.append((client_id, seed))
+        return skip_client_ids, tasks
+
+    def rng_devices(self):
+        # Cuda devices whose generator is forked with the cpu one
+        if torch.device(self.device).type == 'cuda':
+            return [torch.device(self.device).index or 0]
+        return []
+
+    def close(self):
+        pass
+
+
+class ParallelRoundExecutor(RoundExecutor):
+    """
+    Train the sampled clients of a round on a persistent pool of worker processes.
+
+    Workers are forked once, so they share the already-loaded dataloaders. The
+    global weights (and the scaffold server control) are broadcast through a
+    shared-memory flat buffer, and every worker returns its client update
+    through its own shared slot. With an update codec the worker encodes the
+    client delta itself and returns the payload; the server keeps the
+    topk/randk residuals and lends each one to the worker of its client.
+    Updates are handed to the server in client order as soon as possible,
+    which keeps the aggregation identical to the sequential executor.
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        Client,
+        dataloader_dict: dict,
+        model,
+        label_dist_dict: dict=None,
+        num_class: int=None,
+        num_workers: int=2,
+        num_threads: int=1
+    ):
+        super().__init__(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            pool_size=0
+        )
+        if torch.device(device).type != 'cpu':
+            raise ValueError('Parallel client training only supports cpu devices')
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.flattener = StateDictFlattener(model.state_dict())
+
+        # shared buffers: global weights in, client updates out
+        self.global_buf = self.flattener.zeros(shared=True)
+        self.update_bufs = torch.zeros(num_workers, self.flattener.numel).share_memory_()
+        # workers encode with their own codec, the residuals come from the server
+        self.update_codec = build_update_codec(args, self.flattener.numel)
+        if self.update_codec is not None and self.update_codec.error_feedback:
+            self.residual_bufs = torch.zeros(num_workers, self.flattener.numel).share_memory_()
+        if self.args.fed_alg == 'scaffold':
+            self.server_control_buf = self.flattener.zeros(shared=True)
+            self.control_in_bufs = torch.zeros(num_workers, self.flattener.numel).share_memory_()
+            self.control_out_bufs = torch.zeros(num_workers, self.flattener.numel).share_memory_()
+            self.delta_control_bufs = torch.zeros(num_workers, self.flattener.numel).share_memory_()
+
+        # fork the workers, they inherit the data shards and the model
+        ctx = mp.get_context('fork')
+        self.result_queue = ctx.Queue()
+        self.task_queues = [ctx.Queue() for _ in range(num_workers)]
+        self.workers = list()
+        for rank in range(num_workers):
+            worker = ctx.Process(
+                target=self.worker_loop,
+                args=(rank, model),
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        seeds = self.draw_client_seeds(len(client_ids))
+        skip_client_ids, tasks = self.split_tasks(client_ids, seeds)
+
+        # broadcast global weights and server control
+        self.flattener.flatten(server.get_parameters(), out=self.global_buf)
+        if self.args.fed_alg == 'scaffold':
+            self.flattener.flatten(server.server_control, out=self.server_control_buf)
+
+        # dispatch clients to free workers
+        self.next_pos, self.pending = 0, dict()
+        free_ranks = deque(range(self.num_workers))
+        num_running = 0
+        for pos, (client_id, seed) in enumerate(tasks):
+            if len(free_ranks) == 0:
+                free_ranks.append(self.collect(server))
+                num_running -= 1
+            rank = free_ranks.popleft()
+            if self.args.fed_alg == 'scaffold':
+                self.control_in_bufs[rank].copy_(server.client_controls.get_flat(client_id))
+            if self.encodes_residual():
+                self.residual_bufs[rank].copy_(server.update_codec.residuals.get_flat(client_id))
+            self.task_queues[rank].put((pos, client_id, seed))
+            num_running += 1
+        while num_running > 0:
+            self.collect(server)
+            num_running -= 1
+        return skip_client_ids
+
+    def worker_loop(
+        self,
+        rank: int,
+        model
+    ):
+        # Entry point of the forked worker processes
+        _client_worker(self, rank, model)
+
+    def encodes_residual(self):
+        # Workers encode with error feedback, which needs the client residuals
+        return self.update_codec is not None and self.update_codec.error_feedback
+
+    def wait_result(self):
+        """
+        Wait for one finished client, raise if a worker failed.
+        :return: rank, pos, client_id, result, codec payload or None
+        """
+        while True:
+            try:
+                rank, pos, client_id, result, payload, error = self.result_queue.get(timeout=5)
+                break
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    self.close()
+                    raise RuntimeError('A client worker exited unexpectedly')
+        if error is not None:
+            self.close()
+            raise RuntimeError(f'Client {client_id} failed in worker {rank}:\n{error}')
+        return rank, pos, client_id, result, payload
+
+    def collect(
+        self,
+        server
+    ):
+        """
+        Wait for one finished client and hand the server every update that is next in order.
+        :param server: server accumulating the updates
+        :return: rank of the worker that is free again
+        """
+        rank, pos, client_id, result, payload = self.wait_result()
+        client_control, delta_control = None, None
+        if self.args.fed_alg == 'scaffold':
+            client_control = self.flattener.unflatten(self.control_out_bufs[rank].clone())
+            delta_control = self.delta_control_bufs[rank]
+        # the residual is back before the worker slot is reused
+        if self.encodes_residual():
+            server.update_codec.residuals.set(client_id, self.residual_bufs[rank].clone())
+
+        # clients finishing out of order wait in pooled buffers, payloads as they are
+        if pos != self.next_pos:
+            model_updates = payload
+            if model_updates is None:
+                model_updates = self.model_pool.take_buffer()
+                model_updates.copy_(self.update_bufs[rank])
+            if delta_control is not None: delta_control = delta_control.clone()
+            self.pending[pos] = (client_id, model_updates, result, client_control, delta_control)
+            return rank
+
+        # server append updates, in client order
+        model_updates = payload if payload is not None else self.update_bufs[rank]
+        self.save_update(server, client_id, model_updates, result, client_control, delta_control)
+        self.next_pos += 1
+        while self.next_pos in self.pending:
+            client_id, model_updates, result, client_control, delta_control = self.pending.pop(self.next_pos)
+            self.save_update(server, client_id, model_updates, result, client_control, delta_control)
+            if self.update_codec is None: self.model_pool.release_buffer(model_updates)
+            self.next_pos += 1
+        return rank
+
+    def save_update(
+        self,
+        server,
+        client_id,
+        model_updates,
+        result: dict,
+        client_control=None,
+        delta_control=None
+    ):
+        # Hand one flat client update, or its codec payload, to the server
+        if self.args.fed_alg == 'scaffold':
+            server.set_client_control(client_id, client_control)
+        server.save_train_updates(
+            model_updates,
+            result['sample'],
+            result,
+            delta_control=delta_control,
+            client_id=client_id,
+            encoded=self.update_codec is not None
+        )
+
+    def close(self):
+        # Stop the worker pool
+        for rank, worker in enumerate(self.workers):
+            if worker.is_alive(): self.task_queues[rank].put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive(): worker.terminate()
+        self.workers = list()
+
+
+class AsyncRoundExecutor(ParallelRoundExecutor):
+    """
+    Buffered asynchronous training (FedBuff) on the persistent worker pool.
+
+    Clients start on free workers from the current global weights and keep
+    training across server updates. Every run_round returns once buffer_size
+    client deltas have arrived; each delta is weighted by 1/sqrt(1+staleness),
+    where staleness counts the server updates since the client started.
+    Workers are topped up before returning, so they keep training while the
+    server aggregates and evaluates. Optional lognormal slowdowns emulate
+    heterogeneous device speeds.
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        Client,
+        dataloader_dict: dict,
+        model,
+        label_dist_dict: dict=None,
+        num_class: int=None,
+        num_workers: int=2,
+        num_threads: int=1,
+        buffer_size: int=4,
+        speed_sigma: float=0.0
+    ):
+        if args.fed_alg == 'scaffold':
+            raise ValueError('Asynchronous training does not support scaffold')
+        # per worker start weights, shared before the workers fork
+        numel = StateDictFlattener(model.state_dict()).numel
+        self.start_bufs = torch.zeros(num_workers, numel).share_memory_()
+        super().__init__(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            num_workers=num_workers,
+            num_threads=num_threads
+        )
+        self.buffer_size = buffer_size
+        self.version = 0
+        self.launch_queue = deque()
+        self.free_ranks = deque(range(num_workers))
+        self.running = dict()
+
+        # fixed slowdown per client, the fastest client runs at full speed
+        client_ids = [key for key in dataloader_dict.keys() if key not in ['dev', 'test']]
+        factors = np.random.RandomState(0).lognormal(0, speed_sigma, len(client_ids))
+        self.slowdowns = dict(zip(client_ids, (factors / factors.min()).tolist()))
+
+    def worker_loop(
+        self,
+        rank: int,
+        model
+    ):
+        # Entry point of the forked worker processes
+        _async_client_worker(self, rank, model)
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        seeds = self.draw_client_seeds(len(client_ids))
+        skip_client_ids, tasks = self.split_tasks(client_ids, seeds)
+        # clients sampled last round that never started are dropped
+        self.launch_queue = deque(tasks)
+        self.flattener.flatten(server.get_parameters(), out=self.global_buf)
+
+        num_arrived = 0
+        while num_arrived < self.buffer_size:
+            self.launch()
+            if len(self.running) == 0: break
+            rank, _, client_id, result, _ = self.wait_result()
+            _, start_version = self.running.pop(rank)
+            server.save_train_updates(
+                self.update_bufs[rank],
+                result['sample'],
+                result,
+                client_id=client_id,
+                staleness=self.version - start_version
+            )
+            self.free_ranks.append(rank)
+            num_arrived += 1
+
+        # keep workers busy while the server aggregates
+        self.launch()
+        self.version += 1
+        return skip_client_ids
+
+    def launch(self):
+        # Start queued clients on free workers from the current global weights
+        while len(self.free_ranks) > 0 and len(self.launch_queue) > 0:
+            client_id, seed = self.launch_queue.popleft()
+            rank = self.free_ranks.popleft()
+            self.start_bufs[rank].copy_(self.global_buf)
+            self.running[rank] = (client_id, self.version)
+            self.task_queues[rank].put((None, client_id, seed, self.slowdowns.get(client_id, 1.0)))
+
+
+class DistributedRoundExecutor(RoundExecutor):
+    """
+    Train the sampled clients of a round on the ranks of a gloo process group.
+
+    Every rank runs the training script in lockstep. Rank 0 hosts the server
+    and broadcasts the global weights (and the scaffold server control) with
+    the client seeds; ranks 1 to world_size - 1 train the sampled clients
+    whose data they loaded, accumulate them into their own aggregator, and
+    the partial sums are reduced onto rank 0. Update codecs encode on the
+    client ranks, which also keep the residuals of their own clients. Client results are gathered in
+    client order. Client ranks keep an empty update list, so the training
+    loop skips aggregation and evaluation on them.
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        Client,
+        dataloader_dict: dict,
+        model,
+        label_dist_dict: dict=None,
+        num_class: int=None
+    ):
+        self.rank, self.world_size = init_distributed(args)
+        super().__init__(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            pool_size=0 if self.rank == 0 else 1
+        )
+        self.flattener = StateDictFlattener(model.state_dict())
+        self.global_buf = self.flattener.zeros()
+        self.reduce_buf = self.flattener.zeros()
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        # client seeds and global weights from the server rank
+        seeds = [self.draw_client_seeds(len(client_ids)) if self.rank == 0 else None]
+        dist.broadcast_object_list(seeds, src=0)
+        self.broadcast_state(server)
+
+        # train the sampled clients of this rank
+        skip_client_ids, tasks = list(), list()
+        if self.rank != 0:
+            server.initialize_epoch_updates(server.epoch)
+            owned = [(client_id, seed) for client_id, seed in zip(client_ids, seeds[0]) if client_id in self.dataloader_dict]
+            skip_client_ids, tasks = self.split_tasks(
+                [client_id for client_id, _ in owned],
+                [seed for _, seed in owned]
+            )
+            self.train_tasks(server, tasks)
+
+        # sum the client updates on the server rank
+        server.aggregate_edges()
+        self.reduce_sum(server.aggregator.sum_buf)
+        if self.args.fed_alg == 'scaffold': self.reduce_sum(server.control_aggregator.sum_buf)
+        summary = {
+            'clients': [client_id for client_id, _ in tasks],
+            'skip': skip_client_ids,
+            'num_samples': list(server.num_samples_list),
+            'results': list(server.result_dict[server.epoch]['train']),
+            'total_weight': server.aggregator.total_weight,
+            'num_updates': server.aggregator.num_updates,
+            'comm_bytes': dict(server.comm_bytes)
+        }
+        summaries = [None] * self.world_size if self.rank == 0 else None
+        dist.gather_object(summary, summaries, dst=0)
+        if self.rank != 0:
+            # nothing to aggregate on the client ranks
+            server.num_samples_list = list()
+            return skip_client_ids
+        return self.merge_summaries(server, client_ids, summaries[1:])
+
+    def broadcast_state(
+        self,
+        server
+    ):
+        # Broadcast the global weights and the scaffold server control from rank 0
+        if self.rank == 0: self.flattener.flatten(server.get_parameters(), out=self.global_buf)
+        dist.broadcast(self.global_buf, src=0)
+        if self.rank != 0: self.flattener.load_into(server.global_model, self.global_buf)
+        if self.args.fed_alg == 'scaffold':
+            if self.rank == 0: self.flattener.flatten(server.server_control, out=self.global_buf)
+            dist.broadcast(self.global_buf, src=0)
+            if self.rank != 0:
+                server.server_control = self.flattener.unflatten(self.global_buf.clone())
+                server.set_control_device(server.server_control, True)
+
+    def reduce_sum(
+        self,
+        flat
+    ):
+        # Sum a flat buffer over the ranks into rank 0, through a cpu buffer for gloo
+        self.reduce_buf.copy_(flat)
+        dist.reduce(self.reduce_buf, dst=0)
+        if self.rank == 0: flat.copy_(self.reduce_buf)
+
+    def merge_summaries(
+        self,
+        server,
+        client_ids: list,
+        summaries: list
+    ):
+        # Hand the reduced updates and the client results to the server, in client order
+        order = {client_id: pos for pos, client_id in enumerate(client_ids)}
+        entries, skip_client_ids = list(), list()
+        for summary in summaries:
+            entries += list(zip(summary['clients'], summary['num_samples'], summary['results']))
+            skip_client_ids += summary['skip']
+            server.aggregator.total_weight += summary['total_weight']
+            server.aggregator.num_updates += summary['num_updates']
+            if self.args.fed_alg == 'scaffold': server.control_aggregator.num_updates += summary['num_updates']
+            for key in summary['comm_bytes']:
+                server.comm_bytes[key] = server.comm_bytes.get(key, 0) + summary['comm_bytes'][key]
+        entries.sort(key=lambda entry: order[entry[0]])
+        for _, num_sample, result in entries:
+            server.num_samples_list.append(num_sample)
+            server.result_dict[server.epoch]['train'].append(result)
+        return sorted(skip_client_ids, key=lambda client_id: order[client_id])
+
+
+class NetworkRoundExecutor(RoundExecutor):
+    """
+    Train the sampled clients of a round on client processes over tcp sockets.
+
+    The server listens on host:port and forks num_processes local client
+    processes, each holding a round-robin share of the clients and one
+    persistent connection; remote NetworkClient processes can connect the
+    same way. Every round each session receives the global weights once
+    with its (client_id, seed) list and streams back one update per client.
+    Sessions run concurrently on an asyncio loop and updates are handed to
+    the server in client order. Serialization and transfer time of the round
+    are reported in server.comm_time.
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        Client,
+        dataloader_dict: dict,
+        model,
+        label_dist_dict: dict=None,
+        num_class: int=None,
+        num_processes: int=2,
+        num_threads: int=1,
+        host: str='127.0.0.1',
+        port: int=0
+    ):
+        super().__init__(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            pool_size=0
+        )
+        if torch.device(device).type != 'cpu':
+            raise ValueError('Network client training only supports cpu devices')
+        self.num_threads = num_threads
+        self.flattener = StateDictFlattener(model.state_dict())
+        self.global_buf = self.flattener.zeros()
+        if self.args.fed_alg == 'scaffold': self.server_control_buf = self.flattener.zeros()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.host, self.port = host, self.listener.getsockname()[1]
+
+        # fork the local client processes, they inherit the data shards and the model
+        client_ids = [key for key in dataloader_dict.keys() if key not in ['dev', 'test']]
+        ctx = mp.get_context('fork')
+        self.processes = list()
+        for rank in range(num_processes):
+            process = ctx.Process(
+                target=_network_client_process,
+                args=(self, model, client_ids[rank::num_processes]),
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+
+        # one session per client process
+        self.listener.setblocking(False)
+        self.loop = asyncio.new_event_loop()
+        self.sessions, self.session_of = list(), dict()
+        self.loop.run_until_complete(self.accept(num_processes))
+
+    async def accept(
+        self,
+        num_sessions: int
+    ):
+        # Accept client processes until num_sessions are registered
+        while len(self.sessions) < num_sessions:
+            sock, _ = await asyncio.wait_for(self.loop.sock_accept(self.listener), timeout=60)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            meta, _, _ = await recv_message(sock)
+            for client_id in meta['client_ids']: self.session_of[client_id] = len(self.sessions)
+            self.sessions.append(sock)
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        seeds = self.draw_client_seeds(len(client_ids))
+        skip_client_ids, tasks = self.split_tasks(client_ids, seeds)
+        self.flattener.flatten(server.get_parameters(), out=self.global_buf)
+        if self.args.fed_alg == 'scaffold':
+            self.flattener.flatten(server.server_control, out=self.server_control_buf)
+
+        # group the clients by session, keep their position for ordered commits
+        session_tasks = dict()
+        for pos, (client_id, seed) in enumerate(tasks):
+            session_tasks.setdefault(self.session_of[client_id], list()).append((pos, client_id, seed))
+        self.next_pos, self.pending = 0, dict()
+        self.timing = {'serialize': 0.0, 'transfer': 0.0}
+        self.loop.run_until_complete(self.gather([
+            self.run_session(server, self.sessions[session], session_tasks[session])
+            for session in session_tasks
+        ]))
+        server.comm_time.update(self.timing)
+        return skip_client_ids
+
+    async def gather(
+        self,
+        coroutines: list
+    ):
+        # Run the coroutines concurrently on the executor loop
+        return await asyncio.gather(*coroutines)
+
+    async def run_session(
+        self,
+        server,
+        sock,
+        tasks: list
+    ):
+        # Send the round to one session and commit its streamed updates
+        session_start, busy_time = time.time(), 0.0
+        tensors = {'global': self.global_buf}
+        if self.args.fed_alg == 'scaffold': tensors['server_control'] = self.server_control_buf
+        await send_message(
+            sock,
+            {'type': 'round', 'tasks': [[client_id, seed] for _, client_id, seed in tasks]},
+            tensors
+        )
+        for pos, _, _ in tasks:
+            meta, reply_tensors, _ = await recv_message(sock)
+            decode_start = time.time()
+            self.commit(server, pos, meta, reply_tensors)
+            busy_time += meta['train_time'] + meta['serialize_time'] + time.time() - decode_start
+            self.timing['serialize'] += meta['serialize_time'] + time.time() - decode_start
+        self.timing['transfer'] += max(0.0, time.time() - session_start - busy_time)
+
+    def commit(
+        self,
+        server,
+        pos: int,
+        meta: dict,
+        tensors: dict
+    ):
+        # Hand every update that is next in client order to the server
+        self.pending[pos] = (meta, tensors)
+        while self.next_pos in self.pending:
+            meta, tensors = self.pending.pop(self.next_pos)
+            if self.update_encoded(meta):
+                model_updates = join_payload(tensors, meta['payload'])
+            else:
+                model_updates = tensors['update']
+            server.save_train_updates(
+                model_updates,
+                meta['num_sample'],
+                meta['result'],
+                delta_control=tensors.get('delta_control'),
+                client_id=meta['client_id'],
+                encoded=self.update_encoded(meta)
+            )
+            self.next_pos += 1
+
+    def update_encoded(
+        self,
+        meta: dict
+    ):
+        # The client sent a codec payload rather than its weights
+        return 'payload' in meta
+
+    def close(self):
+        # Close the sessions and stop the local client processes
+        if len(self.sessions) > 0:
+            self.loop.run_until_complete(self.gather([
+                send_message(sock, {'type': 'close'}) for sock in self.sessions
+            ]))
+        for sock in self.sessions: sock.close()
+        self.sessions = list()
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive(): process.terminate()
+        self.processes = list()
+        self.listener.close()
+        self.loop.close()
+
+
+class StackedRoundExecutor(RoundExecutor):
+    """
+    Train the sampled clients of a round in chunks of K stacked clients.
+
+    Each chunk runs its local steps together through StackedClientTrainer,
+    which removes the per-client Python and kernel launch overhead of tiny
+    models. Updates are handed to the server in client order.
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        Client,
+        dataloader_dict: dict,
+        model,
+        label_dist_dict: dict=None,
+        num_class: int=None,
+        stack_size: int=16
+    ):
+        super().__init__(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            pool_size=0
+        )
+        self.stack_size = stack_size
+        self.trainer = StackedClientTrainer(
+            args,
+            device,
+            criterion,
+            copy.deepcopy(model)
+        )
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        seeds = self.draw_client_seeds(len(client_ids))
+        skip_client_ids, tasks = self.split_tasks(client_ids, seeds)
+
+        for start in range(0, len(tasks), self.stack_size):
+            chunk = tasks[start:start+self.stack_size]
+            # the chunk trains under the seed of its first client
+            with torch.random.fork_rng(devices=self.rng_devices()):
+                torch.manual_seed(chunk[0][1])
+                client_updates = self.trainer.train(
+                    server.global_model,
+                    [self.dataloader_dict[client_id] for client_id, _ in chunk],
+                    metric_modes=[train_metric_mode(self.args, seed) for _, seed in chunk]
+                )
+            # server append updates
+            for (client_id, seed), (model_updates, result) in zip(chunk, client_updates):
+                server.save_train_updates(
+                    model_updates,
+                    result['sample'],
+                    result,
+                    client_id=client_id,
+                    seed=seed
+                )
+        return skip_client_ids
+
+
+def _client_worker(
+    executor,
+    rank: int,
+    model
+):
+    # Worker loop: load global weights, train one client, write back the update
+    torch.set_num_threads(executor.num_threads)
+    flattener = executor.flattener
+    while True:
+        task = executor.task_queues[rank].get()
+        if task is None: break
+        pos, client_id, seed = task
+        try:
+            flattener.load_into(model, executor.global_buf)
+            torch.manual_seed(seed)
+            client = executor.build_client(client_id, model=model, seed=seed)
+            if executor.args.fed_alg == 'scaffold':
+                client.set_control(
+                    server_control=flattener.unflatten(executor.server_control_buf),
+                    client_control=flattener.unflatten(executor.control_in_bufs[rank])
+                )
+            client.update_weights()
+            flattener.flatten(client.get_parameters(), out=executor.update_bufs[rank])
+            payload = None
+            if executor.update_codec is not None:
+                # encode the delta here, as a network client does
+                executor.update_bufs[rank].sub_(executor.global_buf)
+                payload = executor.update_codec.encode(
+                    executor.update_bufs[rank],
+                    client_id,
+                    seed=seed,
+                    residual=executor.residual_bufs[rank] if executor.encodes_residual() else None
+                )
+            if executor.args.fed_alg == 'scaffold':
+                flattener.flatten(client.client_control, out=executor.control_out_bufs[rank])
+                flattener.flatten(client.delta_control, out=executor.delta_control_bufs[rank])
+            executor.result_queue.put((rank, pos, client_id, client.result, payload, None))
+        except Exception:
+            executor.result_queue.put((rank, pos, client_id, None, None, traceback.format_exc()))
+
+
+def _async_client_worker(
+    executor,
+    rank: int,
+    model
+):
+    # Worker loop: train one client from its start weights, write back the delta
+    torch.set_num_threads(executor.num_threads)
+    flattener = executor.flattener
+    while True:
+        task = executor.task_queues[rank].get()
+        if task is None: break
+        pos, client_id, seed, slowdown = task
+        try:
+            start_time = time.time()
+            flattener.load_into(model, executor.start_bufs[rank])
+            torch.manual_seed(seed)
+            client = executor.build_client(client_id, model=model, seed=seed)
+            client.update_weights()
+            # emulate a slower device
+            if slowdown > 1: time.sleep((time.time() - start_time) * (slowdown - 1))
+            flattener.flatten(client.get_parameters(), out=executor.update_bufs[rank])
+            executor.update_bufs[rank].sub_(executor.start_bufs[rank])
+            executor.result_queue.put((rank, pos, client_id, client.result, None, None))
+        except Exception:
+            executor.result_queue.put((rank, pos, client_id, None, None, traceback.format_exc()))
+
+
+def _network_client_process(
+    executor,
+    model,
+    client_ids: list
+):
+    # Forked client process: serve the clients of this process over one connection
+    torch.set_num_threads(executor.num_threads)
+    executor.listener.close()
+    NetworkClient(
+        executor,
+        model,
+        client_ids,
+        host=executor.host,
+        port=executor.port
+    ).run()
+
+
+def build_round_executor(
+    args,
+    device,
+    criterion,
+    Client,
+    dataloader_dict: dict,
+    model,
+    label_dist_dict: dict=None,
+    num_class: int=None
+):
+    """
+    Return the round executor selected by args.distributed, args.async_buffer, args.net_clients,
+    args.stack_clients and args.client_workers, wrapped by the virtual-clock simulator when
+    args.simulate is set.
+    """
+    async_buffer = getattr(args, 'async_buffer', 0)
+    simulate = getattr(args, 'simulate', False)
+    if simulate and async_buffer > 0:
+        raise ValueError('Simulated rounds need synchronous training')
+    _, world_size = init_distributed(args)
+    net_clients = getattr(args, 'net_clients', 0)
+    if net_clients > 0 and (async_buffer > 0 or world_size > 1):
+        raise ValueError('Network clients need synchronous training in one process group')
+    if world_size > 1:
+        if simulate or async_buffer > 0:
+            raise ValueError('Distributed runs need synchronous training without simulation')
+        return DistributedRoundExecutor(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class
+        )
+    num_workers = getattr(args, 'client_workers', 0)
+    if num_workers > 1 and torch.device(device).type != 'cpu':
+        logging.info('Parallel client training needs a cpu device, train clients sequentially')
+        num_workers = 0
+    stack_size = getattr(args, 'stack_clients', 0)
+    if async_buffer > 0:
+        executor = AsyncRoundExecutor(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            num_workers=max(1, getattr(args, 'client_workers', 0)),
+            num_threads=getattr(args, 'worker_threads', 1),
+            buffer_size=async_buffer,
+            speed_sigma=getattr(args, 'client_speed_sigma', 0.0)
+        )
+    elif net_clients > 0:
+        executor = NetworkRoundExecutor(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            num_processes=net_clients,
+            num_threads=getattr(args, 'worker_threads', 1),
+            host=getattr(args, 'net_host', '127.0.0.1'),
+            port=getattr(args, 'net_port', 0)
+        )
+    elif stack_size > 1:
+        executor = StackedRoundExecutor(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            stack_size=stack_size
+        )
+    elif num_workers > 1:
+        executor = ParallelRoundExecutor(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class,
+            num_workers=num_workers,
+            num_threads=getattr(args, 'worker_threads', 1)
+        )
+    else:
+        executor = RoundExecutor(
+            args,
+            device,
+            criterion,
+            Client,
+            dataloader_dict,
+            model=model,
+            label_dist_dict=label_dist_dict,
+            num_class=num_class
+        )
+    if simulate:
+        executor = SimulatedRoundExecutor(
+            executor,
+            RoundSimulator(args, dataloader_dict, model)
+        )
+    return executor
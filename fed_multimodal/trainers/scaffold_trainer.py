@@ -12,10 +12,11 @@ from torch.utils.data import DataLoader, Dataset
 from sklearn.metrics import accuracy_score, recall_score
 
 # import optimizer
-from .optimizer import ScaffoldOptimizer, NovaOptimizer
+from .optimizer import ScaffoldOptimizer, NovaOptimizer, optimizer_options
 
 warnings.filterwarnings('ignore')
 from .evaluation import EvalMetric
+from .mixed_precision import autocast_context
 
 
 class ClientScaffold(object):
@@ -27,7 +28,8 @@ class ClientScaffold(object):
         dataloader, 
         model,
         label_dict=None,
-        num_class=None
+        num_class=None,
+        metric_mode='full'
     ):
         self.args = args
         self.model = model
@@ -35,6 +37,7 @@ class ClientScaffold(object):
         self.criterion = criterion
         self.dataloader = dataloader
         self.multilabel = True if args.dataset == 'ptb-xl' else False
+        self.metric_mode = metric_mode
         
         
     def get_parameters(self):
@@ -62,27 +65,36 @@ class ClientScaffold(object):
         server_control, 
         client_control
     ):
+        # controls are read only, the client keeps its own device copy
         self.server_control = server_control
-        self.client_control = client_control
-        self.set_control_device(self.client_control, True)
+        self.client_control = self.set_control_device(client_control, True)
     
     def update_weights(self):
         # Set mode to train model
         self.model.train()
 
         # initialize eval
-        self.eval = EvalMetric(self.multilabel)
+        self.eval = EvalMetric(self.multilabel, mode=self.metric_mode)
         
         # optimizer
         optimizer = ScaffoldOptimizer(
             self.model.parameters(), 
             lr=self.args.learning_rate,
             weight_decay=1e-05,
-            momentum=0.9
+            momentum=0.9,
+            param_names=[name for name, _ in self.model.named_parameters()],
+            **optimizer_options(self.args)
+        )
+        # correction c - ci, computed once for all local steps
+        optimizer.set_control(
+            server_control=self.server_control,
+            client_control=self.client_control
         )
 
-        # last global model
-        last_global_model = copy.deepcopy(self.model)
+        # last global weights
+        last_global_state = {
+            name: param.detach().clone() for name, param in self.model.state_dict().items()
+        }
         # get total training batch number
         n_total_bs = int(self.args.local_epochs * len(self.dataloader))
         
@@ -96,12 +108,15 @@ class ClientScaffold(object):
                 l_a, l_b = l_a.to(self.device), l_b.to(self.device)
                 
                 # forward
-                outputs, _ = self.model(
-                    x_a.float(), 
-                    x_b.float(), 
-                    l_a, 
-                    l_b
-                )
+                with autocast_context(self.args, self.device):
+                    outputs, _ = self.model(
+                        x_a.float(), 
+                        x_b.float(), 
+                        l_a, 
+                        l_b
+                    )
+                # loss in fp32
+                outputs = outputs.float()
 
                 if not self.multilabel: 
                     outputs = torch.log_softmax(outputs, dim=1)
@@ -118,10 +133,7 @@ class ClientScaffold(object):
                     10.0
                 )
 
-                optimizer.step(
-                    server_control=copy.deepcopy(self.server_control),
-                    client_control=copy.deepcopy(self.client_control)
-                )
+                optimizer.step()
                 
                 # save results
                 if not self.multilabel: 
@@ -138,8 +150,8 @@ class ClientScaffold(object):
                     )
         # get deltas
         delta_model = self.get_delta_model(
-            last_global_model, 
-            self.model
+            last_global_state, 
+            self.model.state_dict()
         )
         
         # update contral variables
@@ -151,12 +163,9 @@ class ClientScaffold(object):
             lr=self.args.learning_rate,
         )
 
-        # save control variables
-        self.client_control = copy.deepcopy(client_control)
-        self.delta_control = copy.deepcopy(delta_control)
-
-        # set to cpu devices
-        self.set_control_device(self.client_control, False)
+        # save control variables, client control on cpu devices
+        self.client_control = self.set_control_device(client_control, False)
+        self.delta_control = delta_control
 
         # epoch train results
         if not self.multilabel:
@@ -165,12 +174,12 @@ class ClientScaffold(object):
             self.result = self.eval.multilabel_summary()
 
 
-    def get_delta_model(self, model0, model1):
+    def get_delta_model(self, state_dict0, state_dict1):
         """ return a dict: {name: params}
         """
         state_dict = {}
-        for name, param0 in model0.state_dict().items():
-            param1 = model1.state_dict()[name]
+        for name, param0 in state_dict0.items():
+            param1 = state_dict1[name]
             state_dict[name] = param0.detach() - param1.detach()
         return state_dict
 
@@ -182,8 +191,8 @@ class ClientScaffold(object):
         steps, 
         lr
     ):
-        new_control = copy.deepcopy(client_control)
-        delta_control = copy.deepcopy(client_control)
+        new_control = dict(client_control)
+        delta_control = dict(client_control)
 
         for name in delta_model.keys():
             c = server_control[name]
@@ -191,8 +200,8 @@ class ClientScaffold(object):
             delta = delta_model[name]
 
             new_ci = ci.data - c.data + delta.data / (steps * lr)
-            new_control[name].data = new_ci
-            delta_control[name].data = ci.data - new_ci
+            new_control[name] = new_ci
+            delta_control[name] = ci.data - new_ci
         return new_control, delta_control
 
     def set_control_device(
@@ -200,9 +209,8 @@ class ClientScaffold(object):
         control, 
         device=True
     ):
-        for name in control.keys():
-            if device == True:
-                control[name] = control[name].to(self.device)
-            else:
-                control[name] = control[name].cpu()
+        # Return a copy of the control dict on the device or on cpu
+        if device == True:
+            return {name: value.to(self.device) for name, value in control.items()}
+        return {name: value.cpu() for name, value in control.items()}
     
\ No newline at end of file
@@ -0,0 +1,153 @@
+import torch
+
+
+# algorithms that train clients with plain local sgd and step a server optimizer
+server_opt_algs = ['fed_opt', 'fed_avgm', 'fed_adam', 'fed_yogi', 'fed_adagrad']
+
+
+class ServerOptimizer(object):
+    """
+    Server optimizer on the flat global weights.
+
+    Every round the averaged client weights give the pseudo-gradient
+    delta = w_avg - w, and step updates the flat global weights in place with
+    optimizer state that persists across rounds. Only model parameters are
+    optimized, buffers (e.g. BatchNorm statistics) take the average.
+    """
+    def __init__(
+        self,
+        param_mask,
+        lr: float
+    ):
+        self.param_mask = param_mask
+        self.lr = lr
+        self.state = dict()
+
+    def step(
+        self,
+        flat_weights,
+        w_avg
+    ):
+        """
+        Update the global weights with the averaged client weights.
+        :param flat_weights: flat global weights, updated in place
+        :param w_avg: flat average of the client weights
+        """
+        with torch.no_grad():
+            delta = w_avg - flat_weights
+            self.update(flat_weights, delta)
+            flat_weights.copy_(torch.where(self.param_mask, flat_weights, w_avg))
+
+    def update(
+        self,
+        flat_weights,
+        delta
+    ):
+        raise NotImplementedError
+
+
+class ServerSGD(ServerOptimizer):
+    """
+    SGD with momentum on the pseudo-gradient -delta / grad_scale.
+
+    fed_opt uses grad_scale = client learning rate, as the original torch SGD
+    server step did; FedAvgM uses grad_scale = 1.
+    """
+    def __init__(
+        self,
+        param_mask,
+        lr: float,
+        momentum: float=0.9,
+        grad_scale: float=1.0
+    ):
+        super().__init__(param_mask, lr)
+        self.momentum = momentum
+        self.grad_scale = grad_scale
+
+    def update(
+        self,
+        flat_weights,
+        delta
+    ):
+        # buf = momentum * buf + g, w = w - lr * buf, with g = -delta / grad_scale
+        if 'momentum_buffer' not in self.state:
+            self.state['momentum_buffer'] = torch.zeros_like(delta)
+        buf = self.state['momentum_buffer']
+        buf.mul_(self.momentum).sub_(delta, alpha=1.0 / self.grad_scale)
+        flat_weights.sub_(buf, alpha=self.lr)
+
+
+class ServerAdaptive(ServerOptimizer):
+    """
+    FedAdagrad, FedAdam and FedYogi from Reddi et al., Adaptive Federated Optimization.
+    """
+    def __init__(
+        self,
+        param_mask,
+        lr: float,
+        method: str='adam',
+        beta1: float=0.9,
+        beta2: float=0.99,
+        tau: float=1e-3
+    ):
+        super().__init__(param_mask, lr)
+        if method not in ['adagrad', 'adam', 'yogi']:
+            raise ValueError(f'Server optimizer not support {method}')
+        self.method = method
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.tau = tau
+
+    def update(
+        self,
+        flat_weights,
+        delta
+    ):
+        # m = beta1 * m + (1 - beta1) * delta, w = w + lr * m / (sqrt(v) + tau)
+        if 'exp_avg' not in self.state:
+            self.state['exp_avg'] = torch.zeros_like(delta)
+            self.state['exp_avg_sq'] = torch.full_like(delta, self.tau**2)
+        exp_avg, exp_avg_sq = self.state['exp_avg'], self.state['exp_avg_sq']
+        exp_avg.mul_(self.beta1).add_(delta, alpha=1 - self.beta1)
+        delta_sq = delta * delta
+        if self.method == 'adagrad':
+            exp_avg_sq.add_(delta_sq)
+        elif self.method == 'adam':
+            exp_avg_sq.mul_(self.beta2).add_(delta_sq, alpha=1 - self.beta2)
+        else:
+            exp_avg_sq.addcmul_(torch.sign(exp_avg_sq - delta_sq), delta_sq, value=-(1 - self.beta2))
+        flat_weights.addcdiv_(exp_avg, exp_avg_sq.sqrt().add_(self.tau), value=self.lr)
+
+
+def build_server_optimizer(
+    args,
+    param_mask
+):
+    """
+    Return the server optimizer of args.fed_alg.
+    :param args: arguments, global_learning_rate and the server_* settings
+    :param param_mask: flat bool mask of the model parameters
+    :return: server optimizer
+    """
+    beta1 = getattr(args, 'server_beta1', 0.9)
+    if args.fed_alg == 'fed_opt':
+        return ServerSGD(
+            param_mask,
+            lr=args.global_learning_rate,
+            momentum=0.9,
+            grad_scale=args.learning_rate
+        )
+    elif args.fed_alg == 'fed_avgm':
+        return ServerSGD(
+            param_mask,
+            lr=args.global_learning_rate,
+            momentum=beta1
+        )
+    return ServerAdaptive(
+        param_mask,
+        lr=args.global_learning_rate,
+        method=args.fed_alg.replace('fed_', ''),
+        beta1=beta1,
+        beta2=getattr(args, 'server_beta2', 0.99),
+        tau=getattr(args, 'server_tau', 1e-3)
+    )
@@ -8,6 +8,14 @@ from copy import deepcopy
 from torch.utils.tensorboard import SummaryWriter
 
 from .evaluation import EvalMetric
+from .eval_cache import build_eval_set, eval_threads
+from .aggregator import StreamingAggregator
+from .edge_aggregator import EdgeAggregator, load_edge_map
+from .control_store import ControlVariateStore
+from .server_optimizer import server_opt_algs, build_server_optimizer
+from .update_codec import build_update_codec
+from .distributed import is_main_rank
+from .mixed_precision import autocast_context
 
 # logging format
 import logging
@@ -35,25 +43,83 @@ class Server(object):
         self.client_ids = client_ids
         self.multilabel = True if args.dataset == 'ptb-xl' else False
         self.model_setting_str = self.get_model_setting()
+        self.aggregator = StreamingAggregator(model.state_dict())
+        # clients send deltas through the codec, or their full weights
+        self.update_codec = build_update_codec(
+            args,
+            self.aggregator.flattener.numel,
+            device=self.aggregator.device
+        )
+        # async clients send deltas from the weights they started with
+        self.async_mode = getattr(args, 'async_buffer', 0) > 0
+        if self.update_codec is not None or self.async_mode:
+            self.round_base = torch.zeros_like(self.aggregator.sum_buf)
+        if self.update_codec is not None:
+            self.codec_delta = torch.zeros_like(self.aggregator.sum_buf)
+        self.comm_bytes = {'upload': 0, 'download': 0}
+        self.comm_time = dict()
+        self.staleness_list = list()
+        self.start_time = time.time()
         
         if self.args.fed_alg == 'scaffold':
+            if self.async_mode:
+                raise ValueError('Asynchronous training does not support scaffold')
             self.server_control = self.init_control(model)
             self.set_control_device(self.server_control, True)
-            self.client_controls = {
-                client_id: self.init_control(model) for client_id in self.client_ids
-            }
-        elif self.args.fed_alg == 'fed_opt':
-            self.global_optimizer = self._initialize_global_optimizer()
+            # client controls are created on first participation
+            self.client_controls = ControlVariateStore(
+                model.state_dict(),
+                dtype=torch.float16 if getattr(self.args, 'control_dtype', 'fp32') == 'fp16' else torch.float32,
+                hot_size=getattr(self.args, 'control_hot_clients', 0),
+                spill_dir=getattr(self.args, 'control_spill_dir', None)
+            )
+            self.control_aggregator = StreamingAggregator(self.server_control)
+        elif self.args.fed_alg in server_opt_algs:
+            self.global_weights = torch.zeros_like(self.aggregator.sum_buf)
+            self.global_optimizer = build_server_optimizer(
+                self.args,
+                self.get_param_mask()
+            )
+
+        # two-tier topology: clients report to edge aggregators, created on first use
+        self.edge_map = load_edge_map(args, client_ids)
+        self.edges = dict()
+        if len(self.edge_map) > 0 and self.async_mode:
+            raise ValueError('Asynchronous training does not support edge aggregators')
             
-    def _initialize_global_optimizer(self):
-        # global optimizer
-        global_optimizer = torch.optim.SGD(
-            self.global_model.parameters(),
-            lr=self.args.global_learning_rate,
-            momentum=0.9,
-            weight_decay=0.0
-        )
-        return global_optimizer
+    def get_param_mask(self):
+        # Flat bool mask of the model parameters in the aggregation buffer
+        flattener = self.aggregator.flattener
+        param_names = set(dict(self.global_model.named_parameters()).keys())
+        param_mask = torch.zeros(flattener.numel, dtype=torch.bool, device=self.aggregator.device)
+        for idx, key in enumerate(flattener.keys):
+            if key in param_names: param_mask[flattener.offsets[idx]:flattener.offsets[idx+1]] = True
+        return param_mask
+
+    def get_client_aggregators(
+        self,
+        client_id
+    ):
+        # Aggregators of a client update: its edge, or the server
+        edge = self.edge_map.get(client_id)
+        if edge is None:
+            return self.aggregator, getattr(self, 'control_aggregator', None)
+        if edge not in self.edges:
+            self.edges[edge] = EdgeAggregator(
+                self.global_model.state_dict(),
+                self.server_control if self.args.fed_alg == 'scaffold' else None
+            )
+        return self.edges[edge].aggregator, self.edges[edge].control_aggregator
+
+    def aggregate_edges(self):
+        """
+        Forward the combined update of every edge to the server aggregators.
+        """
+        model_bytes = self.aggregator.flattener.numel * 4
+        for edge in self.edges.values():
+            if not edge.forward(self.aggregator, getattr(self, 'control_aggregator', None)): continue
+            self.comm_bytes['edge_upload'] = self.comm_bytes.get('edge_upload', 0) + model_bytes
+            if self.args.fed_alg == 'scaffold': self.comm_bytes['edge_upload'] += model_bytes
 
     def set_client_control(
         self,
@@ -94,6 +160,7 @@ class Server(object):
         )
         
         self.best_test_dict = list()
+        self.time_to_target = None
         
     def get_model_setting(self):
         # Return model setting
@@ -166,11 +233,14 @@ class Server(object):
             model_setting_str += '_hid'+str(self.args.hid_size)
         model_setting_str += '_le'+str(self.args.local_epochs)
         model_setting_str += '_lr' + str(self.args.learning_rate).replace('.', '')
-        if self.args.fed_alg == 'fed_opt': model_setting_str += '_gl'+str(self.args.global_learning_rate).replace('.', '')
+        if self.args.fed_alg in server_opt_algs: model_setting_str += '_gl'+str(self.args.global_learning_rate).replace('.', '')
         model_setting_str += '_bs'+str(self.args.batch_size)
         model_setting_str += '_sr'+str(self.args.sample_rate).replace('.', '')
         model_setting_str += '_ep'+str(self.args.num_epochs)
         if self.args.fed_alg == 'fed_prox': model_setting_str += '_mu'+str(self.args.mu).replace('.', '')
+        update_codec = getattr(self.args, 'update_codec', 'none')
+        if update_codec in ['topk', 'randk']: model_setting_str += '_'+update_codec+str(self.args.codec_ratio).replace('.', '')
+        elif update_codec != 'none': model_setting_str += '_'+update_codec
         
         # attention str
         if self.args.att: self.att = f'{self.args.att_name}'
@@ -201,9 +271,14 @@ class Server(object):
     def initialize_epoch_updates(self, epoch):
         # Initialize updates
         self.epoch = epoch
-        self.model_updates = list()
         self.num_samples_list = list()
-        self.delta_controls = list()
+        self.aggregator.reset()
+        if self.args.fed_alg == 'scaffold': self.control_aggregator.reset()
+        if self.update_codec is not None or self.async_mode:
+            self.aggregator.flattener.flatten(self.global_model.state_dict(), out=self.round_base)
+        self.comm_bytes = {'upload': 0, 'download': 0}
+        self.comm_time = dict()
+        self.staleness_list = list()
         self.result_dict[self.epoch] = dict()
         self.result_dict[self.epoch]['train'] = list()
         self.result_dict[self.epoch]['dev'] = list()
@@ -244,40 +319,43 @@ class Server(object):
 
         # initialize eval
         self.eval = EvalMetric(self.multilabel)
-        for batch_idx, batch_data in enumerate(dataloader):
-                
-            self.global_model.zero_grad()
-            if self.args.modality == "multimodal":
-                x_a, x_b, l_a, l_b, y = batch_data
-                x_a, x_b, y = x_a.to(self.device), x_b.to(self.device), y.to(self.device)
-                l_a, l_b = l_a.to(self.device), l_b.to(self.device)
-                
-                # forward
-                outputs, _ = self.global_model(
-                    x_a.float(), x_b.float(), l_a, l_b
-                )
-            else:
-                x, l, y = batch_data
-                x, l, y = x.to(self.device), l.to(self.device), y.to(self.device)
-                
-                # forward
-                outputs, _ = self.global_model(
-                    x.float(), l
-                )
-        
-            if not self.multilabel: 
-                outputs = torch.log_softmax(outputs, dim=1)
-            loss = self.criterion(outputs, y)
+        with torch.inference_mode(), eval_threads(getattr(self.args, 'eval_threads', 0)):
+            for batch_idx, batch_data in enumerate(build_eval_set(self.args, dataloader)):
+                if self.args.modality == "multimodal":
+                    x_a, x_b, l_a, l_b, y = batch_data
+                    x_a, x_b, y = x_a.to(self.device), x_b.to(self.device), y.to(self.device)
+                    l_a, l_b = l_a.to(self.device), l_b.to(self.device)
+                    
+                    # forward
+                    with autocast_context(self.args, self.device):
+                        outputs, _ = self.global_model(
+                            x_a.float(), x_b.float(), l_a, l_b
+                        )
+                else:
+                    x, l, y = batch_data
+                    x, l, y = x.to(self.device), l.to(self.device), y.to(self.device)
+                    
+                    # forward
+                    with autocast_context(self.args, self.device):
+                        outputs, _ = self.global_model(
+                            x.float(), l
+                        )
+                # metrics in fp32
+                outputs = outputs.float()
             
-            # save results
-            if not self.multilabel: 
-                self.eval.append_classification_results(
-                    y, outputs, loss
-                )
-            else:
-                self.eval.append_multilabel_results(
-                    y, outputs, loss
-                )
+                if not self.multilabel: 
+                    outputs = torch.log_softmax(outputs, dim=1)
+                loss = self.criterion(outputs, y)
+                
+                # save results
+                if not self.multilabel: 
+                    self.eval.append_classification_results(
+                        y, outputs, loss
+                    )
+                else:
+                    self.eval.append_multilabel_results(
+                        y, outputs, loss
+                    )
                 
         # epoch train results
         if not self.multilabel:
@@ -294,11 +372,11 @@ class Server(object):
             metric: str='uar'
         ):
         if data_split == 'train':
-            loss = np.mean([data['loss'] for data in self.result_dict[self.epoch][data_split]])
-            acc = np.mean([data['acc'] for data in self.result_dict[self.epoch][data_split]])
-            uar = np.mean([data['uar'] for data in self.result_dict[self.epoch][data_split]])
-            top5_acc = np.mean([data['top5_acc'] for data in self.result_dict[self.epoch][data_split]])
-            f1 = np.mean([data['f1'] for data in self.result_dict[self.epoch][data_split]])
+            loss = self.average_train_result('loss')
+            acc = self.average_train_result('acc')
+            uar = self.average_train_result('uar')
+            top5_acc = self.average_train_result('top5_acc')
+            f1 = self.average_train_result('f1')
         else:
             loss = self.result_dict[self.epoch][data_split]['loss']
             acc = self.result_dict[self.epoch][data_split]['acc']
@@ -309,7 +387,9 @@ class Server(object):
                 auc = self.result_dict[self.epoch][data_split]['auc']
 
         # loggin console
-        if data_split == 'train': logging.info(f'Current Round: {self.epoch}')
+        if data_split == 'train': 
+            logging.info(f'Current Round: {self.epoch}')
+            self.log_comm_result()
         if metric == 'acc':
             logging.info(f'{data_split} set, Loss: {loss:.3f}, Acc: {acc:.2f}%, Top-5 Acc: {top5_acc:.2f}%')
         elif metric == 'f1':
@@ -319,23 +399,43 @@ class Server(object):
         
         if metric == 'auc' and data_split != 'train':
             logging.info(f'{data_split} set, Loss: {loss:.3f}, AUC: {auc:.2f}%, Top-1 Acc: {acc:.2f}%')
-        # loggin to folder
-        self.log_writer.add_scalar(f'Loss/{data_split}', loss, self.epoch)
-        self.log_writer.add_scalar(f'Acc/{data_split}', acc, self.epoch)
-        self.log_writer.add_scalar(f'UAR/{data_split}', uar, self.epoch)
-        self.log_writer.add_scalar(f'F1/{data_split}', f1, self.epoch)
-        self.log_writer.add_scalar(f'Top5_Acc/{data_split}', top5_acc, self.epoch)
+        # loggin to folder, train metrics the clients did not collect are skipped
+        for tag, value in [('Loss', loss), ('Acc', acc), ('UAR', uar), ('F1', f1), ('Top5_Acc', top5_acc)]:
+            if not np.isnan(value): self.log_writer.add_scalar(f'{tag}/{data_split}', value, self.epoch)
         if metric == 'auc' and data_split != 'train': self.log_writer.add_scalar(f'AUC/{data_split}', auc, self.epoch)
         
+    def log_comm_result(self):
+        # Log the bytes sent by the clients and to the clients this round
+        upload_mb = self.comm_bytes['upload'] / 1024 / 1024
+        download_mb = self.comm_bytes['download'] / 1024 / 1024
+        logging.info(f'Communication, Upload: {upload_mb:.2f}MB, Download: {download_mb:.2f}MB')
+        self.log_writer.add_scalar('Comm/upload_MB', upload_mb, self.epoch)
+        self.log_writer.add_scalar('Comm/download_MB', download_mb, self.epoch)
+        if 'edge_upload' in self.comm_bytes:
+            edge_upload_mb = self.comm_bytes['edge_upload'] / 1024 / 1024
+            logging.info(f'Communication, Edge to server: {edge_upload_mb:.2f}MB')
+            self.log_writer.add_scalar('Comm/edge_upload_MB', edge_upload_mb, self.epoch)
+        for key, value in self.comm_time.items():
+            logging.info(f'Communication, {key}: {value:.3f}s')
+            self.log_writer.add_scalar(f'Comm/{key}_s', value, self.epoch)
+        if 'virtual_clock' in self.result_dict[self.epoch]:
+            self.log_writer.add_scalar('Time/virtual_clock_s', self.result_dict[self.epoch]['virtual_clock'], self.epoch)
+        if 'wall_clock' in self.result_dict[self.epoch]:
+            self.log_writer.add_scalar('Time/wall_clock_s', self.result_dict[self.epoch]['wall_clock'], self.epoch)
+        if self.async_mode and len(self.staleness_list) > 0:
+            mean_staleness = np.mean(self.staleness_list)
+            logging.info(f'Asynchronous updates, Mean staleness: {mean_staleness:.2f}')
+            self.log_writer.add_scalar('Async/mean_staleness', mean_staleness, self.epoch)
+
     def log_multilabel_result(
         self, 
         data_split: str, 
         metric: str='macro_f'
     ):
         if data_split == 'train':
-            loss = np.mean([data['loss'] for data in self.result_dict[self.epoch][data_split]])
-            acc = np.mean([data['acc'] for data in self.result_dict[self.epoch][data_split]])
-            macro_f = np.mean([data['macro_f'] for data in self.result_dict[self.epoch][data_split]])
+            loss = self.average_train_result('loss')
+            acc = self.average_train_result('acc')
+            macro_f = self.average_train_result('macro_f')
         else:
             loss = self.result_dict[self.epoch][data_split]['loss']
             acc = self.result_dict[self.epoch][data_split]['acc']
@@ -346,14 +446,22 @@ class Server(object):
             logging.info(
                 f'Current Round: {self.epoch}'
             )
+            self.log_comm_result()
         logging.info(
             f'{data_split} set, Loss: {loss:.3f}, Macro-F1: {macro_f:.2f}%, Top-1 Acc: {acc:.2f}%'
         )
 
-        # logging to folder
-        self.log_writer.add_scalar(f'Loss/{data_split}', loss, self.epoch)
-        self.log_writer.add_scalar(f'Acc/{data_split}', acc, self.epoch)
-        self.log_writer.add_scalar(f'Macro-F1/{data_split}', macro_f, self.epoch)
+        # logging to folder, train metrics the clients did not collect are skipped
+        for tag, value in [('Loss', loss), ('Acc', acc), ('Macro-F1', macro_f)]:
+            if not np.isnan(value): self.log_writer.add_scalar(f'{tag}/{data_split}', value, self.epoch)
+
+    def average_train_result(
+        self,
+        key: str
+    ):
+        # Mean of a client training metric over the clients that collected it, nan if none did
+        values = [data[key] for data in self.result_dict[self.epoch]['train'] if key in data]
+        return np.mean(values) if len(values) > 0 else np.nan
 
     def save_result(
         self, 
@@ -369,20 +477,76 @@ class Server(object):
 
     def save_train_updates(
         self, 
-        model_updates: dict, 
+        model_updates, 
         num_sample: int, 
         result: dict,
-        delta_control=None
+        delta_control=None,
+        client_id=None,
+        staleness: int=0,
+        encoded: bool=False,
+        seed=None
     ):
-        self.model_updates.append(model_updates)
+        """
+        Accumulate one client update into the round aggregate.
+        :param model_updates: client state_dict, or the flat client weights; in async mode the flat client delta;
+            a codec payload when encoded
+        :param num_sample: number of client training samples
+        :param result: client training results
+        :param delta_control: scaffold control delta, state_dict or flat
+        :param client_id: client id, keys the codec error feedback and the edge
+        :param staleness: server updates since an async client started
+        :param encoded: the client already encoded its delta with the update codec
+        :param seed: client seed, seeds the codec randomness as on the client side
+        """
+        # scaffold averages clients uniformly, async by staleness, the others by sample size
+        if self.async_mode:
+            weight = 1.0 / np.sqrt(1.0 + staleness)
+            self.staleness_list.append(staleness)
+        elif self.args.fed_alg == 'scaffold':
+            weight = 1.0
+        else:
+            weight = float(num_sample)
+        model_bytes = self.aggregator.flattener.numel * 4
+        aggregator, control_aggregator = self.get_client_aggregators(client_id)
+        if encoded:
+            aggregator.add_payload(self.update_codec, model_updates, weight)
+            self.comm_bytes['upload'] += self.update_codec.num_bytes(model_updates)
+        elif self.update_codec is not None:
+            # encode the client delta, decode it into the aggregate
+            if isinstance(model_updates, dict):
+                self.aggregator.flattener.flatten(model_updates, out=self.codec_delta)
+            else:
+                self.codec_delta.copy_(model_updates)
+            if not self.async_mode: self.codec_delta.sub_(self.round_base)
+            payload = self.update_codec.encode(self.codec_delta, client_id, seed=seed)
+            aggregator.add_payload(self.update_codec, payload, weight)
+            self.comm_bytes['upload'] += self.update_codec.num_bytes(payload)
+        else:
+            aggregator.add(model_updates, weight)
+            self.comm_bytes['upload'] += model_bytes
+        self.comm_bytes['download'] += model_bytes
+        if delta_control is not None:
+            control_aggregator.add(delta_control)
+            self.comm_bytes['upload'] += model_bytes
+            self.comm_bytes['download'] += model_bytes
         self.num_samples_list.append(num_sample)
         self.result_dict[self.epoch]['train'].append(result)
-        self.delta_controls.append(delta_control)
+
+    def dev_improved(
+        self,
+        metric: str='acc'
+    ):
+        # Whether the dev result of this round becomes the best one in log_epoch_result
+        if len(self.best_test_dict) == 0: return True
+        return self.result_dict[self.epoch]['dev'][metric] > self.best_dev_dict[metric]
 
     def log_epoch_result(
         self, 
-        metric: str='acc'
+        metric: str='acc',
+        model_state: dict=None
     ):
+        # model_state: weights of the evaluated round when evaluation runs behind training
+        if model_state is None: model_state = self.global_model.state_dict()
         if len(self.best_test_dict) == 0:
             self.best_epoch = self.epoch
             self.best_dev_dict = self.result_dict[self.epoch]['dev']
@@ -394,10 +558,13 @@ class Server(object):
             self.best_dev_dict = self.result_dict[self.epoch]['dev']
             self.best_test_dict = self.result_dict[self.epoch]['test']
             torch.save(
-                deepcopy(self.global_model.state_dict()), 
+                deepcopy(model_state), 
                 str(self.result_path.joinpath('model.pt'))
             )
         
+        if 'virtual_clock' in self.result_dict[self.epoch]:
+            self.log_time_to_accuracy(metric)
+
         # log dev results
         best_dev_acc = self.best_dev_dict['acc']
         if not self.multilabel:
@@ -436,6 +603,22 @@ class Server(object):
             logging.info(f'Best dev UAR {best_dev_uar:.2f}%, Top-1 Acc {best_dev_acc:.2f}%')
             logging.info(f'Best test UAR {best_test_uar:.2f}%, Top-1 Acc {best_test_acc:.2f}%')
 
+    def log_time_to_accuracy(
+        self,
+        metric: str='acc'
+    ):
+        """
+        Log the dev metric over the simulated time, and when it first reaches args.sim_target.
+        :param metric: dev metric
+        """
+        clock = self.result_dict[self.epoch]['virtual_clock']
+        dev_result = self.result_dict[self.epoch]['dev'][metric]
+        self.log_writer.add_scalar(f'TimeToAcc/dev_{metric}', dev_result, int(round(clock)))
+        target = getattr(self.args, 'sim_target', 0.0)
+        if target > 0 and self.time_to_target is None and dev_result >= target:
+            self.time_to_target = clock
+            logging.info(f'Dev {metric} reached {target:.2f}% at round {self.epoch}, simulated time {clock:.1f}s')
+
     def summarize_results(self):
         row_df = pd.DataFrame(index=[f'fold{self.fold_idx}'])
         row_df['acc']  = self.best_test_dict['acc']
@@ -448,6 +631,11 @@ class Server(object):
 
     def summarize_dict_results(self):
         result = dict()
+        # client ranks of a distributed run do not evaluate
+        if not is_main_rank(): return result
+        if len(self.best_test_dict) == 0:
+            logging.warning(f'No round of fold {self.fold_idx} was evaluated, e.g. every client missed the deadline; the summary is empty')
+            return result
         result['acc'] = self.best_test_dict['acc']
         if not self.multilabel:
             result['top5_acc'] = self.best_test_dict['top5_acc']
@@ -456,85 +644,56 @@ class Server(object):
             if "auc" in self.best_test_dict: result['auc'] = self.best_test_dict['auc']
         else:
             result['macro_f'] = self.best_test_dict['macro_f']
+        if self.time_to_target is not None: result['time_to_target'] = self.time_to_target
         return result
 
     def average_weights(self):
         """
-        Returns the average of the weights.
+        Load the average of the client weights into the global model.
         """
         # there are no samples, return
         if len(self.num_samples_list) == 0: 
             return
-        total_num_samples = np.sum(self.num_samples_list)
-        w_avg = copy.deepcopy(self.model_updates[0])
-
-        # calculate weighted updates
-        for key in w_avg.keys():
-            if self.args.fed_alg == 'scaffold':
-                w_avg[key] = torch.div(self.model_updates[0][key], len(self.model_updates))
-            else:
-                w_avg[key] = self.model_updates[0][key]*(self.num_samples_list[0]/total_num_samples)
-        for key in w_avg.keys():
-            for i in range(1, len(self.model_updates)):
-                if self.args.fed_alg == 'scaffold':
-                    w_avg[key] += torch.div(self.model_updates[i][key], len(self.model_updates))
-                else:
-                    w_avg[key] += torch.div(self.model_updates[i][key]*self.num_samples_list[i], total_num_samples)
+        self.aggregate_edges()
+        if self.async_mode:
+            # buffered deltas: w = w_round + lr * sum(weight * delta) / K
+            w_avg = self.aggregator.sum_buf / self.aggregator.num_updates
+            w_avg.mul_(getattr(self.args, 'async_server_lr', 1.0)).add_(self.round_base)
+        else:
+            w_avg = self.aggregator.average()
+            if self.update_codec is not None: w_avg.add_(self.round_base)
         
         # server optimization or just load with weights
-        if self.args.fed_alg == 'fed_opt':
-            self.update_global(copy.deepcopy(w_avg))
+        if self.args.fed_alg in server_opt_algs:
+            self.update_global(w_avg)
         else:
-            self.global_model.load_state_dict(copy.deepcopy(w_avg))
+            self.aggregator.flattener.load_into(self.global_model, w_avg)
 
         # update global control if algorithm is scaffold
         if self.args.fed_alg == 'scaffold':
             self.update_server_control()
+        self.result_dict[self.epoch]['wall_clock'] = time.time() - self.start_time
 
     def update_server_control(self):
-        # update server control
-        total_num_samples = np.sum(self.num_samples_list)
-        delta_avg = copy.deepcopy(self.delta_controls[0])
-        new_control = copy.deepcopy(self.server_control)
-
-        for key in delta_avg.keys():
-            delta_avg[key] = torch.div(self.delta_controls[0][key], self.num_of_clients)
-            
-        for key in delta_avg.keys():
-            for idx in range(1, len(self.delta_controls)):
-                delta_avg[key] += torch.div(self.delta_controls[idx][key], self.num_of_clients)
-            new_control[key] = new_control[key] - delta_avg[key]
-        self.server_control = copy.deepcopy(new_control)
+        # update server control with the summed control deltas
+        delta_sum = self.control_aggregator.flattener.unflatten(
+            self.control_aggregator.sum_buf, cast=False
+        )
+        for key in self.server_control.keys():
+            self.server_control[key] = self.server_control[key] - delta_sum[key] / self.num_of_clients
         
     def update_global(
         self, 
-        update_weights
+        w_avg
     ):
-        # zero_grad
-        self.global_optimizer.zero_grad()
-        global_optimizer_state = self.global_optimizer.state_dict()
-
-        # new_model
-        new_model = copy.deepcopy(self.global_model)
-        new_model.load_state_dict(update_weights, strict=True)
-
-        # set global_model gradient
-        with torch.no_grad():
-            for param, new_param in zip(
-                self.global_model.parameters(), new_model.parameters()
-            ):
-                param.grad = (param.data - new_param.data) / self.args.learning_rate
-
-        # replace some non-parameters's state dict
-        state_dict = self.global_model.state_dict()
-        for name in dict(self.global_model.named_parameters()).keys():
-            update_weights[name] = state_dict[name]
-        self.global_model.load_state_dict(update_weights, strict=True)
-
-        # optimization
-        self.global_optimizer = self._initialize_global_optimizer()
-        self.global_optimizer.load_state_dict(global_optimizer_state)
-        self.global_optimizer.step()
+        """
+        Step the server optimizer on the averaged client weights.
+        :param w_avg: flat average of the client weights
+        """
+        flattener = self.aggregator.flattener
+        flattener.flatten(self.global_model.state_dict(), out=self.global_weights)
+        self.global_optimizer.step(self.global_weights, w_avg)
+        flattener.load_into(self.global_model, self.global_weights)
 
     def set_save_json_file(
         self, 
@@ -548,6 +707,8 @@ class Server(object):
         data_dict, 
         data_path
     ):
+        # only the server rank writes results
+        if not is_main_rank(): return
         jsonString = json.dumps(
             data_dict, 
             indent=4
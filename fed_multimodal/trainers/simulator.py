@@ -0,0 +1,224 @@
+import math
+import torch
+import numpy as np
+
+from .update_codec import build_update_codec
+
+# logging format
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-3s ==> %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+class DeviceProfiles(object):
+    """
+    Compute speed and bandwidth of every client device.
+
+    Speeds are drawn once from lognormal distributions around the mean
+    device FLOP/s and uplink bandwidth, with a fixed seed, so the same
+    clients are slow in every round and every run. Downlinks are
+    down_ratio times faster than uplinks.
+    """
+    def __init__(
+        self,
+        client_ids: list,
+        gflops: float=10.0,
+        bandwidth_mbps: float=10.0,
+        speed_sigma: float=0.0,
+        bandwidth_sigma: float=0.0,
+        down_ratio: float=4.0,
+        seed: int=0
+    ):
+        rng = np.random.RandomState(seed)
+        num_clients = len(client_ids)
+        self.index = {client_id: idx for idx, client_id in enumerate(client_ids)}
+        # lognormal with the given mean
+        self.flops = gflops * 1e9 * rng.lognormal(-speed_sigma**2 / 2, speed_sigma, num_clients)
+        self.upload_bps = bandwidth_mbps * 1e6 / 8 * rng.lognormal(-bandwidth_sigma**2 / 2, bandwidth_sigma, num_clients)
+        self.download_bps = self.upload_bps * down_ratio
+
+
+class RoundSimulator(object):
+    """
+    Discrete-event virtual clock on top of the synchronous rounds.
+
+    Every sampled client gets a completion time: download the global
+    weights, train local_epochs over its samples at the measured training
+    FLOPs per sample, upload its update through the update codec. The
+    server takes the first finishers (target = number of sampled clients,
+    over-selection samples extra clients), drops clients past the deadline
+    and clients that go offline, and the clock advances to the time the
+    round closes. Only the kept clients are trained.
+
+    plan_round only does numpy work on per-client arrays, so thousands of
+    scheduling configurations can be explored without training.
+    """
+    def __init__(
+        self,
+        args,
+        dataloader_dict: dict,
+        model
+    ):
+        self.args = args
+        self.client_ids = [key for key in dataloader_dict.keys() if key not in ['dev', 'test']]
+        self.deadline = getattr(args, 'sim_deadline', 0.0)
+        self.over_select = getattr(args, 'sim_over_select', 0.0)
+        self.dropout = getattr(args, 'sim_dropout', 0.0)
+        self.profiles = DeviceProfiles(
+            self.client_ids,
+            gflops=getattr(args, 'sim_gflops', 10.0),
+            bandwidth_mbps=getattr(args, 'sim_bandwidth_mbps', 10.0),
+            speed_sigma=getattr(args, 'sim_speed_sigma', 0.5),
+            bandwidth_sigma=getattr(args, 'sim_bandwidth_sigma', 0.5)
+        )
+        self.num_samples = np.array([
+            0 if dataloader_dict[client_id] is None else len(dataloader_dict[client_id].dataset)
+            for client_id in self.client_ids
+        ])
+        self.train_flops = measure_train_flops(args, dataloader_dict, model)
+        self.download_bytes, self.upload_bytes = self.update_bytes(model)
+        self.clock = 0.0
+
+    def update_bytes(
+        self,
+        model
+    ):
+        # Bytes of one client download and upload
+        numel = sum(value.numel() for value in model.state_dict().values())
+        download_bytes, upload_bytes = numel * 4, numel * 4
+        codec = build_update_codec(self.args, numel)
+        if codec is not None:
+            # payload sizes do not depend on the values
+            upload_bytes = codec.num_bytes(codec.encode(torch.zeros(numel)))
+        if self.args.fed_alg == 'scaffold':
+            download_bytes, upload_bytes = download_bytes + numel * 4, upload_bytes + numel * 4
+        return download_bytes, upload_bytes
+
+    def client_times(
+        self,
+        client_ids: list
+    ):
+        """
+        Completion time of each client in a round.
+        :param client_ids: client ids
+        :return: seconds from the round start, numpy array
+        """
+        idx = np.array([self.profiles.index[client_id] for client_id in client_ids], dtype=np.int64)
+        compute = self.num_samples[idx] * self.args.local_epochs * self.train_flops / self.profiles.flops[idx]
+        comm = self.download_bytes / self.profiles.download_bps[idx] + self.upload_bytes / self.profiles.upload_bps[idx]
+        return compute + comm
+
+    def plan_round(
+        self,
+        client_ids: list,
+        epoch: int
+    ):
+        """
+        Select the clients that report back in time.
+        :param client_ids: sampled client ids of the round
+        :param epoch: round index, seeds over-selection and dropouts
+        :return: kept_ids: clients to train, dropped_ids, round_time: seconds
+        """
+        rng = np.random.RandomState(epoch)
+        target = len(client_ids)
+        selected = list(client_ids)
+        # over-selection: sample extra clients, keep the first target finishers
+        num_extra = min(
+            int(math.ceil(target * self.over_select)),
+            len(self.client_ids) - target
+        )
+        if num_extra > 0:
+            sampled = set(client_ids)
+            candidates = [client_id for client_id in self.client_ids if client_id not in sampled]
+            selected += [candidates[idx] for idx in rng.choice(len(candidates), num_extra, replace=False)]
+
+        times = self.client_times(selected)
+        if self.dropout > 0: times[rng.rand(len(selected)) < self.dropout] = np.inf
+        if self.deadline > 0: times[times > self.deadline] = np.inf
+        order = np.argsort(times, kind='stable')
+        kept = [idx for idx in order[:target] if np.isfinite(times[idx])]
+
+        # the round closes at the last kept arrival, or at the deadline if clients are missing
+        if len(kept) < target and self.deadline > 0:
+            round_time = self.deadline
+        elif len(kept) > 0:
+            round_time = float(times[kept[-1]])
+        else:
+            round_time = 0.0
+        kept_ids = [selected[idx] for idx in sorted(kept)]
+        kept = set(kept)
+        dropped_ids = [selected[idx] for idx in range(len(selected)) if idx not in kept]
+        return kept_ids, dropped_ids, round_time
+
+
+class SimulatedRoundExecutor(object):
+    """
+    Run a round executor on the clients kept by the round simulator.
+    """
+    def __init__(
+        self,
+        executor,
+        simulator: RoundSimulator
+    ):
+        self.executor = executor
+        self.simulator = simulator
+
+    def run_round(
+        self,
+        server,
+        client_ids: list
+    ):
+        kept_ids, dropped_ids, round_time = self.simulator.plan_round(client_ids, server.epoch)
+        self.simulator.clock += round_time
+        server.result_dict[server.epoch]['virtual_clock'] = self.simulator.clock
+        server.result_dict[server.epoch]['dropped_clients'] = dropped_ids
+        logging.info(f'Simulated Round: {server.epoch}, Time: {round_time:.1f}s, Drop client {dropped_ids}')
+        return self.executor.run_round(server, kept_ids)
+
+    def close(self):
+        self.executor.close()
+
+
+def measure_train_flops(
+    args,
+    dataloader_dict: dict,
+    model
+):
+    """
+    Training FLOPs per sample, 3x the forward FLOPs of one client batch.
+    :param args: arguments, modality
+    :param dataloader_dict: client dataloaders
+    :param model: global model
+    :return: FLOPs per training sample
+    """
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        FlopCounterMode = None
+    dataloader = next(
+        dataloader for key, dataloader in dataloader_dict.items()
+        if key not in ['dev', 'test'] and dataloader is not None
+    )
+    # keep the global generator untouched by the shuffled sampler
+    with torch.random.fork_rng(devices=[]):
+        batch_data = next(iter(dataloader))
+    num_params = sum(p.numel() for p in model.parameters())
+    if FlopCounterMode is None:
+        # dense estimate without the flop counter
+        return 6.0 * num_params
+    device = next(model.parameters()).device
+    # eval mode keeps the batch norm statistics untouched
+    training = model.training
+    model.eval()
+    with torch.no_grad(), FlopCounterMode(display=False) as flop_counter:
+        if args.modality == "multimodal":
+            x_a, x_b, l_a, l_b, _ = batch_data
+            model(x_a.float().to(device), x_b.float().to(device), l_a.to(device), l_b.to(device))
+        else:
+            x, l, _ = batch_data
+            model(x.float().to(device), l.to(device))
+    model.train(training)
+    return 3.0 * flop_counter.get_total_flops() / len(batch_data[-1])
@@ -0,0 +1,206 @@
+import torch
+
+from .evaluation import EvalMetric
+from .server_optimizer import server_opt_algs
+from .mixed_precision import autocast_context
+
+try:
+    from torch.func import functional_call, grad, vmap
+except ImportError:
+    functional_call, grad, vmap = None, None, None
+
+
+class StackedClientTrainer(object):
+    """
+    Train several small clients together as one stacked model.
+
+    The parameters of K clients are stacked on a leading dim and every local
+    step runs once through torch.func.vmap. Clients with fewer batches are
+    masked out of the remaining steps, and padded samples are masked out of
+    the loss. Local updates follow ClientFedAvg: SGD with momentum 0.9, weight
+    decay 1e-5, gradient clipping at 10, and the proximal term for fed_prox.
+    It only suits models that keep sequence lengths on device (HARClassifier,
+    ECGClassifier).
+    """
+    def __init__(
+        self,
+        args,
+        device,
+        criterion,
+        model
+    ):
+        if vmap is None:
+            raise ImportError('Stacked client training requires torch.func (torch>=2.0)')
+        if args.fed_alg not in ['fed_avg', 'fed_prox'] + server_opt_algs:
+            raise ValueError(f'Stacked client training does not support {args.fed_alg}')
+        self.args = args
+        self.model = model
+        self.device = device
+        self.multilabel = True if args.dataset == 'ptb-xl' else False
+        self.momentum = 0.9
+        self.weight_decay = 1e-5
+        self.max_norm = 10.0
+        self.mu = args.mu if args.fed_alg == 'fed_prox' else 0
+        # per-sample criterion, so padded samples can be masked out
+        self.sample_criterion = type(criterion)(reduction='none')
+        self.param_names = [name for name, _ in model.named_parameters()]
+        self.grad_fn = vmap(
+            grad(self.compute_loss, has_aux=True),
+            in_dims=(0, 0, 0, 0),
+            randomness='different'
+        )
+
+    def compute_loss(
+        self,
+        params: dict,
+        inputs: tuple,
+        y,
+        weight
+    ):
+        # Weighted loss of one client batch, padded samples have zero weight
+        with autocast_context(self.args, self.device):
+            outputs, _ = functional_call(self.model, params, inputs)
+        outputs = outputs.float()
+        if not self.multilabel:
+            outputs = torch.log_softmax(outputs, dim=1)
+        loss = self.sample_criterion(outputs, y)
+        if loss.dim() > 1: loss = loss.mean(dim=1)
+        loss = (loss * weight).sum() / weight.sum().clamp(min=1)
+        return loss, (outputs.detach(), loss.detach())
+
+    def client_batches(
+        self,
+        dataloader
+    ):
+        # Materialize the local training batches of one client
+        batches = list()
+        for iter in range(int(self.args.local_epochs)):
+            for batch_idx, batch_data in enumerate(dataloader):
+                if self.args.dataset == 'extrasensory' and batch_idx > 20: continue
+                batches.append(batch_data)
+        return batches
+
+    def stack_step(
+        self,
+        batch_list: list
+    ):
+        """
+        Pad and stack one step of K client batches.
+        :param batch_list: one batch per client, None for finished clients
+        :return: inputs, y, weight, active
+        """
+        template = next(batch for batch in batch_list if batch is not None)
+        max_bs = max(len(batch[-1]) for batch in batch_list if batch is not None)
+        stacked = list()
+        for idx in range(len(template)):
+            shape = [max_bs] + [
+                max(batch[idx].shape[dim] for batch in batch_list if batch is not None)
+                for dim in range(1, template[idx].dim())
+            ]
+            tensors = list()
+            for batch in batch_list:
+                data = template[idx] if batch is None else batch[idx]
+                padded = torch.zeros(shape, dtype=data.dtype)
+                padded[tuple(slice(0, size) for size in data.shape)] = data
+                # padded samples reuse the first sequence length
+                if data.dim() == 1 and idx != len(template) - 1:
+                    padded[len(data):] = data[0]
+                tensors.append(padded)
+            stacked.append(torch.stack(tensors, dim=0).to(self.device))
+        weight = torch.zeros(len(batch_list), max_bs)
+        for client_idx, batch in enumerate(batch_list):
+            if batch is not None: weight[client_idx, :len(batch[-1])] = 1
+        active = torch.tensor([batch is not None for batch in batch_list])
+        inputs = tuple(
+            data.float() if data.is_floating_point() else data for data in stacked[:-1]
+        )
+        return inputs, stacked[-1], weight.to(self.device), active.to(self.device)
+
+    def train(
+        self,
+        global_model,
+        dataloaders: list,
+        metric_modes: list=None
+    ):
+        """
+        Train K clients starting from the global model.
+        :param global_model: global model
+        :param dataloaders: client train dataloaders
+        :param metric_modes: training metrics of every client, full by default
+        :return: list of (model_updates, result), one per client
+        """
+        num_clients = len(dataloaders)
+        self.model.load_state_dict(global_model.state_dict())
+        self.model.train()
+
+        # stacked parameters, momentum buffers and proximal anchors
+        global_params = dict(self.model.named_parameters())
+        params = [
+            global_params[name].detach().unsqueeze(0).repeat(
+                num_clients, *[1]*global_params[name].dim()
+            ).contiguous() for name in self.param_names
+        ]
+        anchors = [param.clone() for param in params] if self.mu != 0 else None
+        momentum_bufs = [torch.zeros_like(param) for param in params]
+
+        client_batches = [self.client_batches(dataloader) for dataloader in dataloaders]
+        num_steps = max(len(batches) for batches in client_batches)
+        if metric_modes is None: metric_modes = ['full'] * num_clients
+        evals = [EvalMetric(self.multilabel, mode=mode) for mode in metric_modes]
+        for step in range(num_steps):
+            batch_list = [
+                batches[step] if step < len(batches) else None for batches in client_batches
+            ]
+            inputs, y, weight, active = self.stack_step(batch_list)
+            grads, (outputs, loss) = self.grad_fn(
+                dict(zip(self.param_names, params)), inputs, y, weight
+            )
+            grads = [grads[name] for name in self.param_names]
+            with torch.no_grad():
+                # clip gradients per client
+                norms = torch.stack([
+                    g.reshape(num_clients, -1).pow(2).sum(dim=1) for g in grads
+                ]).sum(dim=0).sqrt()
+                clip_coef = torch.clamp(self.max_norm / (norms + 1e-6), max=1.0)
+                for g in grads: g.mul_(clip_coef.view(-1, *[1]*(g.dim()-1)))
+
+                # sgd with momentum, finished clients keep their state
+                torch._foreach_add_(grads, params, alpha=self.weight_decay)
+                new_bufs = torch._foreach_add(
+                    torch._foreach_mul(momentum_bufs, self.momentum), grads
+                )
+                # proximal term goes into the buffer, as in FedProxOptimizer
+                if self.mu != 0:
+                    torch._foreach_add_(new_bufs, torch._foreach_sub(params, anchors), alpha=self.mu)
+                new_params = torch._foreach_add(params, new_bufs, alpha=-self.args.learning_rate)
+                for idx in range(len(params)):
+                    mask = active.view(-1, *[1]*(params[idx].dim()-1))
+                    params[idx] = torch.where(mask, new_params[idx], params[idx])
+                    momentum_bufs[idx] = torch.where(mask, new_bufs[idx], momentum_bufs[idx])
+
+            # save results
+            for client_idx, batch in enumerate(batch_list):
+                if batch is None: continue
+                bs = len(batch[-1])
+                if not self.multilabel:
+                    evals[client_idx].append_classification_results(
+                        y[client_idx, :bs], outputs[client_idx, :bs], loss[client_idx]
+                    )
+                else:
+                    evals[client_idx].append_multilabel_results(
+                        y[client_idx, :bs], outputs[client_idx, :bs], loss[client_idx]
+                    )
+
+        # per client state dicts
+        client_updates = list()
+        state_dict = self.model.state_dict()
+        for client_idx in range(num_clients):
+            model_updates = {key: value.clone() for key, value in state_dict.items()}
+            for name, param in zip(self.param_names, params):
+                model_updates[name] = param[client_idx].clone()
+            if not self.multilabel:
+                result = evals[client_idx].classification_summary()
+            else:
+                result = evals[client_idx].multilabel_summary()
+            client_updates.append((model_updates, result))
+        return client_updates
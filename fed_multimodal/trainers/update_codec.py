@@ -0,0 +1,271 @@
+import math
+import torch
+
+from .control_store import ControlVariateStore
+
+
+class UpdateCodec(object):
+    """
+    Codec for flat client deltas (client weights - global weights).
+
+    encode runs once per client update and returns a payload dict of tensors,
+    decode_add adds the weighted decoded delta straight into the aggregation
+    buffer, so a decoded update is never materialized as a state_dict.
+    Codecs with error_feedback keep a residual per client.
+    """
+    error_feedback = False
+
+    def __init__(
+        self,
+        numel: int,
+        device=None
+    ):
+        self.numel = numel
+        self.device = device
+        self.generator = torch.Generator(device=device if device is not None else 'cpu')
+        self.generator.manual_seed(0)
+
+    def encode(
+        self,
+        delta,
+        client_id=None,
+        seed=None,
+        residual=None
+    ):
+        """
+        Encode one flat client delta.
+        :param delta: flat fp32 delta
+        :param client_id: client id, keys the error feedback residual
+        :param seed: seed of the encode randomness, the codec generator when None
+        :param residual: flat fp32 residual of the client, read and updated in place
+            instead of the one in the codec store
+        :return: payload dict
+        """
+        raise NotImplementedError
+
+    def random_generator(
+        self,
+        seed=None,
+        device=None
+    ):
+        # Generator of one encode: a fresh one from the seed, else the codec one
+        if seed is None: return self.generator
+        generator = torch.Generator(device=device if device is not None else 'cpu')
+        generator.manual_seed(seed)
+        return generator
+
+    def decode_add(
+        self,
+        payload: dict,
+        out,
+        weight: float=1.0
+    ):
+        raise NotImplementedError
+
+    def num_bytes(
+        self,
+        payload: dict
+    ):
+        # Bytes on the wire: the payload tensors plus 8 bytes per extra scalar
+        return sum(
+            value.numel() * value.element_size() if torch.is_tensor(value) else 8
+            for value in payload.values()
+        )
+
+
+class HalfCodec(UpdateCodec):
+    """
+    fp16 deltas.
+    """
+    def encode(
+        self,
+        delta,
+        client_id=None,
+        seed=None,
+        residual=None
+    ):
+        return {'delta': delta.half()}
+
+    def decode_add(
+        self,
+        payload: dict,
+        out,
+        weight: float=1.0
+    ):
+        out.add_(payload['delta'], alpha=weight)
+
+
+class QuantizeCodec(UpdateCodec):
+    """
+    Stochastic uniform quantization to 8 or 4 bits, one fp32 scale per bucket.
+
+    Every bucket is scaled to [-levels, levels] by its max abs value and
+    rounded up or down at random, so the decoded delta is unbiased. 4-bit
+    codes are packed two per byte.
+    """
+    def __init__(
+        self,
+        numel: int,
+        device=None,
+        num_bits: int=8,
+        bucket_size: int=512
+    ):
+        super().__init__(numel, device)
+        if num_bits not in [4, 8]:
+            raise ValueError(f'Quantization not support {num_bits} bits')
+        self.num_bits = num_bits
+        self.levels = 2 ** (num_bits - 1) - 1
+        self.bucket_size = bucket_size
+        self.num_buckets = math.ceil(numel / bucket_size)
+        self.padded_numel = self.num_buckets * bucket_size
+
+    def encode(
+        self,
+        delta,
+        client_id=None,
+        seed=None,
+        residual=None
+    ):
+        padded = torch.zeros(self.padded_numel, device=delta.device)
+        padded[:self.numel] = delta
+        buckets = padded.view(self.num_buckets, self.bucket_size)
+        scale = buckets.abs().amax(dim=1).clamp(min=1e-12) / self.levels
+        noise = torch.rand(buckets.shape, generator=self.random_generator(seed, delta.device), device=delta.device)
+        codes = torch.floor(buckets / scale[:, None] + noise).clamp_(-self.levels, self.levels)
+        codes = codes.to(torch.int8).view(-1)
+        if self.num_bits == 4:
+            # shift to [1, 15] and pack two codes per byte
+            codes = (codes + 8).to(torch.uint8).view(-1, 2)
+            codes = codes[:, 0] | (codes[:, 1] << 4)
+        return {'codes': codes, 'scale': scale}
+
+    def decode_add(
+        self,
+        payload: dict,
+        out,
+        weight: float=1.0
+    ):
+        codes = payload['codes']
+        if self.num_bits == 4:
+            codes = torch.stack([codes & 15, codes >> 4], dim=1).view(-1).to(torch.int8) - 8
+        values = codes.view(self.num_buckets, self.bucket_size) * payload['scale'][:, None]
+        out.add_(values.view(-1)[:self.numel], alpha=weight)
+
+
+class SparseCodec(UpdateCodec):
+    """
+    Top-k or random-k sparsification with per-client error feedback.
+
+    The part of the delta that is not sent is kept as the client residual and
+    added to the next delta of the same client. Residuals live in a
+    ControlVariateStore, fp16 by default and spilled to disk beyond hot_size
+    clients. Random-k sends a seed instead of the indices.
+    """
+    error_feedback = True
+
+    def __init__(
+        self,
+        numel: int,
+        device=None,
+        ratio: float=0.01,
+        method: str='topk',
+        residual_dtype=torch.float16,
+        hot_size: int=0,
+        spill_dir: str=None
+    ):
+        super().__init__(numel, device)
+        if method not in ['topk', 'randk']:
+            raise ValueError(f'Sparsification not support {method}')
+        self.method = method
+        self.k = max(1, int(ratio * numel))
+        self.residuals = ControlVariateStore(
+            {'residual': torch.zeros(numel)},
+            dtype=residual_dtype,
+            hot_size=hot_size,
+            spill_dir=spill_dir
+        )
+
+    def encode(
+        self,
+        delta,
+        client_id=None,
+        seed=None,
+        residual=None
+    ):
+        # error feedback: add back what was not sent last time
+        corrected = delta.clone()
+        if residual is not None:
+            corrected.add_(residual)
+        elif client_id in self.residuals:
+            corrected.add_(self.residuals.get_flat(client_id).to(corrected.device))
+        if self.method == 'topk':
+            indices = torch.topk(corrected.abs(), self.k, sorted=False)[1]
+            payload = {'indices': indices.to(torch.int32)}
+        else:
+            generator = self.random_generator(seed, self.generator.device)
+            index_seed = int(torch.randint(
+                0, 2**31 - 1, (1,), generator=generator, device=generator.device
+            ))
+            indices = self.random_indices(index_seed, corrected.device)
+            payload = {'seed': index_seed}
+        payload['values'] = corrected[indices]
+        corrected[indices] = 0
+        if residual is not None:
+            residual.copy_(corrected)
+        elif client_id is not None:
+            self.residuals.set(client_id, corrected)
+        return payload
+
+    def random_indices(
+        self,
+        seed: int,
+        device
+    ):
+        # Regenerate the random-k indices from the seed
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+        return torch.randperm(self.numel, generator=generator, device=device)[:self.k]
+
+    def decode_add(
+        self,
+        payload: dict,
+        out,
+        weight: float=1.0
+    ):
+        if self.method == 'topk':
+            indices = payload['indices'].long()
+        else:
+            indices = self.random_indices(payload['seed'], out.device)
+        out.index_add_(0, indices, payload['values'], alpha=weight)
+
+
+def build_update_codec(
+    args,
+    numel: int,
+    device=None
+):
+    """
+    Return the codec selected by args.update_codec, None sends full fp32 weights.
+    :param args: arguments, update_codec, codec_ratio and the residual storage of topk and randk
+    :param numel: number of elements of a flat update
+    :param device: device of the aggregation buffer
+    :return: update codec or None
+    """
+    codec = getattr(args, 'update_codec', 'none')
+    if codec == 'none':
+        return None
+    elif codec == 'fp16':
+        return HalfCodec(numel, device)
+    elif codec in ['q8', 'q4']:
+        return QuantizeCodec(numel, device, num_bits=int(codec[1]))
+    elif codec in ['topk', 'randk']:
+        return SparseCodec(
+            numel,
+            device,
+            ratio=getattr(args, 'codec_ratio', 0.01),
+            method=codec,
+            residual_dtype=torch.float32 if getattr(args, 'codec_residual_dtype', 'fp16') == 'fp32' else torch.float16,
+            hot_size=getattr(args, 'codec_hot_clients', 0),
+            spill_dir=getattr(args, 'control_spill_dir', None)
+        )
+    raise ValueError(f'Update codec not support {codec}')